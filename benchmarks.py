@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""Times the CPU-bound parts of the test harness
+
+Each benchmark runs its code several times on inputs prepared beforehand,
+and reports the best and median time. Results may be saved as JSON with
+-o and compared with an earlier result with -c, e.g. to check a commit
+for regressions:
+    ./benchmarks.py -o before.json
+    (check out another commit)
+    ./benchmarks.py -c before.json
+
+Run from the repository's top directory.
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from os.path import join as pjoin
+
+import yaml
+
+import logger
+import plan
+import utils
+from get_time import print_table
+
+# sizes of the synthetic results logs that parse_logfile reads
+LOG_SIZES = 100000, 1000000
+
+# modules whose init_module() expands test cases
+EXPANDED_MODULES = {'lps': 'lps_modeler', 'glycolipid': 'glycolipid_modeler',
+                    'mca': 'multicomponent_assembler'}
+
+HEADER = ['benchmark', 'items', 'best (ms)', 'median (ms)', 'per item (us)']
+COMPARE_HEADER = ['benchmark', 'best (ms)', 'baseline (ms)', 'change']
+
+def test_case_files():
+    """Returns {module: [paths]} of every test case file under test_cases
+
+    Test case files hold a list of test cases; other YAML files, like
+    maps of custom options, are left out.
+    """
+    files = {}
+    for path in sorted(glob.glob(pjoin('test_cases', '*', '*.yml'))):
+        cases = utils.read_yaml(path)
+        if isinstance(cases, list) and all(isinstance(case, dict) and 'label' in case
+                                           for case in cases):
+            module = os.path.basename(os.path.dirname(path))
+            files.setdefault(module, []).append(path)
+    return files
+
+def compile_cases(files, cache_dir):
+    """Compiles files as run_tests.py does, without a cached plan
+
+    Returns
+    =======
+        {module: [test cases]}
+    """
+    compiler = plan.PlanCompiler(cache_dir=cache_dir)
+    return {module: compiler.compile(module, paths, use_cache=False)
+            for module, paths in files.items()}
+
+def default_test_files(module):
+    """Returns the paths of the test case files run_tests.py runs by default"""
+    files = []
+    for default in 'standard', 'minimal':
+        default_path = pjoin('test_cases', module, default+'.yml')
+        if os.path.exists(default_path):
+            files += utils.read_yaml(default_path)['files']
+    if not files:
+        files = ['basic.yml']
+    return [utils.find_test_file(test_file, module=module)
+            for test_file in dict.fromkeys(files)]
+
+def _log_entry(rng, labels):
+    """Returns the text of one random result, as run_tests.py logs it"""
+    modules = 'bilayer', 'mca', 'pdb', 'solution', 'nanodisc'
+    event = {'module': rng.choice(modules), 'label': rng.choice(labels),
+             'jobid': str(rng.randrange(10**9, 10**10)),
+             'elapsed_time': rng.uniform(10, 3600)}
+    kind = rng.random()
+    if kind < .2:
+        event.update(result='exception', step=rng.randrange(1, 8),
+                exception='Traceback (most recent call last):\n'+\
+                          '  File "cgui_browser_process.py", line 1\n'+\
+                          'TimeoutError\n')
+    elif kind < .4:
+        event.update(result='failed', step=rng.randrange(1, 8))
+    elif kind < .5:
+        event.update(result='invalid', reason='Error: charges differ\n')
+    else:
+        event.update(result='success', validated=True,
+                     memory={'peak': 300., 'mean': 200.})
+    text = logger.format_result(event)
+    if kind > .8:
+        # a PHP message precedes the result of its test case
+        text = 'Job "{}" ({}) encountered PHP message on step 3:\n'.format(
+                event['label'], event['jobid']) + 'Notice: undefined index\n' + text
+    return text
+
+def synthetic_log(filename, num_lines, seed=0):
+    """Writes a results log of about num_lines lines, like run_tests.py's"""
+    rng = random.Random(seed)
+    labels = ['test case {}'.format(case_no) for case_no in range(2000)]
+    entries = [_log_entry(rng, labels) for _ in range(10000)]
+    lines = 0
+    with open(filename, 'w') as log:
+        while lines < num_lines:
+            text = rng.choice(entries)
+            log.write(text)
+            lines += text.count('\n')
+
+def perturbed_psf(reference, filename):
+    """Writes a copy of a PSF that diff_psf() has to compare in full
+
+    The first entry of every section is moved by a space, so that no
+    section's text equals the reference's, and the first atom's charge and
+    the first bond are changed, so that differences are found and reported.
+    """
+    import psf
+
+    with open(reference, 'rb') as psf_file:
+        data = psf_file.read()
+    pieces = []
+    last = 0
+    for section, counts, body_start, _header_start in psf.PSF.read_headers(data):
+        if section == 'NTITLE' or not counts[0]:
+            continue
+        line_end = data.find(b'\n', body_start)
+        if line_end == -1:
+            line_end = len(data)
+        tokens = data[body_start:line_end].split()
+        if section == 'NATOM' and len(tokens) > psf.ATOM_CHARGE:
+            charge = float(tokens[psf.ATOM_CHARGE]) + .5
+            tokens[psf.ATOM_CHARGE] = '{:.6f}'.format(charge).encode()
+        elif section == 'NBOND' and len(tokens) > 1:
+            tokens[0], tokens[1] = tokens[1], tokens[0]
+        pieces += [data[last:body_start], b' ' + b' '.join(tokens)]
+        last = line_end
+    pieces.append(data[last:])
+    with open(filename, 'wb') as psf_file:
+        psf_file.write(b''.join(pieces))
+
+def bench_compile(state, repeat):
+    """Compiles every test case file under test_cases"""
+    files = test_case_files()
+    runs = [lambda: compile_cases(files, state['cache_dir'])] * repeat
+    num_cases = sum(map(len, compile_cases(files, state['cache_dir']).values()))
+    return runs, num_cases
+
+def bench_parse_logfile(state, repeat, num_lines):
+    """Parses a synthetic results log"""
+    filename = pjoin(state['tmp_dir'], 'results-{}.log'.format(num_lines))
+    synthetic_log(filename, num_lines)
+    # an open file is always parsed entirely, without checkpoints; larger
+    # logs are parsed fewer times, so that they don't take much longer
+    repeat = max(1, repeat * min(num_lines, min(LOG_SIZES)) // num_lines)
+    runs = [lambda: logger.parse_logfile(open(filename))] * repeat
+    return runs, num_lines
+
+def bench_psf_seek_title(state, repeat):
+    """Skips the title of every reference PSF"""
+    references = glob.glob(pjoin('files', 'references', '*', '*.psf'))
+    def run():
+        for reference in references:
+            with open(reference) as psf_file:
+                utils.psf_seek_title(psf_file)
+    return [run] * repeat, len(references)
+
+def bench_diff_psf(state, repeat):
+    """Compares every reference PSF with a slightly changed copy"""
+    references = glob.glob(pjoin('files', 'references', '*', '*.psf'))
+    pairs = []
+    for ref_no, reference in enumerate(references):
+        target = pjoin(state['tmp_dir'], 'target-{}.psf'.format(ref_no))
+        perturbed_psf(reference, target)
+        pairs.append((target, reference))
+    def run():
+        for target, reference in pairs:
+            utils.diff_psf(target, reference)
+    return [run] * repeat, len(references)
+
+def bench_init_module(state, repeat, module):
+    """Expands a module's default test cases with its init_module()"""
+    from importlib import import_module
+
+    init_module = import_module(EXPANDED_MODULES[module]).init_module
+    compiler = plan.PlanCompiler(cache_dir=state['cache_dir'])
+    cases = compiler.compile(module, default_test_files(module), use_cache=False)
+    args = Namespace(copy=True, base_url='http://localhost/')
+    # init_module() may modify the test cases it is given
+    inputs = [copy.deepcopy(cases) for _ in range(repeat)]
+    return [lambda: init_module(inputs.pop(), args)] * repeat, len(cases)
+
+def bench_dry_run(state, repeat):
+    """Dumps every compiled test case as YAML, as --dry-run does"""
+    cases = [case for module_cases in state['cases'].values() for case in module_cases]
+    def run():
+        for case in cases:
+            yaml.dump([case])
+    return [run] * repeat, len(cases)
+
+def benchmarks(log_sizes=LOG_SIZES):
+    """Returns [(name, function, extra arguments)] of every benchmark"""
+    benches = [('compile_test_cases', bench_compile, ())]
+    for num_lines in log_sizes:
+        benches.append(('parse_logfile_{}'.format(num_lines), bench_parse_logfile,
+                        (num_lines,)))
+    benches += [('psf_seek_title', bench_psf_seek_title, ()),
+                ('diff_psf', bench_diff_psf, ())]
+    for module in EXPANDED_MODULES:
+        benches.append(('init_module_{}'.format(module), bench_init_module, (module,)))
+    benches.append(('dry_run_dump', bench_dry_run, ()))
+    return benches
+
+def run_benchmarks(names=None, repeat=5, log_sizes=LOG_SIZES):
+    """Runs benchmarks and returns their results
+
+    Parameters
+    ==========
+        names      list  names of benchmarks to run, or None for all
+        repeat     int   number of times to time each benchmark
+        log_sizes  list  numbers of lines of the logs parse_logfile reads
+
+    Returns
+    =======
+        {name: {'items': number of items per run, 'times': [seconds]}}
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmarks-') as tmp_dir:
+        state = {'tmp_dir': tmp_dir, 'cache_dir': pjoin(tmp_dir, 'plans')}
+        state['cases'] = compile_cases(test_case_files(), state['cache_dir'])
+        for name, function, extra in benchmarks(log_sizes):
+            if names and not name in names:
+                continue
+            runs, items = function(state, repeat, *extra)
+            times = []
+            for run in runs:
+                start_time = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start_time)
+            results[name] = {'items': items, 'times': times}
+            print(name, "best {:.4f} s".format(min(times)), file=sys.stderr)
+    return results
+
+def git_revision():
+    """Returns the commit checked out, with '+' if there are changes"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain',
+                                           '--untracked-files=no']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if changes else '')
+
+def _main():
+    parser = argparse.ArgumentParser(
+            description="Time the CPU-bound parts of the test harness")
+    parser.add_argument('names', nargs='*', metavar='BENCHMARK',
+            help="benchmarks to run (default: all); see --list")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+            help="number of times to time each benchmark (default: 5)")
+    parser.add_argument('--log-sizes', type=int, nargs='+', default=LOG_SIZES,
+            metavar='LINES', help="lines of the logs to parse (default: "+\
+                                  ' '.join(map(str, LOG_SIZES))+")")
+    parser.add_argument('-o', '--output', metavar='PATH',
+            help="save the results to PATH as JSON")
+    parser.add_argument('-c', '--compare', metavar='PATH',
+            help="compare with results saved with -o")
+    parser.add_argument('--list', action='store_true',
+            help="list the benchmarks and exit")
+
+    args = parser.parse_args()
+    if args.list:
+        for name, function, _extra in benchmarks(args.log_sizes):
+            print(name.ljust(24), function.__doc__)
+        return
+
+    known = [name for name, _function, _extra in benchmarks(args.log_sizes)]
+    unknown = [name for name in args.names if not name in known]
+    if unknown:
+        parser.error("unknown benchmarks: " + ' '.join(unknown))
+
+    results = run_benchmarks(args.names, args.repeat, args.log_sizes)
+
+    rows = []
+    for name, result in results.items():
+        best = min(result['times'])
+        per_item = best / result['items'] if result['items'] else float('nan')
+        rows.append([name, result['items'], '{:.3f}'.format(best * 1e3),
+                     '{:.3f}'.format(statistics.median(result['times']) * 1e3),
+                     '{:.3f}'.format(per_item * 1e6)])
+    print_table(HEADER, rows)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print("\nCompared with", baseline.get('revision') or args.compare)
+        rows = []
+        for name, result in results.items():
+            if not name in baseline['results']:
+                continue
+            best = min(result['times'])
+            old_best = min(baseline['results'][name]['times'])
+            rows.append([name, '{:.3f}'.format(best * 1e3), '{:.3f}'.format(old_best * 1e3),
+                         '{:+.1%}'.format(best / old_best - 1)])
+        print_table(COMPARE_HEADER, rows)
+
+    if args.output:
+        report = {
+            'revision': git_revision(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+if __name__ == '__main__':
+    _main()
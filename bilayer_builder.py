@@ -1,6 +1,5 @@
 """Handles bilayer preparation options"""
 import time
-from selenium.common.exceptions import WebDriverException
 
 import utils
 from solution_builder import SolutionBrowserProcess
@@ -8,6 +7,8 @@ from input_generator import InputBrowserProcess
 
 _BROWSER_PROCESS = 'BilayerBrowserProcess'
 
+_lipid_config = utils.load_config("membrane.lipids.enabled.yml")['default']
+
 class BilayerBrowserProcess(SolutionBrowserProcess, InputBrowserProcess):
     """Implements options for bilayer/protein alignment, lipid selection,
     and bilayer size determination.
@@ -20,7 +21,7 @@ class BilayerBrowserProcess(SolutionBrowserProcess, InputBrowserProcess):
         self.module_url = "?doc=input/membrane.bilayer"
 
         # reorder the config into a map of lipid name -> lipid cateogry
-        self.lipid_config = utils.read_yaml("membrane.lipids.enabled.yml")['default']
+        self.lipid_config = dict(_lipid_config)
 
         # not present in config, but needed for lipid category activation
         self.lipid_config['glp'] = {'name': 'Glycolipids'}
@@ -120,6 +121,8 @@ class BilayerBrowserProcess(SolutionBrowserProcess, InputBrowserProcess):
                 self.browser.fill(field, value)
 
     def _build_glycolipids(self, glycolipids, lipids_root):
+        from selenium.common.exceptions import WebDriverException
+
         if not glycolipids:
             return
 
@@ -167,6 +170,8 @@ class BilayerBrowserProcess(SolutionBrowserProcess, InputBrowserProcess):
             self.switch_to_window(0)
 
     def _build_lps(self, lps_lipids, lipids_root):
+        from selenium.common.exceptions import WebDriverException
+
         if not lps_lipids:
             return
 
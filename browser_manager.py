@@ -1,36 +1,61 @@
 """This module handles most of the inter-process communciation aspects of
 BrowserProcess by passing messages through multiprocessing.Queue
 """
-# importing readline causes input buffering to be handled automatically
-import readline
-
+import os
 import sys
-from multiprocessing import Queue
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import BoundedSemaphore, Queue
+from queue import Empty
 from time import sleep
 from random import uniform
 
-from logger import Logger
+import utils
+from cgui_browser_process import CGUIBrowserProcess
+from logger import Logger, convert_logfile, events_filename
+from scheduler import CONTINUE, CaseGraph, case_key
 
 class BrowserManager:
     """A class to manage instances of BrowserProcess
 
     Usage:
-        bm = BrowserManager(process_type, logfile, num_threads, **browser_kwargs)
+        bm = BrowserManager(process_types, logfile, num_threads, **browser_kwargs)
         bm.start()
-        bm.run()
+        bm.run(graph)
         bm.stop()
 
-    process_type should be an instance of a class that extends BrowserProcess
+    process_types should map each module name to a class that extends
+    CGUIBrowserProcess. All modules share a single pool of browser workers;
+    each test case is run by its module's class, according to the test
+    case's 'module' key.
     """
-    def __init__(self, BrowserProcess, logfile, num_threads=1, **browser_kwargs):
+    # seconds to wait for more events once every test case is done
+    DRAIN_TIMEOUT = .5
+
+    def __init__(self, process_types, logfile, num_threads=1, num_validators=1,
+            server_jobs=None, host_slot_dir=None, host_jobs=4, **browser_kwargs):
         """Initializes BrowserProcess instances
 
+        num_validators is the number of processes that compare finished
+        projects' PSFs to their references.
+
+        server_jobs is the most test cases that may have a job running on
+        the server at once; processes beyond that fill forms, download, and
+        validate while they wait. By default, it is num_threads.
+
+        If host_slot_dir is given, at most host_jobs test cases of all
+        BrowserManagers on this host that use the same directory have a job
+        running on the server at once (see host_slots.HostSemaphore).
+
         args in browser_kwargs are passed directly to BrowserProcess.__init__
         """
         self.todo_queue = todo_queue = Queue()
         self.done_queue = done_queue = Queue()
 
         if browser_kwargs.get('interactive'):
+            # importing readline causes input buffering to be handled automatically
+            import readline
             self.inter_queue = browser_kwargs['inter_q'] = Queue()
             self.msg_queue = browser_kwargs['msg_q'] = Queue()
         else:
@@ -39,42 +64,141 @@ class BrowserManager:
 
         self.dry_run = browser_kwargs.get('dry_run')
 
-        logfile = sys.stdout if self.dry_run else logfile
-        self.logger = Logger(logfile, browser_kwargs['module'])
+        self.server_jobs = server_jobs
+        if server_jobs and server_jobs < num_threads and not self.dry_run:
+            browser_kwargs['server_slots'] = BoundedSemaphore(server_jobs)
+        if host_slot_dir and not self.dry_run:
+            from host_slots import HostSemaphore
+            browser_kwargs['host_slots'] = HostSemaphore(host_slot_dir, host_jobs)
+        self.slot_waits = []
+
+        self.logfile = sys.stdout if self.dry_run else logfile
+        self.events = None
+        if not self.dry_run:
+            convert_logfile(logfile)
+            self.events = events_filename(logfile)
+        self.loggers = {}
+        self.run_id = '{}-{}'.format(int(time.time()), os.getpid())
+
+        self.num_validators = num_validators
+        self.validation_pool = None
+        self.idle = 0
 
-        self.processes = [BrowserProcess(todo_queue, done_queue, **browser_kwargs)
+        browser_kwargs['process_types'] = process_types
+        self.processes = [CGUIBrowserProcess(todo_queue, done_queue, **browser_kwargs)
                 for i in range(num_threads)]
 
-    def run(self, base_cases, wait_cases=None):
+    def get_logger(self, module):
+        """Returns the Logger for messages about `module`'s test cases"""
+        logger = self.loggers.get(module)
+        if logger is None:
+            logger = self.loggers[module] = Logger(self.logfile, module,
+                    events=self.events, run_id=self.run_id)
+        return logger
+
+    def log_event(self, event):
+        """Appends an event to the structured event log"""
+        self.get_logger(event.get('module')).log_event(event)
+
+    def validate(self, test_case, sys_dir, sys_archive, elapsed_time):
+        """Submits a finished test case to the validation pool
+
+        The validation result is put in done_queue when it is ready,
+        preceded by a 'validation' event.
+        """
+        start_time = time.time()
+        def report(future):
+            try:
+                result = future.result()
+            except Exception:
+                exc_str = ''.join(traceback.format_exception(*sys.exc_info()))
+                result = 'EXCEPTION', test_case, -1, exc_str
+            self.done_queue.put(('EVENT', {
+                'time': time.time(),
+                'event': 'validation',
+                'module': test_case.get('module'),
+                'label': test_case['label'],
+                'jobid': str(test_case.get('jobid', '-1')),
+                'result': result[0],
+                'duration': time.time() - start_time,
+            }))
+            self.done_queue.put(result)
+
+        future = self.validation_pool.submit(utils.validate_test_case,
+                test_case, sys_dir,
+                sys_archive=sys_archive,
+                module=test_case.get('module'),
+                elapsed_time=elapsed_time,
+                printer_name='validator')
+        future.add_done_callback(report)
+
+    def dispatch(self, graph):
+        """Puts ready test cases on todo_queue, one per idle process"""
+        for test_case in graph.pop_ready(self.idle):
+            self.todo_queue.put(test_case)
+            self.idle -= 1
+
+    def finish(self, graph, done_case, success):
+        """Records a final result in graph, and logs test cases it cancels"""
+        cancelled = graph.finish(case_key(done_case), done_case, success)
+        for test_case, reason in cancelled:
+            print("Cancelling '{}': {}".format(test_case['label'], reason))
+            self.get_logger(test_case.get('module')).log_result(
+                ('EXCEPTION', test_case, -1, reason))
+
+    def run(self, graph, wait_cases=None):
         """Delegates tasks to BrowserProcess instances and logs results
 
-        Blocks until the number of pending jobs is 0.
+        Blocks until every test case in graph has a final result.
 
         Assumes all processes have been started, and DOES NOT join processes
         before returning. Call stop() to explicitly join.
+
+        graph is a scheduler.CaseGraph, which may contain test cases from any
+        number of modules. Each process sends IDLE when it is ready for a
+        test case, and is given the best ready test case at that time.
+
+        For compatibility, graph may also be a list of test cases, and
+        wait_cases may map (module, label) of one of them to the list of
+        cases to start once that case sends CONTINUE.
         """
-        wait_cases = wait_cases or {}
+        if not isinstance(graph, CaseGraph):
+            base_cases = graph
+            graph = CaseGraph()
+            for case in base_cases:
+                graph.add(case)
+            for done_key, cases in (wait_cases or {}).items():
+                for case in cases:
+                    graph.add(case, requires={done_key: CONTINUE})
+        graph.finalize()
+        predicted = graph.predict_wall_time(min(len(self.processes),
+                self.server_jobs or len(self.processes)))
 
-        # put regular cases in the task queue
-        pending = 0
-        for case in base_cases:
-            self.todo_queue.put(case)
-            pending += 1
+        start_time = time.time()
+        modules = sorted({case.get('module') or '' for case in graph.cases()})
+        self.log_event({'time': start_time, 'event': 'run_start', 'module': None,
+            'num_threads': len(self.processes), 'server_jobs': self.server_jobs,
+            'modules': modules, 'num_cases': len(graph),
+            'predicted_wall_time': predicted})
+        if graph.durations or graph.default_durations:
+            print("Predicted wall time: {:.0f} seconds".format(predicted))
 
-        stopped = False # set to True after STOP sent to all threads
         # main communication loop
-        while pending:
+        self.idle = 0
+        while graph:
             result = self.done_queue.get()
-            pending -= 1
             if result[0] in ('SUCCESS', 'VALID', 'INVALID', 'FAILURE', 'EXCEPTION'):
-                self.logger.log_result(result)
+                self.get_logger(result[1].get('module')).log_result(result)
+                success = result[0] in ('SUCCESS', 'VALID', 'INVALID')
+                self.finish(graph, result[1], success)
+            elif result[0] == 'IDLE':
+                self.idle += 1
             elif result[0] == 'INTERACT':
                 partner, partner_jobid = result[1:]
                 print("Interacting with {} ({})".format(partner, partner_jobid))
                 normal_prompt = partner+'> '
                 continue_prompt = '... '
                 prompt = normal_prompt
-                pending += 1
                 while True:
                     try:
                         cmd = input(prompt)
@@ -95,16 +219,16 @@ class BrowserManager:
                     else:
                         prompt = normal_prompt
                 del partner, partner_jobid
+            elif result[0] == 'EVENT':
+                self.handle_event(result[1])
+            elif result[0] == 'VALIDATE':
+                # the validation result is still pending
+                self.validate(*result[1:])
             elif result[0] == 'CONTINUE':
-                pending += 1
+                # start tasks waiting on this one
                 done_case = result[1]
-                done_label = done_case['label']
-                # are any tasks waiting on this one?
-                if done_label in wait_cases:
-                    for _base_case, wait_case in enumerate(wait_cases[done_label]):
-                        self.todo_queue.put(wait_case)
-                        pending += 1
-                    del wait_cases[done_label]
+                branch = result[2] if len(result) > 2 else None
+                graph.release(case_key(done_case), done_case, branch)
             elif result[0] == 'STOP':
                 for proc in self.processes:
                     proc.terminate()
@@ -118,10 +242,51 @@ class BrowserManager:
             else:
                 print('Warning: got unknown result:', result)
 
-            if not stopped and not wait_cases:
-                for proc in self.processes:
-                    self.todo_queue.put('STOP')
-                stopped = True
+            self.dispatch(graph)
+
+        for proc in self.processes:
+            self.todo_queue.put('STOP')
+        self.drain_events()
+
+        end_time = time.time()
+        self.log_event({'time': end_time, 'event': 'run_end', 'module': None,
+            'wall_time': end_time - start_time})
+        self.report_slot_waits()
+        if (graph.durations or graph.default_durations) and not self.dry_run:
+            print("Wall time: {:.0f} seconds (predicted: {:.0f} seconds)".format(
+                end_time - start_time, predicted))
+
+    def handle_event(self, event):
+        """Logs an event sent by a browser process"""
+        self.log_event(event)
+        if event['event'] == 'server_slot':
+            self.slot_waits.append((event['wait'], event['host_wait']))
+
+    def drain_events(self):
+        """Logs the events still in done_queue once every test case is done
+
+        E.g., a test case that raised an exception reports its download
+        after its result. Other messages are no longer needed.
+        """
+        while True:
+            try:
+                # a short timeout lets messages already sent reach the queue
+                result = self.done_queue.get(timeout=self.DRAIN_TIMEOUT)
+            except Empty:
+                return
+            if result[0] == 'EVENT':
+                self.handle_event(result[1])
+
+    def report_slot_waits(self):
+        """Prints how long test cases waited to start a job on the server"""
+        waits = [wait for wait, _host_wait in self.slot_waits]
+        if not waits or max(waits) < 1:
+            return
+        host_waits = sum(host_wait for _wait, host_wait in self.slot_waits)
+        print("Waited for server slots: {:.0f} seconds in total ({:.0f} for other runs"
+              " on this host), at most {:.0f} seconds, by {} of {} test cases".format(
+              sum(waits), host_waits, max(waits), sum(wait >= 1 for wait in waits),
+              len(waits)))
 
     def start(self):
         """Calls start() method of all processes"""
@@ -129,8 +294,14 @@ class BrowserManager:
         for proc in self.processes:
             proc.start()
 
+        if not self.dry_run:
+            self.validation_pool = ProcessPoolExecutor(self.num_validators)
+
     def stop(self):
         """Calls join() method of all processes"""
         # clean up
         for proc in self.processes:
             proc.join()
+
+        if self.validation_pool:
+            self.validation_pool.shutdown()
@@ -1,26 +1,27 @@
 """Base functionality for all CHARMM-GUI module interaction"""
 # standard library imports
 import code
-import shutil
+import json
 import os.path
 import re
 import time
 import traceback
 import signal
 import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join as pjoin
 from multiprocessing import Process
 
-# third-party dependencies
-import requests
+# third-party dependencies; splinter, selenium, and requests are imported
+# only where a browser is used, so planning and validation don't need them
 import yaml
-from splinter import Browser
-from splinter.element_list import ElementList
-from splinter.exceptions import ElementDoesNotExist
-from selenium.common.exceptions import UnexpectedAlertPresentException, TimeoutException
 
 # auto_cgui imports
+import clone
+import replay
 import utils
+from memory_monitor import MemoryMonitor
 
 class CGUIBrowserProcess(Process):
     """Usage: subclass this class and write an init_system() method.
@@ -34,9 +35,132 @@ class CGUIBrowserProcess(Process):
     PHP_FATAL_ERROR = "Fatal error:"
     PHP_MESSAGES = PHP_NOTICE, PHP_WARNING, PHP_ERROR
 
+    # every message checked after a step loads, most severe first
+    PAGE_MESSAGES = CHARMM_ERROR, PHP_FATAL_ERROR, PHP_ERROR, PHP_WARNING, PHP_NOTICE
+
+    # returns [text, context] for each occurrence in the page's visible text
+    # of a string in the JSON array substituted for %s
+    _FIND_MESSAGES_SCRIPT = """(function (texts) {
+        var content = document.body ? (document.body.innerText || '') : '';
+        var found = [];
+        texts.forEach(function (text) {
+            var index = content.indexOf(text);
+            while (index !== -1) {
+                var start = content.lastIndexOf('\\n', index) + 1;
+                var stop = content.indexOf('\\n', index);
+                if (stop === -1) stop = content.length;
+                found.push([text, content.slice(start, stop).trim().slice(0, 300)]);
+                index = content.indexOf(text, index + text.length);
+            }
+        });
+        return found;
+    })(%s)"""
+
+    # preferences that reduce the memory used by each browser
+    FIREFOX_PREFERENCES = {
+        'browser.cache.disk.enable': False,
+        'browser.cache.memory.capacity': 16384,
+        'browser.sessionhistory.max_entries': 2,
+        'browser.sessionhistory.max_total_viewers': 0,
+        'browser.sessionstore.max_tabs_undo': 0,
+        'browser.tabs.remote.autostart': False,
+        'dom.ipc.processCount': 1,
+        'extensions.pocket.enabled': False,
+        'fission.autostart': False,
+        'image.mem.decode_bytes_at_a_time': 16384,
+        'media.autoplay.default': 5,
+    }
+    CHROME_ARGUMENTS = (
+        '--disable-dev-shm-usage',
+        '--disable-extensions',
+        '--disable-gpu',
+        '--disk-cache-size=1',
+        '--no-first-run',
+        '--renderer-process-limit=1',
+    )
+
+    # archive transfer settings
+    DOWNLOAD_THREADS = 2
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+    DOWNLOAD_RETRIES = 5
+    DOWNLOAD_TIMEOUT = 60
+
+    USER_AGENT = 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)'
+
+    # attributes of a worker process that are shared with its handlers
+    SHARED_ATTRS = 'browser', 'memory_monitor', 'session', 'download_executor'
+
+    # max seconds for a single asynchronous text-waiting script call
+    WAIT_SCRIPT_INTERVAL = 30
+
+    # extra seconds the driver gives a script call before giving up on it,
+    # so that the script's own timer always ends it first
+    WAIT_SCRIPT_MARGIN = 5
+
+    # consecutive navigation errors tolerated while waiting for text
+    WAIT_SCRIPT_RETRIES = 20
+
+    # resolves with the first of arguments[0] found in the page's visible
+    # text (optionally restricted to the CSS selector in arguments[1]), or
+    # with null after arguments[2] milliseconds
+    _WAIT_TEXT_SCRIPT = """
+        var texts = arguments[0], selector = arguments[1], limit = arguments[2];
+        var done = arguments[arguments.length - 1];
+        function findText() {
+            var root = selector ? document.querySelector(selector) : document.body;
+            if (!root) return null;
+            var content = root.innerText || root.textContent || '';
+            for (var i = 0; i < texts.length; i++) {
+                if (content.indexOf(texts[i]) !== -1) return texts[i];
+            }
+            return null;
+        }
+        var found = findText();
+        if (found !== null) {
+            done(found);
+            return;
+        }
+        var observer = null, timer = null, finished = false;
+        function finish(result) {
+            if (finished) return;
+            finished = true;
+            if (observer) observer.disconnect();
+            clearTimeout(timer);
+            done(result);
+        }
+        var scheduled = false;
+        observer = new MutationObserver(function () {
+            if (scheduled || finished) return;
+            scheduled = true;
+            setTimeout(function () {
+                scheduled = false;
+                var found = findText();
+                if (found !== null) finish(found);
+            }, 0);
+        });
+        observer.observe(document, {childList: true, subtree: true,
+                                    characterData: true, attributes: true});
+        timer = setTimeout(function () { finish(null); }, limit);
+    """
+
     def __init__(self, todo_q, done_q, **kwargs):
-        """Setup Queues, browser settings, and delegate rest to multiprocessing.Process"""
+        """Setup Queues, browser settings, and delegate rest to multiprocessing.Process
+
+        If `process_types` is given, it should map module names to the
+        CGUIBrowserProcess subclass that handles that module. This instance
+        then acts as a generic worker: each test case is dispatched to a
+        handler of the class given by its 'module' key, and all handlers
+        share this worker's browser.
+        """
+        self.process_types = kwargs.pop('process_types', None)
+        self.handlers = {}
+
+        # remembered so that handlers can be created with identical settings
+        self.settings = kwargs.copy()
+        self.settings.pop('name', None)
+
         self.browser_type = kwargs.pop('browser_type', 'firefox')
+        self.headless = kwargs.pop('headless', False)
         self.base_url = kwargs.pop('base_url', 'http://charmm-gui.org/')
         self.www_dir = kwargs.pop('www_dir', None)
         self.interactive = kwargs.pop('interactive', False)
@@ -46,6 +170,11 @@ class CGUIBrowserProcess(Process):
         self.msg_q = kwargs.pop('msg_q', None)
         self.module = kwargs.pop('module', None)
         self.credentials = kwargs.pop('credentials', None)
+        self.server_slots = kwargs.pop('server_slots', None)
+        self.snapshots = kwargs.pop('snapshots', None)
+        record_dir = kwargs.pop('record_dir', None)
+        self.replay = kwargs.pop('replay', False)
+        self.host_slots = kwargs.pop('host_slots', None)
 
         if not self.base_url.endswith('/'):
             self.base_url += '/'
@@ -54,6 +183,13 @@ class CGUIBrowserProcess(Process):
 
         self.todo_q = todo_q
         self.done_q = done_q
+        self.test_case = {}
+        self.step = -1
+        self.memory_monitor = None
+        self.session = None
+        self.download_executor = None
+        self.holding_slot = False
+        self.recorder = replay.Recorder(record_dir) if record_dir else None
 
     def _click(self, elem, wait=None, alert=None):
         """Implements common click-and-wait procedure"""
@@ -61,6 +197,97 @@ class CGUIBrowserProcess(Process):
         if wait:
             self.wait_text(wait, alert=alert)
 
+    def acquire_server_slot(self):
+        """Waits until fewer than --server-jobs test cases have a job on the server
+
+        With --host-slots, also waits until fewer than --host-jobs test cases
+        of all runs on this host have one. The time spent waiting is stored
+        in the test case as 'server_wait', of which 'host_wait' was spent
+        waiting for the host.
+        """
+        if self.holding_slot or (self.server_slots is None and self.host_slots is None):
+            return
+        start = time.time()
+        if self.server_slots is not None:
+            self.server_slots.acquire()
+        host_start = time.time()
+        # a slot of this run is taken first so that other runs aren't held up
+        if self.host_slots is not None:
+            self.host_slots.acquire()
+        self.holding_slot = True
+        wait = time.time() - start
+        host_wait = time.time() - host_start
+        self.test_case['server_wait'] = wait
+        if self.host_slots is not None:
+            self.test_case['host_wait'] = host_wait
+        self.emit('server_slot', wait=wait, host_wait=host_wait)
+        if wait >= 1:
+            print(self.name, "waited {:.0f} seconds for a server slot".format(wait))
+
+    def release_server_slot(self):
+        """Lets another test case start a job on the server"""
+        if self.holding_slot:
+            self.holding_slot = False
+            if self.host_slots is not None:
+                self.host_slots.release()
+            if self.server_slots is not None:
+                self.server_slots.release()
+
+    def set_case_cookie(self):
+        """Tells a replay server which test case this is (see replay)
+
+        Only done while recording, or with --replay.
+        """
+        if not self.recorder and not self.replay:
+            return
+        if not self.browser.url.startswith(self.base_url):
+            self.browser.visit(self.base_url)
+        self.browser.cookies.add({replay.CASE_COOKIE: replay.case_id(self.test_case)})
+
+    def restore_snapshot(self):
+        """Starts the test case from the deepest snapshot of its project
+
+        Does nothing unless snapshots are enabled (see snapshot_cache) and
+        the test case is not already resuming a project. A test case that
+        copies its project is never restored past the step that copies it.
+        """
+        test_case = self.test_case
+        if self.snapshots is None or 'jobid' in test_case or \
+                not test_case.get('snapshot_keys'):
+            return
+        max_step = None
+        for step_num, step in enumerate(test_case['steps']):
+            actions = step.get('presteps', []) + step.get('poststeps', [])
+            if any('copy_dir(' in action for action in actions):
+                max_step = step_num
+                break
+
+        start_time = time.time()
+        restored = self.snapshots.restore(test_case['snapshot_keys'], self.www_dir,
+                max_step=max_step)
+        if restored:
+            test_case['jobid'], test_case['resume_link'] = restored
+            print(self.name, "restored a snapshot of", test_case['label'], "at step",
+                    restored[1])
+            self.emit('snapshot_restore', step=restored[1],
+                    duration=time.time() - start_time)
+
+    def save_snapshot(self, step_num):
+        """Saves a snapshot of the project, whose page of step_num just loaded"""
+        keys = self.test_case.get('snapshot_keys')
+        if self.snapshots is None or not keys or not 0 < step_num <= len(keys):
+            return
+        key = keys[step_num-1]
+        if self.snapshots.has(key):
+            return
+
+        start_time = time.time()
+        jobid = str(self.test_case['jobid'])
+        stats = self.snapshots.save(key, pjoin(self.www_dir, jobid), jobid, step_num)
+        if stats:
+            self.emit('snapshot_save', step=step_num, duration=time.time() - start_time,
+                    **stats)
+
     def check(self, check_elem_id, wait=None, alert=None):
         """Checks a checkbox and optionally waits for text to appear
 
@@ -109,34 +336,58 @@ class CGUIBrowserProcess(Process):
         elem = self.browser.find_by_value(value)
         self._click(elem, wait, alert=alert)
 
-    def copy_dir(self, ncopy, send_continue=True):
+    def copy_dir(self, ncopy, send_continue=True, branch=None):
         """Make `ncopy` copies of the current project directory.
 
         Requirements:
             - self.test_case['jobid'] must be set
             - self.www_dir must be set (passed to __init__)
-        All copies will be named as {jobid}_{copy_id}
+        All copies will be named as {jobid}_{copy_id}, or as
+        {jobid}_{branch}_{copy_id} if `branch` is given (see
+        utils.project_copy_name()); the branch is sent with CONTINUE.
 
 
         If the destination already exists, it is *not* overwritten.
+
+        Copies are made in parallel, sharing data with the project where
+        the filesystem allows (see clone.clone_tree()).
         """
         if self.www_dir is None:
             raise ValueError("www_dir is not set")
         jobid = str(self.test_case['jobid'])
         src = pjoin(self.www_dir, jobid)
+        dsts = []
         for i in range(ncopy):
-            i = str(i+1)
-            dst = pjoin(self.www_dir, jobid+'_'+i)
+            dst = pjoin(self.www_dir, utils.project_copy_name(jobid, i+1, branch))
             if os.path.exists(dst):
                 print(self.name, "warning:", dst, "exists; skipping ...")
                 continue
-            shutil.copytree(src, dst)
+            dsts.append(dst)
+
+        start_time = time.time()
+        totals = dict.fromkeys(('files', 'reflinked', 'linked', 'copied'), 0)
+        for stats in clone.clone_trees(src, dsts):
+            for key, value in stats.items():
+                totals[key] += value
+        duration = time.time() - start_time
+        size = totals['reflinked'] + totals['linked'] + totals['copied']
+        mega = 1024. * 1024.
+        print(self.name, "made {} copies of {} in {:.1f} seconds: {:.1f} of {:.1f} MB copied".format(
+            len(dsts), jobid, duration, totals['copied'] / mega, size / mega))
+        self.emit('copy', copies=len(dsts), branch=branch, duration=duration, **totals)
 
         if send_continue:
-            self.done_q.put(('CONTINUE', self.test_case))
+            self.done_q.put(('CONTINUE', self.test_case, branch))
+
+    def download(self, saveas=None, block=True, callback=None):
+        """Downloads the user's system in .tgz format
 
-    def download(self, saveas=None):
-        """Downloads the user's system in .tgz format"""
+        The archive is streamed to disk through this process's shared
+        requests session. If block is False, the transfer runs on the
+        download executor and a concurrent.futures.Future is returned
+        instead of the archive's filename; `callback`, if given, is then
+        called on the executor with the filename once the download ends.
+        """
         test_case = self.test_case
         # don't attempt an impossible download
         if not 'jobid' in test_case:
@@ -160,10 +411,8 @@ class CGUIBrowserProcess(Process):
         url = "{url}?doc=input/download&jobid={jobid}".format(url=self.base_url, jobid=jobid)
         print("downloading %s to %s" % (url, saveas))
 
-        user_agent = 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)'
-        headers = {'User-Agent': user_agent}
+        # the browser can only be used from this thread
         session = {}
-
         for cookie in self.browser.driver.get_cookies():
             if cookie['name'] == 'PHPSESSID':
                 session['PHPSESSID'] = cookie['value']
@@ -176,14 +425,102 @@ class CGUIBrowserProcess(Process):
             idx = urlname.find('@')
             user, password = urlname[:idx].split(':')
 
-        req = requests.get(url, headers=headers, auth=(user, password), cookies=session)
-        with open(saveas, 'wb') as download_file:
-            download_file.write(req.content)
-        fsize = float(os.stat(saveas).st_size) / (1024.0 * 1024.0)
-        print("download complete, file size is %5.2f MB" % fsize)
+        def transfer():
+            start_time = time.time()
+            self.fetch(url, saveas, auth=(user, password), cookies=session)
+            if self.recorder:
+                self.recorder.record_archive(saveas, jobid)
+            self.emit('download', test_case, archive=saveas,
+                    bytes=os.path.getsize(saveas), duration=time.time() - start_time)
+            if callback:
+                return callback(saveas)
+            return saveas
+
+        if block:
+            return transfer()
+        return self.download_executor.submit(transfer)
+
+    def fetch(self, url, saveas, **request_kwargs):
+        """Streams the file at url to saveas in DOWNLOAD_CHUNK_SIZE chunks
+
+        Data is first written to saveas+'.part'. If the connection drops,
+        the transfer resumes where it stopped with an HTTP Range request,
+        up to DOWNLOAD_RETRIES times. When the transfer ends, the file size
+        is compared with the size announced by the server and the archive
+        header is checked before the file is renamed to saveas.
+        """
+        import requests
+
+        partial = saveas + '.part'
+        if os.path.exists(partial):
+            os.unlink(partial)
 
+        expected_size = None
+        attempt = 0
+        while True:
+            received = os.path.getsize(partial) if os.path.exists(partial) else 0
+            headers = {}
+            if received:
+                headers['Range'] = 'bytes={}-'.format(received)
+            try:
+                with self.session.get(url, headers=headers, stream=True,
+                        timeout=self.DOWNLOAD_TIMEOUT, **request_kwargs) as req:
+                    req.raise_for_status()
+                    if req.status_code == 206:
+                        # the total is '*' if the server doesn't know it
+                        total = req.headers.get('Content-Range', '').split('/')[-1]
+                        expected_size = int(total) if total.isdigit() else None
+                        mode = 'ab'
+                    else:
+                        # the server may ignore Range and resend everything
+                        mode = 'wb'
+                        length = req.headers.get('Content-Length')
+                        if length and not req.headers.get('Content-Encoding'):
+                            expected_size = int(length)
+                    with open(partial, mode) as download_file:
+                        for chunk in req.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                            download_file.write(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as exc:
+                attempt += 1
+                if attempt > self.DOWNLOAD_RETRIES:
+                    raise
+                print(self.name, "download interrupted ({}); resuming".format(exc))
+                time.sleep(attempt)
+
+        size = os.path.getsize(partial)
+        if expected_size is not None and size != expected_size:
+            raise IOError("incomplete download of {}: got {} of {} bytes".format(
+                saveas, size, expected_size))
+        if not tarfile.is_tarfile(partial):
+            raise IOError("download of {} is not a valid archive".format(saveas))
+        os.replace(partial, saveas)
+
+        fsize = float(size) / (1024.0 * 1024.0)
+        print("download complete, file size is %5.2f MB" % fsize)
         return saveas
 
+    def emit(self, event, test_case=None, **fields):
+        """Sends a structured event about a test case to the main process
+
+        The main process appends it to the JSON-lines event log. Events may
+        be emitted from any thread, but other threads should pass test_case
+        explicitly; it defaults to the browser's current test case.
+        """
+        if test_case is None:
+            test_case = self.test_case
+        record = {
+            'time': time.time(),
+            'event': event,
+            'worker': self.name,
+            'module': test_case.get('module', self.module),
+            'label': test_case.get('label'),
+            'jobid': str(test_case.get('jobid', '-1')),
+        }
+        record.update(fields)
+        self.done_q.put(('EVENT', record))
+
     def eval(self, expr):
         """Evaluate a Python command that could refer to a method of self
         *OR* to a global function.
@@ -207,6 +544,8 @@ class CGUIBrowserProcess(Process):
 
         Note that splinter may be wrong about element visibility
         """
+        from splinter.element_list import ElementList
+
         if not isinstance(elems, ElementList):
             elems = ElementList([elems])
 
@@ -261,6 +600,9 @@ class CGUIBrowserProcess(Process):
             alert = alert.lower()
         assert alert in (None, 'accept', 'dismiss'), "unrecognized alert response: "+str(alert)
 
+        # a test case's job is on the server from its first submitted page
+        self.acquire_server_slot()
+
         if isinstance(next_button, (tuple, list)):
             finder = getattr('find_by_'+next_button[0])
             selector = next_button[1]
@@ -277,7 +619,11 @@ class CGUIBrowserProcess(Process):
 
         while not button_elem.visible:
             time.sleep(1)
+        if self.recorder:
+            self.recorder.record_page(self.browser)
         button_elem.click()
+        if self.recorder:
+            self.recorder.submitted()
 
         # some modules give warning dialogs that we don't care about
         if alert:
@@ -298,7 +644,31 @@ class CGUIBrowserProcess(Process):
                         print(self.name, "{}ed alert with text: '{}'".format(alert, alert_text))
 
         if test_text:
-            self.wait_text_multi([test_text, self.CHARMM_ERROR, self.PHP_ERROR])
+            return self.wait_text_multi([test_text, self.CHARMM_ERROR,
+                self.PHP_FATAL_ERROR, self.PHP_ERROR])
+        return None
+
+    def get_handler(self, module):
+        """Returns the object that should run test cases for `module`
+
+        Handlers are created once per module and reused for every later
+        test case of that module. If this process was not given any
+        `process_types`, then it handles all test cases itself.
+        """
+        if not self.process_types:
+            return self
+
+        handler = self.handlers.get(module)
+        if handler is None:
+            settings = self.settings.copy()
+            settings['module'] = module
+            BrowserProcess = self.process_types[module]
+            handler = BrowserProcess(self.todo_q, self.done_q, name=self.name, **settings)
+            self.handlers[module] = handler
+
+        for attr in self.SHARED_ATTRS:
+            setattr(handler, attr, getattr(self, attr))
+        return handler
 
     def handle_step(self, step_info):
         """Fills all form values in this step's 'elems' dict.
@@ -488,11 +858,13 @@ class CGUIBrowserProcess(Process):
 
     def run_dry(self):
         """Print pre-processed test cases in YAML format"""
-        for test_case in iter(self.todo_q.get, 'STOP'):
+        for test_case in self.next_cases():
             try:
                 self.test_case = test_case
                 print(yaml.dump([test_case]), end='')
                 test_case['jobid'] = -1
+                # nothing is copied, but test cases waiting for a copy are shown
+                self.done_q.put(('CONTINUE', test_case))
                 self.done_q.put(('SUCCESS', test_case, -1))
             except:
                 # give the full exception string
@@ -502,11 +874,76 @@ class CGUIBrowserProcess(Process):
                     self.interact(locals())
                 self.done_q.put(('EXCEPTION', test_case, -1, exc_str))
 
+    def next_cases(self):
+        """Yields test cases from todo_q until it gives STOP
+
+        Sends IDLE before each one, so that the main process hands out a
+        test case only when a process is ready to run it.
+        """
+        while True:
+            self.done_q.put(('IDLE', self.name))
+            test_case = self.todo_q.get()
+            if test_case == 'STOP':
+                return
+            yield test_case
+
+    def open_browser(self):
+        """Returns a new splinter Browser using low-memory settings"""
+        from selenium.webdriver import ChromeOptions
+        from splinter import Browser
+
+        if self.browser_type == 'firefox':
+            return Browser('firefox', headless=self.headless,
+                    profile_preferences=self.FIREFOX_PREFERENCES)
+        if self.browser_type == 'chrome':
+            options = ChromeOptions()
+            for argument in self.CHROME_ARGUMENTS:
+                options.add_argument(argument)
+            return Browser('chrome', headless=self.headless, options=options)
+        return Browser(self.browser_type, headless=self.headless)
+
+    @staticmethod
+    def record_phase(timing, phase, start):
+        """Adds the time since `start` to timing[phase] and returns the time
+
+        run_case() stores one such dict per step in test_case['timings'],
+        with these phases (seconds):
+            wait         waiting for the step's wait_text
+            prestep      evaluating presteps
+            handle_step  filling in the step's elems
+            poststep     evaluating poststeps
+            go_next      clicking Next (not on the last step)
+            final_wait   waiting for the last step's wait_text (last step only)
+        """
+        now = time.time()
+        timing[phase] = timing.get(phase, 0.) + now - start
+        return now
+
+    def record_memory(self):
+        """Stores peak and mean browser memory usage in the current test case"""
+        stats = self.memory_monitor and self.memory_monitor.stats()
+        if stats:
+            self.test_case['memory'] = stats
+
     def run_full(self):
         """Execute test cases and log results"""
-        with Browser(self.browser_type) as browser:
+        import requests
+
+        with self.open_browser() as browser:
             self.browser = browser
-            self.step = step_num = -1
+
+            # sample memory of the driver and the browser processes it spawned
+            self.memory_monitor = MemoryMonitor(browser.driver.service.process.pid)
+            self.memory_monitor.start()
+
+            # archives are transferred in the background over kept-alive
+            # connections while this process moves on to its next case
+            self.session = requests.Session()
+            self.session.headers['User-Agent'] = self.USER_AGENT
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.DOWNLOAD_THREADS)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.download_executor = ThreadPoolExecutor(self.DOWNLOAD_THREADS)
 
             # ensure we are logged in
             if self.credentials is not None:
@@ -515,104 +952,173 @@ class CGUIBrowserProcess(Process):
                 browser.fill('password', self.credentials['pass'])
                 self.click_by_value('Submit')
 
-            for test_case in iter(self.todo_q.get, 'STOP'):
-                try:
-                    self.test_case = test_case
-                    print(self.name, "starting", test_case['label'])
-                    start_time = time.time()
-                    resume_link = 0
-                    base = os.path.abspath(pjoin('files', test_case['base']))
-                    self.base = base
-
-                    resume = 'jobid' in test_case
-                    if resume:
-                        jobid = test_case['jobid']
-                        resume_link = test_case['resume_link']
-                        self.resume_step(jobid, link_no=resume_link)
-
-                    self.init_system(resume=resume)
-
-                    jobid = test_case['jobid']
-                    print(self.name, "Job ID:", jobid)
-
-                    steps = test_case['steps'][resume_link:]
-                    failure = False
-                    for step_num, step in enumerate(steps):
-                        self.step = step_num
-                        if 'wait_text' in step:
-                            found_text = self.wait_text_multi([step['wait_text'],
-                                self.CHARMM_ERROR, self.PHP_FATAL_ERROR, self.PHP_ERROR])
-                        if found_text != step['wait_text']:
-                            failure = True
-                            break
-
-                        # Check for PHP errors, warnings, and notices
-                        found_text = self.warn_if_text(self.PHP_MESSAGES)
-                        if found_text and self.interactive:
-                            if not self.errors_only or \
-                                    found_text in (self.PHP_ERROR, self.PHP_FATAL_ERROR):
-                                self.interact(locals())
-
-                        for prestep in step.get('presteps', []):
-                            self.eval(prestep)
-                        if 'elems' in step:
-                            self.handle_step(step)
-                        for poststep in step.get('poststeps', []):
-                            self.eval(poststep)
-
-                        if step_num < len(steps)-1:
-                            alert = step.get('alert')
-                            invalid_alert_text = step.get('invalid_alert_text')
-                            self.go_next(alert=alert, invalid_alert_text=invalid_alert_text)
-
-                    elapsed_time = time.time() - start_time
-
-                    if self.interactive and (failure or not self.errors_only):
-                        self.interact(locals())
+            for test_case in self.next_cases():
+                module = test_case.get('module', self.module)
+                self.memory_monitor.reset()
+                self.get_handler(module).run_case(test_case)
 
-                    # early failure?
-                    if failure:
-                        self.done_q.put(('FAILURE', test_case, step_num, elapsed_time))
-                        failure = False
-                        continue
-
-                    # late failure?
-                    final_wait_text = steps[-1]['wait_text']
-                    found_text = self.wait_text_multi([final_wait_text,
-                        self.CHARMM_ERROR, self.PHP_ERROR,
-                        self.PHP_FATAL_ERROR])
-
-                    if found_text != final_wait_text:
-                        self.done_q.put(('FAILURE', test_case, step_num, elapsed_time))
-                        failure = False
-                    else:
-                        # download project and optionally compare PSF
-                        sys_archive = None
-                        if not 'localhost' in self.base_url:
-                            sys_archive = self.download()
-                            sys_dir, _ext = os.path.splitext(sys_archive)
-                        else:
-                            sys_dir = pjoin(self.www_dir, jobid)
-
-                        validation_result = utils.validate_test_case(test_case, sys_dir,
-                                sys_archive=sys_archive,
-                                module=self.module,
-                                elapsed_time=elapsed_time,
-                                printer_name=self.name)
-
-                        self.done_q.put(validation_result)
-
-                except KeyboardInterrupt:
-                    raise # reraise and cleanup browser context
-                except:
-                    # give the full exception string
-                    exc_str = ''.join(traceback.format_exception(*sys.exc_info()))
-                    print(exc_str)
-                    if self.interactive:
+            self.download_executor.shutdown(wait=True)
+            self.session.close()
+            self.memory_monitor.stop()
+
+    def run_case(self, test_case):
+        """Runs a single test case in the current browser and reports the result"""
+        browser = self.browser
+        self.step = step_num = -1
+        try:
+            self.test_case = test_case
+            print(self.name, "starting", test_case['label'])
+            start_time = time.time()
+            self.emit('case_start')
+            if self.recorder:
+                self.recorder.start(test_case)
+            self.set_case_cookie()
+            resume_link = 0
+            base = os.path.abspath(pjoin('files', test_case['base']))
+            self.base = base
+
+            self.restore_snapshot()
+
+            # the job is on the server from its first submitted page (see
+            # go_next()), or from when its project is resumed, until its last
+            # page is done
+            resume = 'jobid' in test_case
+            if resume:
+                jobid = test_case['jobid']
+                resume_link = test_case['resume_link']
+                self.acquire_server_slot()
+                self.resume_step(jobid, link_no=resume_link)
+
+            self.init_system(resume=resume)
+            # in case the front page was submitted without go_next()
+            self.acquire_server_slot()
+
+            jobid = test_case['jobid']
+            print(self.name, "Job ID:", jobid)
+            self.emit('jobid', resume_link=resume_link)
+
+            steps = test_case['steps'][resume_link:]
+            failure = False
+            test_case['timings'] = timings = []
+            for step_num, step in enumerate(steps):
+                self.step = step_num
+                step_start = lap = time.time()
+                timing = {'step': step_num}
+                timings.append(timing)
+                self.emit('step_start', step=step_num)
+                if 'wait_text' in step:
+                    found_text = self.wait_text_multi([step['wait_text'],
+                        self.CHARMM_ERROR, self.PHP_FATAL_ERROR, self.PHP_ERROR])
+                    lap = self.record_phase(timing, 'wait', lap)
+                if found_text != step['wait_text']:
+                    failure = True
+                    break
+                if self.recorder:
+                    self.recorder.loaded()
+                self.save_snapshot(resume_link + step_num)
+
+                # Check for CHARMM errors, and PHP errors, warnings, and notices
+                found_text = self.warn_if_text(self.PAGE_MESSAGES)
+                if found_text and self.interactive:
+                    if not self.errors_only or \
+                            found_text in (self.CHARMM_ERROR, self.PHP_ERROR, self.PHP_FATAL_ERROR):
                         self.interact(locals())
-                    self.done_q.put(('EXCEPTION', test_case, step_num, exc_str))
-                    if not 'localhost' in self.base_url:
-                        self.download()
+
+                lap = time.time()
+                for prestep in step.get('presteps', []):
+                    self.eval(prestep)
+                lap = self.record_phase(timing, 'prestep', lap)
+                if 'elems' in step:
+                    self.handle_step(step)
+                lap = self.record_phase(timing, 'handle_step', lap)
+                for poststep in step.get('poststeps', []):
+                    self.eval(poststep)
+                lap = self.record_phase(timing, 'poststep', lap)
+
+                if step_num < len(steps)-1:
+                    alert = step.get('alert')
+                    invalid_alert_text = step.get('invalid_alert_text')
+                    self.go_next(alert=alert, invalid_alert_text=invalid_alert_text)
+                    lap = self.record_phase(timing, 'go_next', lap)
+                self.emit('step_end', step=step_num, duration=time.time() - step_start,
+                        phases=timing)
+
+            elapsed_time = time.time() - start_time
+            if failure:
+                self.release_server_slot()
+
+            if self.interactive and (failure or not self.errors_only):
+                self.interact(locals())
+
+            # early failure?
+            if failure:
+                self.record_memory()
+                self.done_q.put(('FAILURE', test_case, step_num, elapsed_time))
+                return
+
+            # late failure?
+            final_wait_text = steps[-1]['wait_text']
+            lap = time.time()
+            found_text = self.wait_text_multi([final_wait_text,
+                self.CHARMM_ERROR, self.PHP_ERROR,
+                self.PHP_FATAL_ERROR])
+            self.record_phase(timings[-1], 'final_wait', lap)
+            if self.recorder and found_text == final_wait_text:
+                self.recorder.record_page(browser)
+            self.release_server_slot()
+            self.record_memory()
+
+            if found_text != final_wait_text:
+                self.done_q.put(('FAILURE', test_case, step_num, elapsed_time))
+            elif not 'localhost' in self.base_url:
+                # download project in the background, then compare PSF
+                def validate(sys_archive):
+                    sys_dir, _ext = os.path.splitext(sys_archive)
+                    self.validate(test_case, sys_dir, sys_archive, elapsed_time)
+
+                future = self.download(block=False, callback=validate)
+                future.add_done_callback(lambda future: self.report_download_error(
+                    future, test_case, step_num))
+            else:
+                self.validate(test_case, pjoin(self.www_dir, jobid), None, elapsed_time)
+
+        except KeyboardInterrupt:
+            raise # reraise and cleanup browser context
+        except:
+            # give the full exception string
+            exc_str = ''.join(traceback.format_exception(*sys.exc_info()))
+            print(exc_str)
+            self.release_server_slot()
+            if self.interactive:
+                self.interact(locals())
+            self.record_memory()
+            self.done_q.put(('EXCEPTION', test_case, step_num, exc_str))
+            if not 'localhost' in self.base_url:
+                future = self.download(block=False)
+                if future:
+                    future.add_done_callback(lambda future: self.report_download_error(future))
+
+    def report_download_error(self, future, test_case=None, step_num=-1):
+        """Prints an exception raised by a background download
+
+        If test_case is given, the exception also becomes its result.
+        """
+        exc = future.exception()
+        if exc is None:
+            return
+        exc_str = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        print(self.name, "background download or validation failed:")
+        print(exc_str)
+        if test_case is not None:
+            self.done_q.put(('EXCEPTION', test_case, step_num, exc_str))
+
+    def validate(self, test_case, sys_dir, sys_archive, elapsed_time):
+        """Asks the main process to validate a finished test case's PSF
+
+        Validation runs in BrowserManager's validation pool, so this
+        process's browser is free for the next test case.
+        """
+        self.done_q.put(('VALIDATE', test_case, sys_dir, sys_archive, elapsed_time))
 
     def stop(self, reason=None):
         """Message main thread to safely terminate all threads"""
@@ -624,6 +1130,8 @@ class CGUIBrowserProcess(Process):
 
     def switch_to_window(self, index, wait=60, poll_frequency=.5):
         """Waits up to `wait` seconds for a new window, then switches to it"""
+        from selenium.common.exceptions import TimeoutException
+
         # warn if we are waiting for more than one window
         windows = self.browser.windows
         if index > len(windows):
@@ -658,6 +1166,8 @@ class CGUIBrowserProcess(Process):
 
         By default, prints a warning every time len(element_list) < min_length
         """
+        from selenium.common.exceptions import UnexpectedAlertPresentException
+
         # get a reference to the actual function, and save its arguments
         find_by_str = element_list.find_by
         finder = getattr(element_list, 'find_by_'+find_by_str)
@@ -685,34 +1195,88 @@ class CGUIBrowserProcess(Process):
         while not self.browser.evaluate_script(script):
             time.sleep(1)
 
-    def wait_text(self, text, wait_time=1, alert=None):
-        """Blocks until text appears on a page"""
+    def wait_text(self, text, wait_time=None, alert=None, css=None):
+        """Blocks until text appears on a page
+
+        If wait_time is given, raises TimeoutException after that many
+        seconds. See wait_text_multi() for the meaning of `css`.
+        """
         print(self.name, "waiting for text:", text)
-        while True:
-            try:
-                if self.browser.is_text_present(text, wait_time=wait_time):
-                    break
-            except UnexpectedAlertPresentException as exc:
-                if not alert:
-                    raise
+        self._wait_text_any([text], wait_time, alert, css)
 
-    def wait_text_multi(self, texts, alert=None):
+    def wait_text_multi(self, texts, alert=None, timeout=None, css=None):
         """Blocks until one of the texts in `texts` appears on a page
 
-        Use this is more than one result is expected.
+        Use this is more than one result is expected. If more than one text
+        is present, the earliest one in `texts` is returned.
+
+        Parameters
+        ==========
+            texts    list   strings to look for in the page's visible text
+            alert    str    if given, ignore alerts while waiting
+            timeout  float  seconds to wait before raising TimeoutException;
+                            waits forever by default
+            css      str    CSS selector of the only region to search
         """
         print(self.name, "waiting for any text in:", texts)
-        wait_time = 1
+        return self._wait_text_any(texts, timeout, alert, css)
+
+    def _wait_text_any(self, texts, timeout=None, alert=None, css=None):
+        """Implements wait_text() and wait_text_multi()
+
+        A MutationObserver in the page resolves a single asynchronous script
+        call as soon as any text appears, so no time is lost between polls.
+        Each script call is limited to WAIT_SCRIPT_INTERVAL seconds by its own
+        timer, which also disconnects the observer, and is repeated while the
+        deadline has not passed; this also handles pages that are replaced
+        (e.g., by clicking Next) while a call is running. Other driver errors,
+        like a closed browser, are raised.
+        """
+        from selenium.common.exceptions import UnexpectedAlertPresentException, \
+                TimeoutException, JavascriptException, StaleElementReferenceException
+
+        driver = self.browser.driver
+        start_time = time.time()
+        deadline = None if timeout is None else start_time + timeout
+        retries = 0
         while True:
-            for text in texts:
+            interval = self.WAIT_SCRIPT_INTERVAL
+            if deadline is not None:
+                interval = min(interval, deadline - time.time())
+                if interval <= 0:
+                    self.emit('wait', step=self.step, texts=list(texts), found=None,
+                            duration=time.time() - start_time)
+                    raise TimeoutException("Timed out waiting for any of: "+repr(texts))
+
+            previous_timeout = driver.timeouts.script
+            try:
+                driver.set_script_timeout(interval + self.WAIT_SCRIPT_MARGIN)
+                found_text = driver.execute_async_script(self._WAIT_TEXT_SCRIPT,
+                        list(texts), css, int(interval * 1000))
+                retries = 0
+                if found_text is not None:
+                    self.emit('wait', step=self.step, texts=list(texts), found=found_text,
+                            duration=time.time() - start_time)
+                    return found_text
+            except UnexpectedAlertPresentException:
+                if not alert:
+                    raise
+                time.sleep(1)
+            except TimeoutException:
+                # the page is too busy to run the script's timer; try again
+                pass
+            except (JavascriptException, StaleElementReferenceException) as exc:
+                # the page was unloaded while the observer was running
+                retries += 1
+                if retries > self.WAIT_SCRIPT_RETRIES:
+                    raise
+                print(self.name, "warning: restarting text wait after:", exc.msg)
+                time.sleep(.1)
+            finally:
                 try:
-                    if self.browser.is_text_present(text, wait_time):
-                        return text
-                except UnexpectedAlertPresentException as exc:
-                    if not alert:
-                        raise
-                except ElementDoesNotExist as exc:
-                    print(f"Warning: received {exc}")
+                    driver.set_script_timeout(previous_timeout)
+                except UnexpectedAlertPresentException:
+                    pass
 
     @staticmethod
     def wait_visible(element, wait=None, click=False, alert=None):
@@ -724,6 +1288,9 @@ class CGUIBrowserProcess(Process):
 
         Returns the element on success.
         """
+        from selenium.common.exceptions import UnexpectedAlertPresentException, \
+                TimeoutException
+
         start_time = time.time()
         while wait is None or time.time() - start_time < wait:
             try:
@@ -736,18 +1303,33 @@ class CGUIBrowserProcess(Process):
                     raise
         raise TimeoutException
 
+    def find_messages(self, texts):
+        """Scans the page's visible text once for every string in `texts`
+
+        Returns
+        =======
+            List of (text, context) for each occurrence of any string in
+            `texts`, where context is the line of text containing it.
+        """
+        found = self.browser.evaluate_script(self._FIND_MESSAGES_SCRIPT % json.dumps(list(texts)))
+        return [tuple(message) for message in found or []]
+
     def warn_if_text(self, text_or_texts):
         """Warns if one or more strings appear on the page
 
+        All strings are found with a single script call, which returns
+        immediately whether or not any string is present.
+
         Parameters
         ==========
             text_or_texts   str or seq  one or more messages to find
 
         Returns
         =======
-            First observed string (if any), else None
+            First observed string (if any), else None. If several strings
+            are observed, the one listed first in text_or_texts is returned.
         """
-        msg = "Warning: {} ({}) found '{{}}' on step {}"
+        msg = "Warning: {} ({}) found '{{}}' on step {}: {{}}"
         if not 'jobid' in self.test_case:
             jobid = '-1'
         else:
@@ -755,13 +1337,18 @@ class CGUIBrowserProcess(Process):
         msg = msg.format(self.name, jobid, self.step)
         if isinstance(text_or_texts, (list, tuple)):
             texts = text_or_texts
-            for text in texts:
-                if self.browser.is_text_present(text):
-                    print(msg.format(text))
-                    return text
-        elif self.browser.is_text_present(text_or_texts):
-            print(msg.format(text))
-            return text
+        else:
+            texts = [text_or_texts]
+
+        found_texts = set()
+        for text, context in self.find_messages(texts):
+            print(msg.format(text, context))
+            self.emit('message', step=self.step, text=text, context=context)
+            found_texts.add(text)
+
+        for text in texts:
+            if text in found_texts:
+                return text
         return None
 
     def uncheck(self, check_elem_id, wait=None, alert=None):
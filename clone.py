@@ -0,0 +1,103 @@
+"""Clones project directories as cheaply as their filesystem allows
+
+For each file, clone_tree() uses the first of these that works:
+    1. a reflink, which shares the file's data copy-on-write (Btrfs, XFS
+       with reflink=1, and other filesystems that support FICLONE)
+    2. a hard link, for files that are never changed in place (see
+       IMMUTABLE_PATTERNS)
+    3. a full copy
+"""
+import errno
+import fcntl
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+# ioctl request of Linux's FICLONE: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# files that CHARMM-GUI writes once and never rewrites, relative to a project;
+# archives are left out, since the project archive is rebuilt as steps go on
+IMMUTABLE_PATTERNS = 'toppar/*',
+
+# errors that mean a filesystem can't make reflinks
+_NO_REFLINK = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS}
+
+# st_dev of a filesystem: whether it makes reflinks
+_reflink_devices = {}
+
+def reflink(src, dst):
+    """Makes dst a copy-on-write clone of src
+
+    Raises OSError if the filesystem doesn't support it.
+    """
+    with open(src, 'rb') as src_obj, open(dst, 'wb') as dst_obj:
+        fcntl.ioctl(dst_obj.fileno(), FICLONE, src_obj.fileno())
+
+def clone_file(src, dst, rel_path, stats, immutable=IMMUTABLE_PATTERNS):
+    """Clones src to dst, and adds its size to stats under the method used"""
+    stat = os.stat(src)
+    stats['files'] += 1
+
+    if _reflink_devices.get(stat.st_dev, True):
+        try:
+            reflink(src, dst)
+            shutil.copystat(src, dst)
+            stats['reflinked'] += stat.st_size
+            return
+        except OSError as exc:
+            if os.path.exists(dst):
+                os.unlink(dst)
+            if not exc.errno in _NO_REFLINK:
+                raise
+            _reflink_devices[stat.st_dev] = False
+
+    if any(fnmatch(rel_path, pattern) for pattern in immutable):
+        try:
+            os.link(src, dst)
+            stats['linked'] += stat.st_size
+            return
+        except OSError:
+            pass # e.g., too many links; copy instead
+
+    shutil.copy2(src, dst)
+    stats['copied'] += stat.st_size
+
+def clone_tree(src, dst, immutable=IMMUTABLE_PATTERNS):
+    """Like shutil.copytree(src, dst), but shares data with src where possible
+
+    Returns
+    =======
+        dict with the number of 'files' and the bytes that were
+        'reflinked', hard 'linked', and 'copied'
+    """
+    stats = dict.fromkeys(('files', 'reflinked', 'linked', 'copied'), 0)
+    dirs = []
+    for dirpath, _dirnames, filenames in os.walk(src, followlinks=True):
+        rel_dir = os.path.relpath(dirpath, src)
+        dst_dir = os.path.normpath(os.path.join(dst, rel_dir))
+        os.mkdir(dst_dir)
+        dirs.append((dirpath, dst_dir))
+
+        for filename in filenames:
+            src_file = os.path.join(dirpath, filename)
+            dst_file = os.path.join(dst_dir, filename)
+            if os.path.islink(src_file) and not os.path.exists(src_file):
+                # a dangling link has nothing to copy
+                os.symlink(os.readlink(src_file), dst_file)
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_dir, filename))
+            clone_file(src_file, dst_file, rel_path, stats, immutable)
+
+    # adding files changes directories' mtimes
+    for src_dir, dst_dir in dirs:
+        shutil.copystat(src_dir, dst_dir)
+    return stats
+
+def clone_trees(src, dsts, max_workers=4, immutable=IMMUTABLE_PATTERNS):
+    """Clones src to each of dsts in parallel, and returns their stats"""
+    if not dsts:
+        return []
+    with ThreadPoolExecutor(min(len(dsts), max_workers)) as executor:
+        return list(executor.map(lambda dst: clone_tree(src, dst, immutable), dsts))
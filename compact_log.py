@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""Command-line interface to shrink a results log to the latest result of
+each test case"""
+import argparse
+import os
+import sys
+
+import logger
+from utils import warn
+
+parser = argparse.ArgumentParser(
+        description="Rewrite a results log and its event log, keeping only "+\
+                    "the latest result and the attempt count of each test case")
+parser.add_argument('-l', '--logfile', default='results.log',
+        help="results log to compact (default: results.log)")
+
+args = parser.parse_args()
+
+LOGFILE = args.logfile
+if not os.path.exists(LOGFILE) and \
+        not os.path.exists(logger.events_filename(LOGFILE)):
+    warn(f"Error: No such file: '{LOGFILE}'")
+    sys.exit(1)
+
+num_before, num_after = logger.compact_events(LOGFILE)
+print(f"Compacted {num_before} events to {num_after} results")
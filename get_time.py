@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
-"""When run as a program, gets the total Python runtime of all simulations
-in logfile"""
+"""When run as a program, summarizes the running time of test cases in a
+results log: percentiles per module or label, success vs. failure time,
+and the parallel efficiency of each run"""
+import argparse
+import csv
+import hashlib
+import json
+import pickle
+import re
 import sys
 import os
+import time
+
+import numpy as np
+
+from logger import CHECKPOINT_FINGERPRINT_SIZE, events_filename, file_fingerprint
+from utils import CACHE_DIR
 
 class ClockTime:
     """A helper class for dealing with clock time math and str/int
@@ -58,8 +71,8 @@ class ClockTime:
         times.reverse()
         conversions = conversions[:len(times)]
         time_total = 0
-        for time, conv in zip(times, conversions):
-            time_total += time * conv
+        for amount, conv in zip(times, conversions):
+            time_total += amount * conv
         return time_total
 
     @staticmethod
@@ -131,32 +144,316 @@ class ClockTime:
     def __eq__(self, value):
         return self.value == ClockTime(value).value
 
+# outcome of each result type; exceptions have no meaningful running time
+OUTCOMES = {'success': 'success', 'invalid': 'failure', 'failed': 'failure'}
+
+_LOG_REGEXES = { # field: regex for the text results log
+    'label': re.compile(r'Job "([^"]+)"'),
+    'module': re.compile(r"in module '([^']+)'"),
+    'elapsed_time': re.compile(r'after (-?\d+\.\d+) seconds'),
+}
+
+class History:
+    """Results and runs of a results log, as NumPy arrays
+
+    Results read from an event log are cached in CACHE_DIR with the byte
+    offset they were read up to, so only events appended since the last
+    call are decoded.
+
+    Attributes
+    ==========
+        modules, labels, outcomes, runs     arrays of str, one per result
+        elapsed                             array of float (seconds)
+        run_info    {run ID: {'start', 'end', 'num_threads'}} from run events
+    """
+    COLUMNS = 'modules', 'labels', 'outcomes', 'runs', 'elapsed'
+
+    def __init__(self, logfile):
+        records = []
+        self.run_info = {}
+        for name in self.COLUMNS:
+            setattr(self, name, np.array([], dtype=float if name == 'elapsed' else str))
+
+        events = events_filename(logfile)
+        if os.path.exists(events):
+            self._read_events(events, records)
+        else:
+            self._read_logfile(logfile, records)
+        self._append(records)
+
+        if os.path.exists(events):
+            self._save_cache(events)
+
+    def _append(self, records):
+        if not records:
+            return
+        for name, column in zip(self.COLUMNS, zip(*records)):
+            column = np.array(column, dtype=float if name == 'elapsed' else str)
+            setattr(self, name, np.concatenate((getattr(self, name), column)))
+
+    @staticmethod
+    def _cache_name(events):
+        digest = hashlib.sha1(os.path.abspath(events).encode()).hexdigest()
+        return os.path.join(CACHE_DIR, 'history-{}.pickle'.format(digest[:16]))
+
+    def _load_cache(self, events, events_file):
+        """Restores cached results, and returns the offset they were read to"""
+        try:
+            with open(self._cache_name(events), 'rb') as cache:
+                state = pickle.load(cache)
+            size = os.fstat(events_file.fileno()).st_size
+            if state['offset'] > size or state['fingerprint'] != \
+                    file_fingerprint(events_file, state['fingerprint_size']):
+                return 0
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+            return 0
+
+        for name in self.COLUMNS:
+            setattr(self, name, state[name])
+        self.run_info = state['run_info']
+        return state['offset']
+
+    def _save_cache(self, events):
+        with open(events, 'rb') as events_file:
+            state = {name: getattr(self, name) for name in self.COLUMNS}
+            state['run_info'] = self.run_info
+            state['offset'] = self.offset
+            state['fingerprint_size'] = min(self.offset, CHECKPOINT_FINGERPRINT_SIZE)
+            state['fingerprint'] = file_fingerprint(events_file, state['fingerprint_size'])
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(self._cache_name(events), os.getpid())
+            with open(tmp_file, 'wb') as cache:
+                pickle.dump(state, cache)
+            os.replace(tmp_file, self._cache_name(events))
+        except OSError as exc:
+            print("Warning: can't cache run history:", exc, file=sys.stderr)
+
+    def _read_events(self, events, records):
+        with open(events, 'rb') as events_file:
+            offset = self._load_cache(events, events_file)
+            events_file.seek(offset)
+            data = events_file.read()
+            # a partial last line is read again next time
+            end = data.rfind(b'\n') + 1
+            self.offset = offset + end
+            for line in data[:end].decode(errors='replace').splitlines():
+                if not '"event": "r' in line:
+                    continue # skip events that aren't about results or runs
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                event_type = event.get('event')
+                run = event.get('run', '')
+                if event_type == 'result':
+                    outcome = OUTCOMES.get(event['result'])
+                    elapsed = event.get('elapsed_time', -1.)
+                    if outcome and elapsed >= 0:
+                        records.append((event['module'] or '', event['label'],
+                                        outcome, run, elapsed))
+                elif event_type == 'run_start':
+                    info = self.run_info.setdefault(run, {})
+                    info['start'] = info['end'] = event['time']
+                    info['num_threads'] = event['num_threads']
+                elif event_type == 'run_end':
+                    self.run_info.setdefault(run, {})['end'] = event['time']
+                if event_type != 'run_start' and run in self.run_info and 'time' in event:
+                    # a run that crashed lasted at least until its last result
+                    info = self.run_info[run]
+                    info['end'] = max(info.get('end', event['time']), event['time'])
+
+    @staticmethod
+    def _read_logfile(logfile, records):
+        with open(logfile) as file_obj:
+            for line in file_obj:
+                fields = {}
+                for key, regex in _LOG_REGEXES.items():
+                    match = regex.search(line)
+                    fields[key] = match.group(1) if match else None
+                if fields['label'] is None or fields['elapsed_time'] is None:
+                    continue
+                outcome = 'success' if 'success' in line else 'failure'
+                records.append((fields['module'] or '', fields['label'], outcome, '',
+                                float(fields['elapsed_time'])))
+
+    def select(self, mask):
+        """Drops every result where mask is False"""
+        for name in ('modules', 'labels', 'outcomes', 'runs', 'elapsed'):
+            setattr(self, name, getattr(self, name)[mask])
+
+def group_stats(keys, values):
+    """Returns statistics of values grouped by rows of keys
+
+    Parameters
+    ==========
+        keys    list of 1-D arrays, all as long as values
+        values  1-D float array
+
+    Returns
+    =======
+        (group keys, dict of stat name: array), with one element per group
+        in sorted order. Stats are count, total, p50, p90, and max.
+    """
+    if not len(values):
+        return [np.array([], dtype=str) for _key in keys], {}
+
+    # one integer code per distinct combination of keys
+    codes = np.zeros(len(values), dtype=np.int64)
+    uniques = []
+    for key in keys:
+        unique, inverse = np.unique(key, return_inverse=True)
+        uniques.append(unique)
+        codes = codes * len(unique) + inverse
+    groups, codes = np.unique(codes, return_inverse=True)
+
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    counts = np.bincount(codes)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    def percentile(fraction):
+        # linear interpolation, like np.percentile, for every group at once
+        pos = starts + fraction * (counts - 1)
+        low = np.floor(pos).astype(np.int64)
+        high = np.ceil(pos).astype(np.int64)
+        weight = pos - low
+        return sorted_values[low] * (1 - weight) + sorted_values[high] * weight
+
+    stats = {
+        'count': counts,
+        'total': np.bincount(codes, weights=values),
+        'p50': percentile(.5),
+        'p90': percentile(.9),
+        'max': sorted_values[starts + counts - 1],
+    }
+
+    group_keys = []
+    for unique in reversed(uniques):
+        group_keys.append(unique[groups % len(unique)])
+        groups = groups // len(unique)
+    group_keys.reverse()
+    return group_keys, stats
+
+def group_table(history, by):
+    """Returns header and rows of per-group, per-outcome statistics"""
+    keys = [history.modules]
+    header = ['module']
+    if by == 'label':
+        keys.append(history.labels)
+        header.append('label')
+    keys.append(history.outcomes)
+    header.extend(['outcome', 'count', 'total', 'p50', 'p90', 'max'])
+
+    group_keys, stats = group_stats(keys, history.elapsed)
+    columns = group_keys + [stats.get(name, []) for name in header[len(keys):]]
+    return header, list(zip(*columns))
+
+def run_table(history):
+    """Returns header and rows of per-run statistics, oldest run first
+
+    Efficiency is the total running time of a run's test cases divided by
+    the run's wall time and number of browser processes.
+    """
+    header = ['run', 'start', 'threads', 'count', 'success', 'total', 'p50',
+              'p90', 'wall', 'efficiency']
+    (runs,), stats = group_stats([history.runs], history.elapsed)
+    successes = np.bincount(np.searchsorted(runs, history.runs),
+                            weights=history.outcomes == 'success',
+                            minlength=len(runs))
+
+    rows = []
+    for i, run in enumerate(runs):
+        info = history.run_info.get(run, {})
+        start = info.get('start')
+        wall = info['end'] - start if start is not None else float('nan')
+        threads = info.get('num_threads', 0)
+        efficiency = stats['total'][i] / wall / threads if wall > 0 and threads else float('nan')
+        start = time.strftime('%Y-%m-%d %H:%M', time.localtime(start)) if start else ''
+        rows.append((run, start, threads, stats['count'][i], int(successes[i]),
+                     stats['total'][i], stats['p50'][i], stats['p90'][i], wall,
+                     efficiency))
+
+    rows.sort(key=lambda row: row[1])
+    return header, rows
+
+def estimate_durations(history):
+    """Returns typical running times of test cases from their past results
+
+    Only successful results count, since failures usually stop early.
+
+    Returns
+    =======
+        ({(module, label): median seconds}, {module: median seconds})
+    """
+    success = history.outcomes == 'success'
+    modules, labels = history.modules[success], history.labels[success]
+    elapsed = history.elapsed[success]
+
+    (case_modules, case_labels), stats = group_stats([modules, labels], elapsed)
+    durations = {(module or None, label): float(p50) for module, label, p50
+                 in zip(case_modules, case_labels, stats.get('p50', []))}
+
+    (modules,), stats = group_stats([modules], elapsed)
+    defaults = {module or None: float(p50) for module, p50
+                in zip(modules, stats.get('p50', []))}
+    return durations, defaults
+
+def format_cell(value):
+    """Returns a table cell for value"""
+    if isinstance(value, (float, np.floating)):
+        return '{:.2f}'.format(value)
+    return str(value)
+
+def print_table(header, rows, out=sys.stdout):
+    """Prints rows as aligned text columns"""
+    cells = [header] + [list(map(format_cell, row)) for row in rows]
+    widths = [max(map(len, column)) for column in zip(*cells)]
+    for row in cells:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip(),
+              file=out)
+
 def _main():
-    def usage():
-        print("Usage:", sys.argv[0], "[logfile]", file=sys.stderr)
+    parser = argparse.ArgumentParser(
+            description="Summarize the running time of test cases in a results log")
+    parser.add_argument('logfile', nargs='?', default='results.log',
+            help="results log to read (default: results.log)")
+    parser.add_argument('-m', '--modules', nargs='+',
+            help="only include these modules")
+    parser.add_argument('-b', '--by', choices=('module', 'label'), default='module',
+            help="group times by module, or by module and label (default: module)")
+    parser.add_argument('-r', '--runs', action='store_true',
+            help="report each run's times and parallel efficiency instead")
+    parser.add_argument('--csv', action='store_true',
+            help="write CSV instead of a text table")
 
-    if len(sys.argv) == 1:
-        infile = 'results.log'
-    else:
-        infile = sys.argv[1]
+    args = parser.parse_args()
+    infile = args.logfile
 
-    if not os.path.exists(infile):
+    if not os.path.exists(infile) and not os.path.exists(events_filename(infile)):
         print("Error: No such file or directory:", infile, file=sys.stderr)
-        usage()
         sys.exit(1)
     elif os.path.isdir(infile):
         print("Error:", infile, "is a directory", file=sys.stderr)
-        usage()
         sys.exit(2)
 
-    expr = re.compile(r'(\d+\.\d+)')
-    with open(infile) as file_obj:
-        times = [expr.search(line).group(1) for line in file_obj]
+    history = History(infile)
+    if args.modules:
+        history.select(np.isin(history.modules, args.modules))
 
-    tot_time = sum(map(float, times))
+    if args.runs:
+        header, rows = run_table(history)
+    else:
+        header, rows = group_table(history, args.by)
 
-    print("Total running time: {:.2f} seconds {!s}".format(tot_time, ClockTime(int(tot_time))))
+    if args.csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(map(lambda row: list(map(format_cell, row)), rows))
+    else:
+        print_table(header, rows)
+        tot_time = history.elapsed.sum()
+        print("Total running time: {:.2f} seconds {!s}".format(tot_time, ClockTime(int(tot_time))))
 
 if __name__ == '__main__':
-    import re
     _main()
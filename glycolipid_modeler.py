@@ -1,11 +1,11 @@
 """Handles Glycolipid Modeler options"""
-from utils import read_yaml
+from utils import load_config
 from cgui_browser_process import CGUIBrowserProcess
 
 _BROWSER_PROCESS = 'GlycolipidBrowserProcess'
 
-_categories = read_yaml('glycolipid.enabled.yml')
-_infos = read_yaml('glycolipid.sequence.yml')
+_categories = load_config('glycolipid.enabled.yml')
+_infos = load_config('glycolipid.sequence.yml')
 
 def _get_all_glycolipids(category):
     glycolipids = []
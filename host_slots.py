@@ -0,0 +1,63 @@
+"""Limits the number of server jobs of every run_tests.py on a host"""
+import fcntl
+import os
+import time
+
+class HostSemaphore:
+    """A counting semaphore shared by all processes that use the same directory
+
+    Each of the `slots` slots is a lock file in `directory`, and holding a
+    slot means holding an exclusive flock() on its file. The OS releases the
+    locks of a process that dies, so a crashed or killed run never keeps a
+    slot. The directory must be writable by everyone who shares it.
+
+    Usage:
+        slots = HostSemaphore('/var/tmp/cgui-slots', 4)
+        slots.acquire()
+        ...
+        slots.release()
+
+    Waiting processes poll for a free slot every `poll_interval` seconds,
+    so slots are not handed out in the order they were requested. Like
+    multiprocessing's semaphores, an instance may be given to new processes;
+    each process releases only what it acquired.
+    """
+    def __init__(self, directory, slots, poll_interval=1.):
+        self.directory = directory
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.held = None
+        os.makedirs(directory, exist_ok=True)
+
+    def slot_filename(self, slot):
+        """Returns the name of the lock file of a slot"""
+        return os.path.join(self.directory, 'slot-{}.lock'.format(slot))
+
+    def _try_slot(self, slot):
+        """Returns a locked file descriptor for a slot, or None if it is taken"""
+        fd = os.open(self.slot_filename(slot), os.O_RDONLY | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def acquire(self):
+        """Blocks until a slot is free, takes it, and returns its number"""
+        if self.held is not None:
+            raise RuntimeError("this process already holds a slot")
+        while True:
+            for slot in range(self.slots):
+                fd = self._try_slot(slot)
+                if fd is not None:
+                    self.held = fd
+                    return slot
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        """Frees the slot held by this process, if any"""
+        if self.held is not None:
+            fd, self.held = self.held, None
+            # closing the only descriptor of the file releases its lock
+            os.close(fd)
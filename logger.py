@@ -1,16 +1,66 @@
 """Central interface for message logging"""
+import copy
+import hashlib
+import json
 import os
 import re
+import time
 import utils
 
+# number of bytes at the start of a log that identify it in a checkpoint
+CHECKPOINT_FINGERPRINT_SIZE = 4096
+
+def events_filename(logfile):
+    """Returns the name of the structured event log kept alongside logfile"""
+    base, _ext = os.path.splitext(logfile)
+    return base + '.events.jsonl'
+
+def format_result(event):
+    """Returns the human-readable results log entry for a 'result' event"""
+    module = event.get('module')
+    module = module and " in module '{}'".format(module)
+    jobid = event.get('jobid')
+    if jobid is None:
+        jobid = '-1'
+    label = event['label']
+    memory = event.get('memory')
+    if memory:
+        memory = '; browser memory: peak {:.1f} MB, mean {:.1f} MB'.format(
+                memory['peak'], memory['mean'])
+    else:
+        memory = ''
+
+    result = event['result']
+    if result == 'exception':
+        templ = 'Job "{}" ({}){} encountered an exception on step {}{}:\n{}\n'
+        return templ.format(label, jobid, module, event.get('step', -1), memory, event.get('exception', ''))
+    if result == 'failed':
+        templ = 'Job "{}" ({}){} failed on step {} after {:.2f} seconds{}\n'
+        return templ.format(label, jobid, module, event.get('step', -1), event.get('elapsed_time', -1.), memory)
+    if result == 'invalid':
+        templ = 'Job "{}" ({}){} finished after {:.2f} seconds, but was invalid{}:\n{}\n'
+        return templ.format(label, jobid, module, event.get('elapsed_time', -1.), memory, event.get('reason', ''))
+
+    ran_validation = ' and passed validation' if event.get('validated') else ''
+    templ = 'Job "{}" ({}){} finished successfully after {:.2f} seconds{}{}\n'
+    return templ.format(label, jobid, module, event.get('elapsed_time', -1.), ran_validation, memory)
+
 class Logger:
     """Writes log information in a single-threaded context.
 
+    Every result is recorded as a 'result' event in the JSON-lines file
+    `events` (if given), from which the human-readable entry written to
+    `logfile` is derived. Events sent by browser processes are appended to
+    `events` with log_event().
+
     N.B.: This class is NOT thread-safe.
     """
-    def __init__(self, logfile, module=''):
+    def __init__(self, logfile, module='', events=None, run_id=None):
         self.logfile = logfile
+        self.module_name = module
         self.module = module and " in module '{}'".format(module)
+        self.events = events
+        self.run_id = run_id
 
         if getattr(logfile, 'write', None):
             self.write = self.write_opened
@@ -26,49 +76,70 @@ class Logger:
         with open(self.logfile, 'a') as file_obj:
             file_obj.write(msg)
 
+    def log_event(self, event):
+        """Appends one event (a JSON-serializable dict) to the event log"""
+        if not self.events:
+            return
+        if self.run_id is not None:
+            event.setdefault('run', self.run_id)
+        with open(self.events, 'a') as file_obj:
+            file_obj.write(json.dumps(event) + '\n')
+
+    def _result_event(self, case_info, result, **fields):
+        """Returns a 'result' event describing case_info"""
+        event = {
+            'time': time.time(),
+            'event': 'result',
+            'module': self.module_name or case_info.get('module', ''),
+            'label': case_info['label'],
+            'jobid': str(case_info.get('jobid', '-1')),
+            'result': result,
+        }
+        memory = case_info.get('memory')
+        if memory:
+            event['memory'] = {'peak': memory[0], 'mean': memory[1]}
+        if case_info.get('timings'):
+            event['timings'] = case_info['timings']
+        for key in ('server_wait', 'host_wait'):
+            if key in case_info:
+                event[key] = case_info[key]
+        event.update(fields)
+        return event
+
+    def _log_result_event(self, event):
+        self.log_event(event)
+        self.write(format_result(event))
+
     def log_exception(self, case_info, step_num, exc_info):
         """Writes test cases resulting in a Python exception to logfile"""
-        templ = 'Job "{}" ({}){} encountered an exception on step {}:\n{}\n'
         if not 'jobid' in case_info:
             case_info['jobid'] = '-1'
         if 'resume_link' in case_info and step_num == 0:
             step_num = case_info['resume_link']
-        jobid = case_info['jobid']
-        label = case_info['label']
-        self.write(templ.format(label, jobid, self.module, step_num, exc_info))
+        self._log_result_event(self._result_event(case_info, 'exception',
+            step=step_num, exception=exc_info))
 
     def log_failure(self, case_info, step, elapsed_time=-1.):
         """Writes test cases resulting in CHARMM error to logfile"""
-        templ = 'Job "{}" ({}){} failed on step {} after {:.2f} seconds\n'
         if not 'jobid' in case_info:
             case_info['jobid'] = '-1'
-        jobid = case_info['jobid']
-        label = case_info['label']
-        self.write(templ.format(label, jobid, self.module, step, elapsed_time))
+        self._log_result_event(self._result_event(case_info, 'failed',
+            step=step, elapsed_time=elapsed_time))
 
     def log_success(self, case_info, elapsed_time=-1., ran_validation=False):
         """Writes test cases that reach final page without error to logfile"""
-        if ran_validation:
-            ran_validation = ' and passed validation'
-        else:
-            ran_validation = ''
-
-        templ = 'Job "{}" ({}){} finished successfully after {:.2f} seconds{}\n'
-        jobid = case_info['jobid']
-        label = case_info['label']
-        self.write(templ.format(label, jobid, self.module, elapsed_time, ran_validation))
+        self._log_result_event(self._result_event(case_info, 'success',
+            elapsed_time=elapsed_time, validated=bool(ran_validation)))
 
     def log_notice(self, case_info, step, elapsed_time=-1.):
         templ = 'Job "{}" ({}){} encountered PHP message on step {}:\n{}\n'
 
     def log_invalid(self, case_info, elapsed_time=-1., reason=''):
         """Writes test cases that finish, but failed validation to logfile"""
-        templ = 'Job "{}" ({}){} finished after {:.2f} seconds, but was invalid:\n{}\n'
         if not 'jobid' in case_info:
             case_info['jobid'] = '-1'
-        jobid = case_info['jobid']
-        label = case_info['label']
-        self.write(templ.format(label, jobid, self.module, elapsed_time, reason))
+        self._log_result_event(self._result_event(case_info, 'invalid',
+            elapsed_time=elapsed_time, reason=reason))
 
     def log_result(self, result):
         """Infers result type and logs it
@@ -96,53 +167,263 @@ class Logger:
         else:
             print('Warning: got unknown result:', result)
 
-def parse_logfile(logfile):
-    regexes = ( # varname, regex
-        ('jobid', re.compile(r'Job.*\((-?\d+)\)')),
-        ('label', re.compile(r'Job.*"([^"]+)"')),
-        ('module', re.compile(r"Job.*'([^']+)'")),
-        ('step', re.compile(r"Job.*on step (-?\d+)")),
-    )
+def read_results(logfile):
+    """Returns the latest result of each logged test case
 
-    sys_info = {}
-    notices = {}
+    Reads the structured event log that belongs to logfile if it exists,
+    otherwise falls back to parsing logfile itself. See parse_events() for
+    the return value.
+    """
+    events = events_filename(logfile)
+    if os.path.exists(events):
+        return parse_events(events)
+    return parse_logfile(logfile)
+
+def convert_logfile(logfile):
+    """Seeds the event log of a results log written before events existed
+
+    One 'result' event is written for the latest result of each test case
+    found by parse_logfile(), so that read_results() keeps seeing them.
+    Entries that never got a result, e.g. in a truncated log, are skipped.
+    """
+    events = events_filename(logfile)
+    if os.path.exists(events) or not os.path.exists(logfile):
+        return
+    with open(events, 'w') as events_file:
+        for module, jobs in parse_logfile(logfile).items():
+            for label, jobinfo in jobs.items():
+                if jobinfo.get('result') is None:
+                    continue
+                event = {'event': 'result', 'module': module, 'label': label,
+                         'jobid': jobinfo['jobid'], 'result': jobinfo['result'],
+                         'step': jobinfo.get('step'), 'converted': True}
+                if 'attempts' in jobinfo:
+                    event['attempts'] = jobinfo['attempts']
+                events_file.write(json.dumps(event) + '\n')
+
+def checkpoint_filename(path):
+    """Returns the name of the parser checkpoint kept alongside path"""
+    return path + '.ckpt'
+
+def file_fingerprint(file_obj, size):
+    """Returns a digest of the first `size` bytes of a binary file"""
+    file_obj.seek(0)
+    return hashlib.sha1(file_obj.read(size)).hexdigest()
+
+def _parse_incremental(path, parse_line):
+    """Calls parse_line(line, sys_info, notices) on each line of path
+
+    The parser state and the byte offset of the last complete line are
+    saved in a checkpoint file next to path, so later calls only parse
+    lines appended since then. The checkpoint is discarded if the start of
+    the file no longer matches (e.g., after compaction) or the file shrank.
+    Returns sys_info, without archive names (see _add_archives()).
+    """
+    checkpoint = checkpoint_filename(path)
+    with open(path, 'rb') as log:
+        size = os.fstat(log.fileno()).st_size
+        state = None
+        try:
+            with open(checkpoint) as ckpt:
+                state = json.load(ckpt)
+            if state['offset'] > size or state['fingerprint'] != \
+                    file_fingerprint(log, state['fingerprint_size']):
+                state = None
+        except (OSError, ValueError, KeyError, TypeError):
+            state = None
+        if state is None:
+            state = {'offset': 0, 'sys_info': {}, 'notices': {}}
+
+        log.seek(state['offset'])
+        data = log.read()
+        # a partial last line is parsed, but not checkpointed
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode(errors='replace').splitlines():
+            parse_line(line, state['sys_info'], state['notices'])
+
+        if end:
+            state['offset'] += end
+            state['fingerprint_size'] = min(state['offset'], CHECKPOINT_FINGERPRINT_SIZE)
+            state['fingerprint'] = file_fingerprint(log, state['fingerprint_size'])
+            try:
+                utils.write_json_atomic(checkpoint, state)
+            except OSError as exc:
+                print("Warning: can't save checkpoint {}: {}".format(checkpoint, exc))
+
+    sys_info = state['sys_info']
+    if data[end:].strip():
+        sys_info = copy.deepcopy(sys_info)
+        notices = copy.deepcopy(state['notices'])
+        parse_line(data[end:].decode(errors='replace'), sys_info, notices)
+    return sys_info
+
+def _add_archives(sys_info):
+    """Adds the name of each job's archive, if it exists, to sys_info
 
+    Each directory that may hold archives is listed only once.
+    """
+    listings = {}
+    for jobs in sys_info.values():
+        for jobinfo in jobs.values():
+            archive = utils.get_archive_name(jobinfo['jobid'])
+            dirname = os.path.dirname(archive) or os.curdir
+            if not dirname in listings:
+                try:
+                    listings[dirname] = set(os.listdir(dirname))
+                except OSError:
+                    listings[dirname] = set()
+            if os.path.basename(archive) in listings[dirname]:
+                jobinfo['archive'] = archive
+    return sys_info
+
+def _parse_event_line(line, sys_info, notices):
+    """Updates sys_info and notices with one line of an event log"""
+    # most events are about steps and waits; skip them without decoding
+    if not '"event": "result"' in line and not '"event": "message"' in line:
+        return
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return # e.g., a line cut short by a crash
+
+    event_type = event.get('event')
+    if event_type == 'message':
+        notices.setdefault(event['jobid'], [])
+        notices[event['jobid']].append({'step': str(event.get('step', -1))})
+    elif event_type == 'result':
+        jobid = str(event['jobid'])
+        step = event.get('step')
+        jobinfo = {
+            'jobid': jobid,
+            'step': None if step is None else str(step),
+            'result': event['result'],
+            'dirname': utils.get_sys_dirname(jobid),
+            'notices': event.get('notices', []) + notices.pop(jobid, []),
+        }
+
+        module_info = sys_info.setdefault(event['module'], {})
+        if prev_job := module_info.get(event['label'], None):
+            jobinfo['attempts'] = prev_job.get('attempts', 1) + 1
+        elif 'attempts' in event:
+            jobinfo['attempts'] = event['attempts']
+        module_info[event['label']] = jobinfo
+
+def parse_events(events):
+    """Returns the latest result of each test case in an event log
+
+    Only events appended since the last call are parsed; see
+    _parse_incremental().
+
+    Return
+    ======
+        {module: {label: jobinfo}}, where jobinfo is a dict with the same
+        keys as those returned by parse_logfile()
+    """
+    return _add_archives(_parse_incremental(events, _parse_event_line))
+
+_LOG_REGEXES = ( # varname, regex
+    ('jobid', re.compile(r'Job.*\((-?\d+)\)')),
+    ('label', re.compile(r'Job.*"([^"]+)"')),
+    ('module', re.compile(r"Job.*'([^']+)'")),
+    ('step', re.compile(r"Job.*on step (-?\d+)")),
+)
+
+def _parse_log_line(line, sys_info, notices):
+    """Updates sys_info and notices with one line of a text results log"""
+    jobinfo = {}
+    for key, regex in _LOG_REGEXES:
+        result = regex.search(line)
+        jobinfo[key] = result.group(1) if result else None
+
+    if jobinfo['jobid'] is None:
+        return
+
+    for sentinel in ('exception', 'failed', 'invalid', 'success'):
+        if sentinel in line:
+            jobinfo['result'] = sentinel
+            break
+
+    module = jobinfo.pop('module')
+    jobid = jobinfo['jobid']
+    if 'encountered PHP message' in line:
+        notices.setdefault(jobid, [])
+        notices[jobid].append({'step': jobinfo['step']})
+    else:
+        label = jobinfo.pop('label')
+
+        jobinfo['dirname'] = utils.get_sys_dirname(jobid)
+        jobinfo['notices'] = notices.pop(jobid, [])
+
+        sys_info.setdefault(module, {})
+        if prev_job := sys_info[module].get(label, None):
+            jobinfo['attempts'] = prev_job.get('attempts', 1) + 1
+        sys_info[module][label] = jobinfo
+
+def parse_logfile(logfile):
+    """Returns the latest result of each test case in a text results log
+
+    If logfile is a filename, only lines appended since the last call are
+    parsed; see _parse_incremental(). An open file is always read entirely.
+    """
     if isinstance(logfile, str):
-        logfile = open(logfile)
+        return _add_archives(_parse_incremental(logfile, _parse_log_line))
 
+    sys_info = {}
+    notices = {}
     with logfile as results_file:
         for line in results_file:
-            jobinfo = {}
-            for key, regex in regexes:
-                result = regex.search(line)
-                jobinfo[key] = result.group(1) if result else None
+            _parse_log_line(line, sys_info, notices)
+    return _add_archives(sys_info)
 
-            if jobinfo['jobid'] is None:
-                continue
+def compact_events(logfile):
+    """Rewrites a results log and its event log, keeping only the latest
+    result of each test case
 
-            for sentinel in ('exception', 'failed', 'invalid', 'success'):
-                if sentinel in line:
-                    jobinfo['result'] = sentinel
-                    break
+    Step, wait, download, and other events are dropped. The attempt count
+    and notices of each test case are kept in its result event, and the
+    text log is regenerated from the remaining result events. Do not
+    compact a log that a running run_tests.py is appending to.
 
-            module = jobinfo.pop('module')
-            jobid = jobinfo['jobid']
-            if 'encountered PHP message' in line:
-                notices.setdefault(jobid, [])
-                notices[jobid].append({'step': jobinfo['step']})
-            else:
-                label = jobinfo.pop('label')
+    Returns
+    =======
+        (number of events before, number of events after)
+    """
+    convert_logfile(logfile)
+    events = events_filename(logfile)
 
-                archive = utils.get_archive_name(jobid)
-                if os.path.exists(archive):
-                    jobinfo['archive'] = archive
+    sys_info = {}
+    notices = {}
+    latest = {}
+    num_events = 0
+    with open(events) as events_file:
+        for line in events_file:
+            num_events += 1
+            _parse_event_line(line, sys_info, notices)
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get('event') == 'result':
+                key = event['module'], event['label']
+                # keep the order in which test cases last finished
+                latest.pop(key, None)
+                latest[key] = event
 
-                jobinfo['dirname'] = utils.get_sys_dirname(jobid)
-                jobinfo['notices'] = notices.pop(jobid, [])
+    compacted = []
+    for (module, label), event in latest.items():
+        jobinfo = sys_info[module][label]
+        if 'attempts' in jobinfo:
+            event['attempts'] = jobinfo['attempts']
+        event.pop('notices', None)
+        if jobinfo['notices']:
+            event['notices'] = jobinfo['notices']
+        compacted.append(event)
 
-                sys_info.setdefault(module, {})
-                if prev_job := sys_info[module].get(label, None):
-                    jobinfo['attempts'] = prev_job.get('attempts', 1) + 1
-                sys_info[module][label] = jobinfo
+    utils.write_text_atomic(events, ''.join(json.dumps(event) + '\n'
+                                            for event in compacted))
+    utils.write_text_atomic(logfile, ''.join(map(format_result, compacted)))
+    for path in (events, logfile):
+        if os.path.exists(checkpoint_filename(path)):
+            os.unlink(checkpoint_filename(path))
 
-    return sys_info
+    return num_events, len(compacted)
@@ -1,12 +1,12 @@
 """Handles LPS Modeler options"""
 from itertools import product
 
-from utils import read_yaml, set_form_value
+from utils import load_config, set_form_value
 from cgui_browser_process import CGUIBrowserProcess
 
 _BROWSER_PROCESS = 'LPSBrowserProcess'
 
-_species = read_yaml('lps.enabled.yml')
+_species = load_config('lps.enabled.yml')
 _valid_settings = 'species', 'lipa', 'core', 'nounit', 'oanti', 'lipaphos'
 _list_possible = _valid_settings[1:]
 
@@ -0,0 +1,91 @@
+"""Samples memory usage of a browser and its driver"""
+import os
+import threading
+
+class MemoryMonitor(threading.Thread):
+    """Periodically samples the total RSS of a process and its descendants
+
+    Usage:
+        monitor = MemoryMonitor(driver_pid)
+        monitor.start()
+        monitor.reset()         # at the start of each test case
+        peak, mean = monitor.stats()
+        monitor.stop()
+
+    Memory is read from /proc, so sampling only works on Linux; elsewhere,
+    stats() always returns None.
+    """
+    def __init__(self, pid, interval=2.):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.enabled = os.path.isdir('/proc')
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.peak = 0
+        self.total = 0
+        self.count = 0
+
+    @staticmethod
+    def _read_rss(pid):
+        """Returns the resident set size of pid in bytes, or 0 if it is gone"""
+        try:
+            with open('/proc/{}/statm'.format(pid)) as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, IndexError, ValueError):
+            return 0
+
+    def _tree_pids(self):
+        """Returns self.pid and all of its descendants' pids"""
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/{}/stat'.format(entry)) as stat:
+                    # the command name may contain spaces; ppid follows it
+                    ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+        pids = [self.pid]
+        for pid in pids:
+            pids.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        """Records and returns the current RSS of the process tree in bytes"""
+        rss = sum(map(self._read_rss, self._tree_pids()))
+        with self._lock:
+            self.peak = max(self.peak, rss)
+            self.total += rss
+            self.count += 1
+        return rss
+
+    def reset(self):
+        """Forgets all samples taken so far"""
+        with self._lock:
+            self.peak = self.total = self.count = 0
+
+    def stats(self):
+        """Returns peak and mean RSS in MB since the last reset()
+
+        Takes one more sample first, so that short test cases are measured.
+        """
+        if not self.enabled:
+            return None
+        self.sample()
+        with self._lock:
+            mega = 1024. * 1024.
+            return self.peak / mega, self.total / self.count / mega
+
+    def run(self):
+        if not self.enabled:
+            return
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """Stops sampling"""
+        self._stopped.set()
@@ -1,26 +1,25 @@
 """Handles Multicomponent Assembler options"""
 import copy
 from os.path import join as pjoin
-from splinter.exceptions import ElementDoesNotExist
 from bilayer_builder import BilayerBrowserProcess
 from input_generator import InputBrowserProcess
-from utils import set_elem_value
+from scheduler import CONTINUE, CaseGraph, case_key
+from utils import project_copy_name, set_elem_value
 
 _BROWSER_PROCESS = 'MCABrowserProcess'
 
 def init_module(test_cases, args):
     """Preprocesses test cases
 
-    Returns: (2-tuple)
+    Returns
     =======
-        base_cases  Cases that can begin immediately
-        wait_cases  Cases that need one of the base cases to complete first
+        scheduler.CaseGraph, in which solvent test variants that resume from
+        a copy of the first variant's project wait for it to be copied
     """
-    base_cases = []
-    wait_cases = {}
+    graph = CaseGraph()
     for test_case in test_cases:
         if not 'solvent_tests' in test_case:
-            base_cases.append(test_case)
+            graph.add(test_case)
         else:
             do_copy = args.copy
             if 'memb' in test_case['label']:
@@ -33,11 +32,23 @@ def init_module(test_cases, args):
             # tests, this is not possible
             if 'localhost' in args.base_url.lower() and do_copy:
                 base_case = cases[0]
-                base_cases.append(base_case)
-                wait_cases[base_case['label']] = cases[1:]
+                graph.add(base_case)
+                for case in cases[1:]:
+                    graph.add(case, requires={case_key(base_case): CONTINUE},
+                              prepare=resume_solvent_copy)
             else:
-                base_cases += cases
-    return base_cases, wait_cases
+                for case in cases:
+                    graph.add(case)
+    return graph
+
+def resume_solvent_copy(test_case, base_case):
+    """Points a solvent test variant at its copy of base_case's project
+
+    copy_dir() names the copies {jobid}_1, {jobid}_2, ...; the variant
+    resumes at the step where the copies were made.
+    """
+    test_case['jobid'] = project_copy_name(base_case['jobid'], test_case['case_id'])
+    test_case['resume_link'] = test_case['solvent_link']
 
 def handle_solvent_memb_tests(test_case, do_copy=False):
     """Like handle_solvent_tests(), but for systems with a membrane"""
@@ -170,6 +181,8 @@ class MCABrowserProcess(BilayerBrowserProcess, InputBrowserProcess):
     def find_comp_row(self, comp_name, step):
         """Returns the row element page corresponding to the given uploaded
         component basename"""
+        from splinter.exceptions import ElementDoesNotExist
+
         def molpacking_selector():
             return self.browser.find_by_css(
                 ".component_list table tr:not(:first-child) td:nth-child(2)")
@@ -1,10 +1,10 @@
 """Handles Nanomaterial Modeler options"""
 from solution_builder import SolutionBrowserProcess
-from utils import read_yaml, set_elem_value, set_form_value
+from utils import load_config, set_elem_value, set_form_value
 
 _BROWSER_PROCESS = 'NMMBrowserProcess'
-_nanomaterial_menu = read_yaml('nanomaterials.yml')['nanomaterial']['sub']
-_ligand_menu = read_yaml('lig.enabled.yml')
+_nanomaterial_menu = load_config('nanomaterials.yml')['nanomaterial']['sub']
+_ligand_menu = load_config('lig.enabled.yml')
 
 # Some settings have aliases, e.g. 'lx' can also be 'height'. In all cases,
 # the name submitted by the form should be given first. Settings are handled
@@ -0,0 +1,524 @@
+"""Compiles test cases into fully-expanded test plans
+
+A module's test plan is the list of test cases that results from applying
+option inheritance and custom options (see setup_custom_options()) to every
+test case in its test files. Compiling a plan reads the same parent, map,
+and template files over and over, so PlanCompiler parses each YAML file
+only once, resolves each test file name only once, and compiles each option
+regex only once. Compiled plans are also cached in CACHE_DIR, together with
+the files they were compiled from, so that an unchanged plan is loaded
+without parsing any YAML.
+
+Many test cases of a module start with the same steps. For tests on
+localhost, share_step_prefixes() arranges for those steps to run only once
+(see StepTrie), and set_snapshot_keys() names the states of their projects
+so that they can be reused in later runs (see snapshot_cache).
+"""
+import copy
+import functools
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+from os.path import join as pjoin
+
+import utils
+from scheduler import CONTINUE, case_key
+
+# directory of cached plans
+PLAN_CACHE_DIR = pjoin(utils.CACHE_DIR, 'plans')
+
+# test case options that have no effect on what its steps do
+_NON_STEP_OPTIONS = frozenset(('label', 'steps', 'module', 'parent', 'dict',
+                               'requires', 'priority', 'psf_validation',
+                               'snapshot_keys'))
+
+def _file_state(path):
+    """Returns [mtime_ns, size, sha1] of a file"""
+    stat = os.stat(path)
+    with open(path, 'rb') as file_obj:
+        digest = hashlib.sha1(file_obj.read()).hexdigest()
+    return [stat.st_mtime_ns, stat.st_size, digest]
+
+def _file_unchanged(path, state):
+    """Returns True if path still has the contents described by state"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if [stat.st_mtime_ns, stat.st_size] == state[:2]:
+        return True
+    # a file may be touched without being changed
+    return stat.st_size == state[1] and _file_state(path)[2] == state[2]
+
+class PlanCompiler:
+    """Compiles test plans, reusing everything it reads
+
+    Usage:
+        compiler = PlanCompiler()
+        base_cases = compiler.compile('bilayer', ['test_cases/bilayer/basic.yml'])
+
+    load_yaml() and find_test_file() record every file they read and every
+    name they resolve; compile() stores those with the plan so that the
+    cached plan is discarded as soon as any of them would change.
+    """
+    # the compiled plan also depends on the code that compiles it
+    SOURCES = os.path.abspath(__file__), os.path.abspath(utils.__file__)
+
+    def __init__(self, cache_dir=PLAN_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.yaml_cache = {}
+        self.lookups = {}
+        self.patterns = {}
+        self.files_read = set()
+        self.lookups_used = set()
+
+    def load_yaml(self, filename):
+        """Returns a private copy of the contents of a YAML file
+
+        Each file is parsed only once; callers may modify what they get.
+        """
+        self.files_read.add(filename)
+        if not filename in self.yaml_cache:
+            self.yaml_cache[filename] = utils.read_yaml(filename)
+        return copy.deepcopy(self.yaml_cache[filename])
+
+    def find_test_file(self, filename, module=None):
+        """Memoized version of utils.find_test_file()"""
+        key = filename, module
+        self.lookups_used.add(key)
+        if not key in self.lookups:
+            self.lookups[key] = utils.find_test_file(filename, module=module)
+        return self.lookups[key]
+
+    def option_pattern(self, opt):
+        """Returns the compiled regex that matches custom option `opt`"""
+        pattern = self.patterns.get(opt)
+        if pattern is None:
+            pattern = self.patterns[opt] = re.compile(r'\b' + opt + r'\b')
+        return pattern
+
+    def setup_custom_options(self, test_case, module):
+        """Applies inheritance, custom options, and module steps to test_case"""
+        test_case = self.setup_test_inheritance(test_case, module)
+
+        map_filename = test_case.get('dict')
+        if map_filename:
+            map_filename = self.find_test_file(map_filename, module=module)
+            opt_map = self.load_yaml(map_filename)
+            for opt, settings in opt_map.items():
+                if opt in test_case:
+                    value = str(test_case[opt])
+                    pattern = self.option_pattern(opt)
+
+                    step = settings.get('step')
+                    assert step, "Error: 'step' must be defined for custom options"
+                    step = int(step) - 1
+
+                    test_step = test_case['steps'][step]
+
+                    presteps = settings.get('presteps')
+                    if presteps:
+                        for ind, step in enumerate(presteps):
+                            presteps[ind] = pattern.sub(value, step)
+
+                        test_presteps = test_step.setdefault('presteps', [])
+                        test_presteps += presteps
+
+                    elems = settings.get('elems')
+                    if elems:
+                        for ind, elem in enumerate(elems):
+                            for elem_name, elem_value in elem.items():
+                                elem_value = str(elem_value)
+                                elems[ind][elem_name] = pattern.sub(value, elem_value)
+
+                        test_elems = test_step.setdefault('elems', [])
+                        test_elems += elems
+
+                    poststeps = settings.get('poststeps')
+                    if poststeps:
+                        for ind, step in enumerate(poststeps):
+                            poststeps[ind] = pattern.sub(value, step)
+
+                        test_poststeps = test_step.setdefault('poststeps', [])
+                        test_poststeps += poststeps
+
+        # look for "module" in each step
+        # can't use for loop b/c iteration is nonlinear
+        ind = 0
+        while ind < len(test_case['steps']):
+            step = test_case['steps'][ind]
+            if 'module' in step:
+                module_info = step['module']
+                module_name = module_info['name']
+                module_template = self.find_test_file(module_name, module=module_name)
+
+                test_template = self.load_yaml(module_template)
+
+                # inherit options from test_template
+                test_copy = test_case.copy()
+
+                # default to test_copy's options except for steps/dict/parent
+                for key in ('steps', 'dict', 'parent'):
+                    if key in test_copy:
+                        del test_copy[key]
+
+                test_template.update(test_copy)
+
+                test_template = test_copy
+
+                # generate sub-case as though template were the main case
+                test_template = self.setup_custom_options(test_template, module=module_name)
+
+                # obtain user's desired slice of module's steps
+                index = module_info.get('index', None)
+                if index is None:
+                    start = module_info.get('start', None)
+                    stop = module_info.get('stop', None)
+                    step_slice = slice(start, stop)
+                    module_steps = test_template['steps'][step_slice]
+                else:
+                    module_steps = [test_template['steps'][index]]
+
+                # replace module entry with steps
+                before = test_case['steps'][:ind]
+                after = test_case['steps'][ind+1:]
+                test_template['steps'] = before + module_steps + after
+                test_case = test_template
+
+                ind += len(module_steps)
+            else:
+                ind += 1
+
+        return test_case
+
+    def setup_test_inheritance(self, child_case, module):
+        """Option inheritance logic is handled here.
+
+        Test cases can inherit options from another test case. Option resolution
+        works similarly to variable-name resolution in Python's object inheritance
+        scheme, except that multiple inheritance is not allowed; i.e., test cases
+        may have only one parent.
+
+        If an option is defined in both the child and the parent, then the child's
+        value for that option used.
+        """
+        if not 'parent' in child_case:
+            child_case['parent'] = module
+
+        lineage = [child_case]
+        filenames = [None]
+        parent = child_case.get('parent', module)
+        while parent != False:
+            # defaults to module name
+            if parent is None:
+                parent = module
+
+            # break if module has itself as parent
+            parent = self.find_test_file(parent, module=module)
+            if parent in filenames:
+                break
+
+            parent_case = self.load_yaml(parent)
+            lineage.append(parent_case)
+            filenames.append(parent)
+
+            child_case = parent_case
+            parent = child_case.get('parent', module)
+
+        parent_case = lineage.pop()
+        while lineage:
+            child_case = lineage.pop()
+            parent_case.update(child_case)
+
+        return parent_case
+
+    def cache_filename(self, module, test_files):
+        """Returns the name of the cached plan for module's test_files"""
+        key = repr((module, sorted(test_files), os.path.abspath(os.curdir)))
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return pjoin(self.cache_dir, '{}-{}.pickle'.format(module, digest))
+
+    def load_cached(self, cache_file):
+        """Returns the cached plan in cache_file, or None if it is stale"""
+        try:
+            with open(cache_file, 'rb') as cache:
+                cached = pickle.load(cache)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+
+        for path, state in cached['files'].items():
+            if not _file_unchanged(path, state):
+                return None
+
+        # a new file may take precedence over the one a name resolved to
+        for (filename, module), path in cached['lookups'].items():
+            try:
+                if utils.find_test_file(filename, module=module) != path:
+                    return None
+            except FileNotFoundError:
+                return None
+
+        return cached['cases']
+
+    def save(self, cache_file, cases, files, lookups):
+        """Caches a compiled plan along with the files it was compiled from"""
+        cached = {
+            'cases': cases,
+            'files': {path: _file_state(path) for path in files},
+            'lookups': lookups,
+        }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'wb') as cache:
+                pickle.dump(cached, cache, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError as exc:
+            utils.warn("Warning: can't cache test plan:", exc)
+
+    def compile(self, module, test_files, use_cache=True):
+        """Returns the fully compiled test cases in a module's test files
+
+        Parameters
+        ==========
+            module      str   lowercase module name, e.g. 'bilayer'
+            test_files  list  paths of YAML files with lists of test cases
+
+        Returns
+        =======
+            List of test cases, in the order they appear in test_files
+        """
+        cache_file = self.cache_filename(module, test_files)
+        if use_cache:
+            cases = self.load_cached(cache_file)
+            if cases is not None:
+                return cases
+
+        self.files_read = set()
+        self.lookups_used = set()
+        cases = []
+        for test_file in test_files:
+            for test_case in self.load_yaml(test_file):
+                cases.append(self.setup_custom_options(test_case, module))
+
+        files = self.files_read | set(self.SOURCES)
+        lookups = {key: self.lookups[key] for key in self.lookups_used}
+        self.save(cache_file, cases, files, lookups)
+        return cases
+
+_compiler = None
+
+def get_compiler():
+    """Returns this process's PlanCompiler"""
+    global _compiler
+    if _compiler is None:
+        _compiler = PlanCompiler()
+    return _compiler
+
+def _freeze(value):
+    """Returns a canonical string for a YAML value, to use as a dict key"""
+    return json.dumps(value, sort_keys=True, default=str)
+
+class StepTrie:
+    """A trie of the compiled steps of test cases
+
+    Each node stands for one step: its inputs (elems, presteps, poststeps,
+    wait_text, ...), the options that the step reads (see option_steps()),
+    and whether it is a test case's last step, which is not submitted.
+    Options that may be read anywhere, e.g. by a module's front page, key
+    the roots instead. Test cases on the same path from a root do exactly
+    the same thing up to where they part.
+
+    Usage:
+        trie = StepTrie()
+        for test_case in test_cases:
+            trie.insert(test_case)
+        for runner, test_case, branch, copy_no in trie.branches(): ...
+    """
+    # option maps of every module, whose `step` says where an option is read
+    MAP_GLOB = pjoin('test_cases', '*', '*.map.yml')
+
+    def __init__(self, compiler=None):
+        self.compiler = compiler or get_compiler()
+        self.roots = {}
+        self._option_maps = None
+
+    @staticmethod
+    def _node():
+        return {'children': {}, 'cases': []}
+
+    def option_maps(self):
+        """Returns {option: [settings in every option map that defines it]}"""
+        if self._option_maps is None:
+            self._option_maps = {}
+            for map_path in sorted(glob.glob(self.MAP_GLOB)):
+                for opt, settings in (self.compiler.load_yaml(map_path) or {}).items():
+                    if isinstance(settings, dict):
+                        self._option_maps.setdefault(opt, []).append(settings)
+        return self._option_maps
+
+    def _rendered(self, opt, value, settings):
+        """Yields (kind, item) that setup_custom_options() adds for an option"""
+        pattern = self.compiler.option_pattern(opt)
+        value = str(value)
+        for kind in ('presteps', 'poststeps'):
+            for item in settings.get(kind) or ():
+                yield kind, pattern.sub(value, item)
+        for elem in settings.get('elems') or ():
+            yield 'elems', {name: pattern.sub(value, str(elem_value))
+                            for name, elem_value in elem.items()}
+
+    def option_steps(self, test_case):
+        """Returns {option: index of the first step that reads it}
+
+        An option is read by the first step that holds something its option
+        map entry adds, like `select_lipids()` for `lipids`; such a prestep
+        reads the option's value when it runs. Options that can't be found
+        in any step, like those a front page reads, are given None.
+        """
+        steps = test_case['steps']
+        option_steps = {}
+        for opt, value in test_case.items():
+            if opt in _NON_STEP_OPTIONS:
+                continue
+            found = None
+            for settings in self.option_maps().get(opt, ()):
+                for kind, item in self._rendered(opt, value, settings):
+                    for step_num, step in enumerate(steps[:found]):
+                        if item in (step.get(kind) or ()):
+                            found = step_num
+                            break
+            option_steps[opt] = found
+        return option_steps
+
+    def case_options(self, test_case):
+        """Returns keys of the options each step of a test case reads
+
+        Returns
+        =======
+            (key of options read before any step, [key of each step's])
+        """
+        option_steps = self.option_steps(test_case)
+        step_options = [{} for _step in test_case['steps']]
+        front_options = {}
+        for opt, step_num in option_steps.items():
+            options = front_options if step_num is None else step_options[step_num]
+            options[opt] = test_case[opt]
+        return _freeze(front_options), [_freeze(options) for options in step_options]
+
+    def insert(self, test_case):
+        """Adds a test case's steps to the trie"""
+        front_options, step_options = self.case_options(test_case)
+        node = self.roots.setdefault(front_options, self._node())
+        steps = test_case['steps']
+        for step_num, step in enumerate(steps):
+            key = _freeze(step), step_options[step_num], step_num == len(steps) - 1
+            node = node['children'].setdefault(key, self._node())
+        node['cases'].append(test_case)
+
+    @staticmethod
+    def _first_case(node):
+        """Returns the first test case inserted below node"""
+        while not node['cases']:
+            node = next(iter(node['children'].values()))
+        return node['cases'][0]
+
+    def branches(self):
+        """Yields how test cases can share the steps they have in common
+
+        Yields
+        ======
+            (runner, test_case, branch, copy_no): runner copies its project
+            when it reaches step number `branch`, and test_case resumes from
+            copy number `copy_no` at that step. Test cases that share no
+            steps with another test case are not yielded, nor are test
+            cases identical to another one.
+        """
+        for root in self.roots.values():
+            # test cases that part on their first step share nothing
+            for child in root['children'].values():
+                yield from self._branches(child, 1, self._first_case(child))
+
+    def _branches(self, node, depth, runner):
+        """Yields branches below node, which runner reaches after `depth` steps"""
+        children = list(node['children'].values())
+        if len(children) == 1:
+            yield from self._branches(children[0], depth + 1, runner)
+            return
+
+        copy_no = 0
+        for child in children:
+            first = self._first_case(child)
+            if first is runner:
+                yield from self._branches(child, depth + 1, runner)
+            else:
+                copy_no += 1
+                yield runner, first, depth, copy_no
+                yield from self._branches(child, depth + 1, first)
+
+def resume_from_copy(test_case, base_case, branch, copy_no):
+    """Points a test case at its copy of base_case's project (see copy_dir())"""
+    test_case['jobid'] = utils.project_copy_name(base_case['jobid'], copy_no, branch)
+    test_case['resume_link'] = branch
+
+def share_step_prefixes(graph):
+    """Makes test cases in graph that start with the same steps share them
+
+    The shared steps are run by one test case, which copies its project
+    (see CGUIBrowserProcess.copy_dir()) wherever other test cases part from
+    it; each of those resumes from its own copy. Only test cases that
+    neither require nor are required by another test case, and that don't
+    already copy or resume a project, take part. Copying projects only
+    works for tests on localhost.
+
+    Parameters
+    ==========
+        graph  scheduler.CaseGraph  graph of one module, not yet finalized
+
+    Returns
+    =======
+        number of steps that are no longer repeated
+    """
+    trie = StepTrie()
+    for test_case in graph.independent_cases():
+        if 'jobid' in test_case or 'copy_dir(' in _freeze(test_case['steps']):
+            continue
+        trie.insert(test_case)
+
+    copies = {}
+    saved = 0
+    for runner, test_case, branch, copy_no in trie.branches():
+        prepare = functools.partial(resume_from_copy, branch=branch, copy_no=copy_no)
+        graph.require(case_key(test_case), case_key(runner), CONTINUE,
+                      prepare=prepare, branch=branch)
+        copies.setdefault((case_key(runner), branch), [runner, 0])[1] += 1
+        saved += branch
+
+    for (_key, branch), (runner, ncopy) in copies.items():
+        # copy once the step's page is loaded, before anything is changed
+        step = runner['steps'][branch] = copy.deepcopy(runner['steps'][branch])
+        step.setdefault('presteps', []).insert(0,
+                "copy_dir(ncopy={}, branch={})".format(ncopy, branch))
+    return saved
+
+def set_snapshot_keys(test_cases, revision):
+    """Sets each test case's 'snapshot_keys'
+
+    snapshot_keys[i] identifies the project of a test case once the page of
+    step i+1 has loaded: a hash of the server's code revision, and of steps
+    0 to i with the options they read (see StepTrie.case_options()). Test
+    cases with equal keys have projects in the same state at that point.
+    """
+    trie = StepTrie()
+    for test_case in test_cases:
+        front_options, step_options = trie.case_options(test_case)
+        digest = hashlib.sha1(_freeze([revision, test_case.get('module'),
+                                       front_options]).encode())
+        keys = []
+        for step, options in zip(test_case['steps'][:-1], step_options):
+            digest.update(_freeze([step, options]).encode())
+            keys.append(digest.hexdigest())
+        test_case['snapshot_keys'] = keys
@@ -1,9 +1,11 @@
 """Handles polymer builder options"""
-import yaml
 from cgui_browser_process import CGUIBrowserProcess
+from utils import load_config
 
 _BROWSER_PROCESS = 'PBBrowserProcess'
 
+_polymer_menu = load_config('polymer.enabled.yml')
+
 class PBBrowserProcess(CGUIBrowserProcess):
     """Implements option selection for all polymer pages"""
     def __init__(self, *args, **kwargs):
@@ -105,7 +107,7 @@ class PBBrowserProcess(CGUIBrowserProcess):
 
         # attach files for this test case
         self.model = test_case['label']
-        self.polydic = yaml.load(open("polymer.enabled.yml",'r'))
+        self.polydic = _polymer_menu
         self.run_step0(test_case['pchains'],
                        wait_text='Generate Systems')
         test_case['jobid'] = self.jobid
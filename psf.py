@@ -0,0 +1,402 @@
+"""Array-based reading and comparison of CHARMM PSF files"""
+import hashlib
+import json
+import mmap
+import os
+import re
+
+import numpy as np
+
+# number of atom indices in each entry of a connectivity section
+ENTRY_WIDTHS = {
+    'NBOND': 2,
+    'NTHETA': 3,
+    'NPHI': 4,
+    'NIMPHI': 4,
+    'NDON': 2,
+    'NACC': 2,
+    'NGRP': 3,
+    'NCRTERM': 8,
+}
+
+# offset to convert the first value of an entry to a 0-based atom index;
+# NGRP holds 0-based pointers rather than 1-based atom numbers
+FIRST_ATOM_OFFSETS = {section: -1 for section in ENTRY_WIDTHS}
+FIRST_ATOM_OFFSETS['NGRP'] = 0
+
+# human-readable names of sections, as used in diff summaries
+SECTION_NAMES = {
+    'NATOM': 'atoms',
+    'NBOND': 'bonds',
+    'NTHETA': 'angles',
+    'NPHI': 'dihedrals',
+    'NIMPHI': 'impropers',
+    'NDON': 'donors',
+    'NACC': 'acceptors',
+    'NNB': 'nonbonded exclusions',
+    'NGRP': 'groups',
+    'MOLNT': 'molecules',
+    'NUMLP': 'lone pairs',
+    'NCRTERM': 'cross-terms',
+}
+
+# NATOM columns compared as strings, by index
+ATOM_STR_COLUMNS = {1: 'segid', 2: 'resid', 3: 'resname', 4: 'name', 5: 'type'}
+ATOM_CHARGE = 6
+ATOM_MASS = 7
+
+# whitespace around line breaks, which is ignored by content_hash()
+_LINE_BREAK = re.compile(rb'[ \t]*\r?\n[ \t]*')
+
+# matches the name in header lines like "      1330         0 !NGRP NST2"
+_HEADER_NAME = re.compile(rb'!([A-Z]\w*)')
+
+class PSF:
+    """Column-oriented contents of a PSF file
+
+    The raw text of each section after the title is kept in `raw`, keyed by
+    its header name (e.g., 'NATOM', 'NBOND'), and its header counts are in
+    `counts`. Sections are only converted to arrays when first accessed:
+
+        atom_strings    2D bytes array of segid, resid, resname, name, and
+                        type for each atom, upper-cased
+        charges         float array of atom charges
+        masses          float array of atom masses
+        atom_extra      2D float array of any remaining atom columns
+        section(name)   integer array of a non-atom section, with one row
+                        per entry for connectivity sections
+
+    `source` may be a filename, which is memory-mapped, or the bytes of a
+    PSF file.
+    """
+    def __init__(self, source, name=None):
+        self.name = name or (source if isinstance(source, str) else '<psf>')
+        self.counts = {}
+        self.raw = {}
+        self._sections = {}
+        self._atoms = None
+
+        if isinstance(source, str):
+            with open(source, 'rb') as file_obj:
+                with mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    self._split(data)
+        else:
+            self._split(source)
+
+    @staticmethod
+    def read_headers(data):
+        """Returns [(name, counts, body_start, header_start), ...] for data"""
+        headers = []
+        for match in _HEADER_NAME.finditer(data):
+            header_start = data.rfind(b'\n', 0, match.start()) + 1
+            body_start = data.find(b'\n', match.end())
+            body_start = len(data) if body_start == -1 else body_start + 1
+            counts = data[header_start:match.start()].split()
+            if not counts or not all(count.lstrip(b'-').isdigit() for count in counts):
+                continue
+            counts = [int(count) for count in counts]
+            headers.append((match.group(1).decode(), counts, body_start, header_start))
+        return headers
+
+    def _split(self, data):
+        headers = self.read_headers(data)
+        if not headers or headers[0][0] != 'NTITLE':
+            raise ValueError("missing !NTITLE section in "+self.name)
+
+        for index, (section, counts, start, _header_start) in enumerate(headers):
+            if section == 'NTITLE':
+                continue
+            if index+1 < len(headers):
+                stop = headers[index+1][3]
+            else:
+                stop = len(data)
+
+            self.counts[section] = counts
+            self.raw[section] = data[start:stop].rstrip()
+
+    def section(self, section):
+        """Returns the values of a non-atom section as an integer array"""
+        values = self._sections.get(section)
+        if values is None:
+            counts = self.counts[section]
+            values = np.fromstring(self.raw[section], dtype=np.int64, sep=' ')
+            width = ENTRY_WIDTHS.get(section)
+            if width and values.size == counts[0] * width:
+                values = values.reshape(counts[0], width)
+            self._sections[section] = values
+        return values
+
+    def _parse_atoms(self):
+        if self._atoms is not None:
+            return self._atoms
+
+        natom = self.counts['NATOM'][0]
+        tokens = np.array(self.raw['NATOM'].split())
+        if natom == 0:
+            ncols = ATOM_MASS + 1
+        elif tokens.size % natom:
+            raise ValueError("unexpected number of atom columns in "+self.name)
+        else:
+            ncols = tokens.size // natom
+        if ncols <= ATOM_MASS:
+            raise ValueError("too few atom columns in "+self.name)
+
+        table = tokens.reshape(natom, ncols)
+        self._atoms = {
+            'atom_strings': np.char.upper(table[:, list(ATOM_STR_COLUMNS)]),
+            'charges': table[:, ATOM_CHARGE].astype(np.float64),
+            'masses': table[:, ATOM_MASS].astype(np.float64),
+            'atom_extra': table[:, ATOM_MASS+1:].astype(np.float64),
+        }
+        return self._atoms
+
+    @property
+    def atom_strings(self):
+        return self._parse_atoms()['atom_strings']
+
+    @property
+    def charges(self):
+        return self._parse_atoms()['charges']
+
+    @property
+    def masses(self):
+        return self._parse_atoms()['masses']
+
+    @property
+    def atom_extra(self):
+        return self._parse_atoms()['atom_extra']
+
+    @property
+    def segids(self):
+        """Segment ID of each atom"""
+        return self.atom_strings[:, 0]
+
+    def content_hash(self):
+        """Returns a SHA-256 hex digest of everything after the title
+
+        Case and whitespace at the start and end of each line are ignored,
+        so two PSFs with the same hash have no differences for diff().
+        """
+        digest = hashlib.sha256()
+        for section, counts in self.counts.items():
+            digest.update(' '.join(map(str, counts)).encode() + b' !' + section.encode())
+            digest.update(b'\n' + _LINE_BREAK.sub(b'\n', self.raw[section].strip().upper()) + b'\n')
+        return digest.hexdigest()
+
+class PSFDiff:
+    """Per-section summary of the differences between two PSFs
+
+    `sections` maps each differing section's header name to a dict with:
+        counts      (target counts, reference counts), if they differ
+        sizes       (target values, reference values), if only they differ
+        differing   number of differing entries (if counts are equal)
+        segments    {segid: number of differing entries}
+        fields      for atoms, {column name: number of differing atoms}
+    """
+    def __init__(self, target_name, reference_name):
+        self.target_name = target_name
+        self.reference_name = reference_name
+        self.sections = {}
+
+    def __bool__(self):
+        return bool(self.sections)
+
+    def __str__(self):
+        lines = ['Target ({}) differs from reference ({}):'.format(
+            self.target_name, self.reference_name)]
+        for section, info in self.sections.items():
+            name = SECTION_NAMES.get(section, section)
+            if 'counts' in info:
+                counts = [' '.join(map(str, counts)) if counts else 'missing'
+                          for counts in info['counts']]
+                lines.append('  {}: count {} != {}'.format(name, *counts))
+                continue
+            if 'sizes' in info:
+                lines.append('  {}: {} values != {}'.format(name, *info['sizes']))
+                continue
+            lines.append('  {}: {} differing'.format(name, info['differing']))
+            if info.get('fields'):
+                fields = ', '.join('{} {}'.format(field, count)
+                        for field, count in info['fields'].items())
+                lines.append('    by field: '+fields)
+            if info.get('segments'):
+                segments = ', '.join('{} {}'.format(segid, count)
+                        for segid, count in info['segments'].items())
+                lines.append('    by segment: '+segments)
+        return '\n'.join(lines)
+
+def _count_by_segment(segids, mask):
+    """Returns {segid: count} of the True entries in mask"""
+    names, counts = np.unique(segids[mask], return_counts=True)
+    return {name.decode(): int(count) for name, count in zip(names, counts)}
+
+def diff_counts(target, reference_counts, reference_name):
+    """Compares only the section header counts of target to reference_counts
+
+    reference_counts should look like PSF.counts. Returns a PSFDiff.
+    """
+    result = PSFDiff(target.name, reference_name)
+    sections = list(target.counts)
+    sections += [section for section in reference_counts if not section in target.counts]
+    for section in sections:
+        target_counts = target.counts.get(section)
+        ref_counts = reference_counts.get(section)
+        if target_counts != ref_counts:
+            result.sections[section] = {'counts': (target_counts, ref_counts)}
+    return result
+
+class ReferenceIndex:
+    """Header counts and content hashes of every PSF in a reference directory
+
+    The index is kept in a JSON file, and an entry is only recomputed when
+    its file's size or modification time changes.
+
+    Usage:
+        index = ReferenceIndex('files/references', '.cache/references.json')
+        entry = index.lookup('files/references/pdb/1ubq_with_two_staples.psf')
+        entry['counts'], entry['hash']
+    """
+    def __init__(self, root, cache_file):
+        self.root = root
+        self.cache_file = cache_file
+        self.entries = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as cache:
+                    self.entries = json.load(cache)
+            except ValueError:
+                self.entries = {}
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _is_current(self, key, stat):
+        entry = self.entries.get(key)
+        return entry is not None and \
+                entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size
+
+    def _index(self, path, stat):
+        structure = PSF(path)
+        self.entries[self._key(path)] = {
+            'mtime': stat.st_mtime,
+            'size': stat.st_size,
+            'counts': structure.counts,
+            'hash': structure.content_hash(),
+        }
+
+    def save(self):
+        """Atomically writes the index to its cache file"""
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as cache:
+            json.dump(self.entries, cache)
+        os.replace(tmp_file, self.cache_file)
+
+    def update(self):
+        """Indexes new and modified references and forgets deleted ones"""
+        changed = False
+        found = set()
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith('.psf'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = self._key(path)
+                found.add(key)
+                stat = os.stat(path)
+                if not self._is_current(key, stat):
+                    self._index(path, stat)
+                    changed = True
+
+        for key in set(self.entries) - found:
+            del self.entries[key]
+            changed = True
+
+        if changed:
+            self.save()
+
+    def lookup(self, path):
+        """Returns the (possibly updated) index entry for a reference file"""
+        key = self._key(path)
+        stat = os.stat(path)
+        if not self._is_current(key, stat):
+            self._index(path, stat)
+            self.save()
+        return self.entries[key]
+
+def diff(target, reference, charge_tol=1e-5, mass_tol=1e-4):
+    """Compares two PSF objects section by section
+
+    Sections whose text is identical are not parsed at all. Otherwise,
+    charges (and other numeric atom columns) are compared with an absolute
+    tolerance of charge_tol, and masses with mass_tol. String columns are
+    compared case-insensitively. Connectivity entries are compared in
+    order, and each differing entry is attributed to the segment of its
+    first atom in target.
+
+    Returns a PSFDiff, which is False if the files are equivalent.
+    """
+    result = PSFDiff(target.name, reference.name)
+
+    sections = list(target.counts)
+    sections += [section for section in reference.counts if not section in target.counts]
+    for section in sections:
+        target_counts = target.counts.get(section)
+        ref_counts = reference.counts.get(section)
+        if target_counts != ref_counts:
+            result.sections[section] = {'counts': (target_counts, ref_counts)}
+            continue
+        if target.raw[section] == reference.raw[section]:
+            continue
+
+        if section == 'NATOM':
+            fields = {}
+            string_diff = target.atom_strings != reference.atom_strings
+            for column, field in enumerate(ATOM_STR_COLUMNS.values()):
+                fields[field] = int(string_diff[:, column].sum())
+            charge_diff = ~np.isclose(target.charges, reference.charges,
+                    rtol=0, atol=charge_tol)
+            mass_diff = ~np.isclose(target.masses, reference.masses, rtol=0, atol=mass_tol)
+            fields['charge'] = int(charge_diff.sum())
+            fields['mass'] = int(mass_diff.sum())
+
+            mask = string_diff.any(axis=1) | charge_diff | mass_diff
+            if target.atom_extra.shape == reference.atom_extra.shape:
+                extra_diff = ~np.isclose(target.atom_extra, reference.atom_extra,
+                        rtol=0, atol=charge_tol)
+                fields['other'] = int(extra_diff.any(axis=1).sum())
+                mask |= extra_diff.any(axis=1)
+            else:
+                fields['other'] = len(mask)
+                mask[:] = True
+
+            if mask.any():
+                result.sections[section] = {
+                    'differing': int(mask.sum()),
+                    'segments': _count_by_segment(target.segids, mask),
+                    'fields': {field: count for field, count in fields.items() if count},
+                }
+            continue
+
+        target_values = target.section(section)
+        ref_values = reference.section(section)
+        if target_values.shape != ref_values.shape:
+            result.sections[section] = {'sizes': (target_values.size, ref_values.size)}
+            continue
+
+        mask = target_values != ref_values
+        if target_values.ndim == 2:
+            mask = mask.any(axis=1)
+        if not mask.any():
+            continue
+
+        info = result.sections[section] = {'differing': int(mask.sum())}
+        if target_values.ndim == 2 and section in ENTRY_WIDTHS and 'NATOM' in target.raw:
+            segids = target.segids
+            first_atoms = target_values[mask, 0] + FIRST_ATOM_OFFSETS[section]
+            valid = (first_atoms >= 0) & (first_atoms < len(segids))
+            entry_segids = segids[first_atoms[valid]]
+            info['segments'] = _count_by_segment(entry_segids,
+                    np.ones(len(entry_segids), dtype=bool))
+
+    return result
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Records what browsers see of CHARMM-GUI, and replays it offline
+
+With `run_tests.py --record DIR`, each browser process saves, for every
+test case, the page it is on each time it clicks Next and once the last
+page has loaded, along with the scripts, style sheets, and images those
+pages use, and the project archives it downloads (see Recorder).
+
+When run as a program, serves recordings made that way over HTTP (see
+ReplayHandler), so that run_tests.py can run the recorded test cases
+against it with `--replay -b http://127.0.0.1:PORT/`. Pages are replayed in the
+order they were recorded: each form submission moves a test case to its
+next page, after a delay that stands in for the server's computation.
+Requests that were not recorded, like AJAX calls, get a 404 response, so
+only test cases whose steps advance with Next can be replayed.
+
+Replayed test cases are told apart by a cookie (CASE_COOKIE) that browser
+processes set while recording, and when run_tests.py is given --replay.
+"""
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join as pjoin
+from urllib.parse import parse_qs, urljoin, urlsplit
+
+import utils
+
+# name of the cookie that identifies a test case
+CASE_COOKIE = 'autocgui_case'
+
+# extensions of static files that pages refer to
+ASSET_EXTENSIONS = ('.js', '.css', '.png', '.gif', '.jpg', '.jpeg', '.svg', '.ico',
+                    '.woff', '.woff2', '.ttf')
+
+_ASSET_REGEX = re.compile(r'''(?:src|href)\s*=\s*["']([^"'#]+)["']''', re.IGNORECASE)
+
+# stands in for pages that are never recorded
+STUB_PAGE = """<html><body><form method="post">
+<input type="text" name="email"><input type="password" name="password">
+<input type="submit" value="Submit"></form></body></html>"""
+
+def case_id(test_case):
+    """Returns the value of CASE_COOKIE for a test case"""
+    key = '{}\n{}'.format(test_case.get('module'), test_case['label'])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+class Recorder:
+    """Saves the pages of test cases to a directory
+
+    Layout of the directory:
+        {module}/{case ID}/case.json    label and list of pages, each with
+                                        its url, file, and the seconds the
+                                        server took to send it
+        {module}/{case ID}/page-N.html  the pages, in order
+        assets/{path}                   static files, by URL path
+        archives/{archive}              downloaded project archives
+
+    Usage:
+        recorder = Recorder('recordings')
+        recorder.start(test_case)
+        recorder.record_page(browser)   # before clicking Next
+        recorder.submitted()            # after clicking Next
+        recorder.loaded()               # once the next page has loaded
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.case_dir = None
+        self.case_info = None
+        self.submit_time = None
+        self.server_time = 0.
+        self.session = None
+
+    def start(self, test_case):
+        """Starts recording a new test case"""
+        self.case_dir = pjoin(self.directory, test_case.get('module') or '',
+                              case_id(test_case))
+        if os.path.isdir(self.case_dir):
+            shutil.rmtree(self.case_dir)
+        os.makedirs(self.case_dir)
+        self.case_info = {'module': test_case.get('module'), 'label': test_case['label'],
+                          'pages': []}
+        self.submit_time = None
+        self.server_time = 0.
+
+    def submitted(self):
+        """Notes that a form was just submitted"""
+        self.submit_time = time.time()
+
+    def loaded(self):
+        """Notes that the page the last form led to has loaded"""
+        if self.submit_time is not None:
+            self.server_time = time.time() - self.submit_time
+            self.submit_time = None
+
+    def record_page(self, browser):
+        """Saves the page the browser is on, and the files it uses"""
+        if self.case_info is None:
+            return
+        pages = self.case_info['pages']
+        filename = 'page-{}.html'.format(len(pages))
+        html = browser.html
+        utils.write_text_atomic(pjoin(self.case_dir, filename), html)
+        pages.append({'url': browser.url, 'file': filename, 'server_time': self.server_time})
+        self.server_time = 0.
+        utils.write_json_atomic(pjoin(self.case_dir, 'case.json'), self.case_info)
+        self.record_assets(browser.url, html)
+
+    def asset_filename(self, url):
+        """Returns where the static file at url is saved"""
+        path = urlsplit(url).path.lstrip('/')
+        return os.path.normpath(pjoin(self.directory, 'assets', path))
+
+    def record_assets(self, page_url, html):
+        """Saves the static files on page_url's host that html refers to"""
+        import requests
+
+        if self.session is None:
+            self.session = requests.Session()
+        host = urlsplit(page_url).netloc
+        for ref in set(_ASSET_REGEX.findall(html)):
+            url = urljoin(page_url, ref)
+            parts = urlsplit(url)
+            if parts.netloc != host or not parts.path.lower().endswith(ASSET_EXTENSIONS):
+                continue
+            filename = self.asset_filename(url)
+            if os.path.exists(filename):
+                continue
+            try:
+                response = self.session.get(url, timeout=30)
+                response.raise_for_status()
+            except requests.RequestException as exc:
+                print("Warning: can't record", url+':', exc, file=sys.stderr)
+                continue
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'wb') as asset:
+                asset.write(response.content)
+
+    def record_archive(self, archive, jobid):
+        """Saves the downloaded project archive of a job"""
+        archive_dir = pjoin(self.directory, 'archives')
+        os.makedirs(archive_dir, exist_ok=True)
+        shutil.copyfile(archive, pjoin(archive_dir, utils.get_archive_name(jobid)))
+
+class Recording:
+    """Recorded test cases of one directory, as used by ReplayHandler"""
+    def __init__(self, directory, delay=0., scale=0.):
+        self.directory = directory
+        self.delay = delay
+        self.scale = scale
+        self.cases = {}
+        self.cursors = {}
+        self.lock = threading.Lock()
+        for dirpath, _dirnames, filenames in os.walk(directory):
+            if 'case.json' in filenames:
+                with open(pjoin(dirpath, 'case.json')) as case_file:
+                    case_info = json.load(case_file)
+                case_info['dir'] = dirpath
+                self.cases[os.path.basename(dirpath)] = case_info
+
+    def server_time(self, page):
+        """Returns how long to wait before sending a page"""
+        return self.delay + self.scale * page.get('server_time', 0.)
+
+    def page(self, case_key, url, submitted):
+        """Returns the page to send a test case, and how long to wait first
+
+        Loading the first page of a test case starts it over; submitting a
+        form moves it to its next page; anything else gets the current page.
+        """
+        pages = self.cases[case_key]['pages']
+        with self.lock:
+            cursor = self.cursors.get(case_key, 0)
+            if submitted:
+                cursor = min(cursor + 1, len(pages) - 1)
+            elif urlsplit(url).query == urlsplit(pages[0]['url']).query:
+                cursor = 0
+            self.cursors[case_key] = cursor
+        page = pages[cursor]
+        return pjoin(self.cases[case_key]['dir'], page['file']), \
+               self.server_time(page) if submitted else 0.
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Answers requests from a Recording, set as the server's `recording`"""
+    def do_GET(self):
+        self.reply(submitted=False)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.reply(submitted=True)
+
+    def log_message(self, format, *args):
+        pass # one line per request is too much for a benchmark
+
+    def send_file(self, filename, content_type=None):
+        with open(filename, 'rb') as file_obj:
+            data = file_obj.read()
+        if content_type is None:
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, text, code=200):
+        data = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply(self, submitted):
+        recording = self.server.recording
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        doc = query.get('doc', [''])[0]
+
+        assets = pjoin(recording.directory, 'assets')
+        asset = os.path.normpath(pjoin(assets, parts.path.lstrip('/')))
+        if parts.path.lower().endswith(ASSET_EXTENSIONS):
+            if os.path.commonpath([asset, assets]) == assets and os.path.isfile(asset):
+                return self.send_file(asset)
+            return self.send_text('not recorded', 404)
+
+        if doc == 'input/download':
+            archive = utils.get_archive_name(query.get('jobid', [''])[0])
+            archive = pjoin(recording.directory, 'archives', archive)
+            if os.path.isfile(archive):
+                return self.send_file(archive, 'application/x-gzip')
+            return self.send_text('not recorded', 404)
+
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        case_key = cookie[CASE_COOKIE].value if CASE_COOKIE in cookie else None
+        if not doc or doc == 'sign' or not case_key in recording.cases:
+            return self.send_text(STUB_PAGE)
+
+        filename, delay = recording.page(case_key, self.path, submitted)
+        time.sleep(delay)
+        self.send_file(filename, 'text/html; charset=utf-8')
+
+def serve(directory, port=0, delay=0., scale=0.):
+    """Returns a server for the recordings in directory, not yet started
+
+    The server's address is server.server_address; port 0 picks a free one.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), ReplayHandler)
+    server.daemon_threads = True
+    server.recording = Recording(os.path.abspath(directory), delay=delay, scale=scale)
+    return server
+
+def _main():
+    parser = argparse.ArgumentParser(
+            description="Replay recordings made with run_tests.py --record")
+    parser.add_argument('directory', help="directory of recordings")
+    parser.add_argument('-p', '--port', type=int, default=8800,
+            help="port to listen on (default: 8800)")
+    parser.add_argument('-d', '--delay', type=float, default=0.,
+            help="seconds to wait before answering a form (default: 0)")
+    parser.add_argument('-s', '--scale', type=float, default=0.,
+            help="also wait this many times as long as the server took when "+\
+                 "recording (default: 0)")
+
+    args = parser.parse_args()
+    server = serve(args.directory, args.port, args.delay, args.scale)
+    print("Replaying {} test cases at http://127.0.0.1:{}/".format(
+        len(server.recording.cases), server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    _main()
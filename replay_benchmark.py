@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Measures how run_tests.py scales with -n, offline
+
+For each number of browser processes, runs test cases against recordings
+served by replay.py, then reports test cases per hour, the time spent per
+step filling in and submitting pages (as opposed to waiting for the
+server), and the peak memory used by each browser process.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from os.path import join as pjoin
+
+import yaml
+
+import replay
+from get_time import print_table
+from logger import events_filename
+
+# phases of a step that measure the automation rather than the server
+AUTOMATION_PHASES = 'prestep', 'handle_step', 'poststep', 'go_next'
+
+HEADER = ['threads', 'cases', 'success', 'wall', 'cases/hour', 'automation/step',
+          'wait/step', 'peak MB/process']
+
+def summarize(events):
+    """Returns a row of HEADER for the last run in an event log"""
+    run_events = []
+    with open(events) as events_file:
+        for line in events_file:
+            event = json.loads(line)
+            if event.get('event') == 'run_start':
+                run_events = []
+            run_events.append(event)
+
+    start = next(event for event in run_events if event['event'] == 'run_start')
+    end = [event for event in run_events if event['event'] == 'run_end']
+    wall = end[-1]['wall_time'] if end else run_events[-1]['time'] - start['time']
+    results = [event for event in run_events if event['event'] == 'result']
+
+    automation = []
+    waits = []
+    peaks = []
+    for result in results:
+        for timing in result.get('timings', []):
+            automation.append(sum(timing.get(phase, 0.) for phase in AUTOMATION_PHASES))
+            waits.append(timing.get('wait', 0.) + timing.get('final_wait', 0.))
+        if 'memory' in result:
+            peaks.append(result['memory']['peak'])
+
+    mean = lambda values: sum(values) / len(values) if values else float('nan')
+    successes = sum(result['result'] == 'success' for result in results)
+    return [start['num_threads'], len(results), successes, wall,
+            len(results) / wall * 3600 if wall > 0 else float('nan'),
+            mean(automation), mean(waits), max(peaks, default=float('nan'))]
+
+def run_benchmark(recordings, num_threads, run_args, config, log_dir, delay=0.,
+                  scale=0.):
+    """Runs run_tests.py against a replay server and returns a row of HEADER"""
+    server = replay.serve(recordings, delay=delay, scale=scale)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    config = dict(config)
+    for key in ('CGUSER', 'CGPASS', 'USER', 'PASS'):
+        config.pop(key, None)
+    config['BASE_URL'] = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    config['BROWSER_HEADLESS'] = True
+    config_file = pjoin(log_dir, 'config.yml')
+    with open(config_file, 'w') as config_obj:
+        yaml.dump(config, config_obj)
+
+    logfile = pjoin(log_dir, 'results-n{}.log'.format(num_threads))
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        subprocess.run([sys.executable, pjoin(here, 'run_tests.py'), '--config', config_file,
+                        '-l', logfile, '-n', str(num_threads), '--replay'] + run_args,
+                       cwd=here)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return summarize(events_filename(logfile))
+
+def _main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark run_tests.py against recordings made with --record")
+    parser.add_argument('recordings', help="directory of recordings")
+    parser.add_argument('-m', '--modules', nargs='+', required=True, metavar='MODULE',
+            help="modules to test, as for run_tests.py")
+    parser.add_argument('-t', '--test-name',
+            help="test cases to run, as for run_tests.py")
+    parser.add_argument('-n', '--num-threads', type=int, nargs='+', default=[1, 2, 4],
+            metavar='N', help="numbers of browser processes to try (default: 1 2 4)")
+    parser.add_argument('-d', '--delay', type=float, default=0.,
+            help="seconds the replay server waits before answering a form")
+    parser.add_argument('-s', '--scale', type=float, default=0.,
+            help="also wait this many times as long as the server took when recording")
+    parser.add_argument('--config', default='config.yml', metavar='PATH',
+            help="configuration to take browser settings from (default: config.yml)")
+    parser.add_argument('-o', '--output', metavar='PATH',
+            help="also write the results to PATH as JSON")
+    parser.add_argument('--log-dir', metavar='PATH',
+            help="directory for results logs (default: a new temporary directory)")
+
+    args = parser.parse_args()
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config) as config_file:
+            config = yaml.safe_load(config_file) or {}
+
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='replay-benchmark-')
+    os.makedirs(log_dir, exist_ok=True)
+
+    run_args = ['-m'] + args.modules
+    if args.test_name:
+        run_args += ['-t', args.test_name]
+
+    rows = []
+    for num_threads in args.num_threads:
+        rows.append(run_benchmark(args.recordings, num_threads, run_args, config, log_dir,
+                                  delay=args.delay, scale=args.scale))
+
+    print_table(HEADER, rows)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump([dict(zip(HEADER, row)) for row in rows], output, indent=2)
+
+if __name__ == '__main__':
+    _main()
@@ -6,7 +6,7 @@ import os
 import sys
 
 # auto_cgui imports
-from logger import parse_logfile
+from logger import read_results
 from utils import warn, read_yaml
 
 # module alias (case-insensitive): base filename
@@ -47,7 +47,7 @@ if not os.path.exists(LOGFILE):
     warn(f"Error: No such file: '{LOGFILE}'")
     sys.exit(1)
 
-sys_info = parse_logfile(LOGFILE)
+sys_info = read_results(LOGFILE)
 for module, jobs in sys_info.items():
     if modules != ['all'] and module not in modules:
         continue
@@ -11,13 +11,14 @@ from os.path import join as pjoin
 import yaml
 
 # auto_cgui imports
+import plan
+import scheduler
 import utils
-from browser_manager import BrowserManager
 from utils import warn
 
 if __name__ == '__main__':
-    # module alias (case-insensitive): base filename
-    cgui_modules = utils.read_yaml('modules.yml')
+    # module alias (case-insensitive): (base filename, class name)
+    cgui_modules = utils.read_module_registry('modules.yml')
 
     parser = argparse.ArgumentParser(
             description="Test a C-GUI project by simulating browser interactions")
@@ -28,6 +29,21 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--num-threads', type=int, default=1,
             metavar="N",
             help="Number of parallel threads to spawn for testing (default: 1)")
+    parser.add_argument('-j', '--server-jobs', type=int, metavar="N",
+            help="Most test cases to have a job running on the server at "+\
+                 "once; with -n larger than N, the other processes prepare "+\
+                 "forms or process results meanwhile (default: same as -n)")
+    parser.add_argument('--host-slots', metavar="PATH",
+            help="Directory of lock files shared by all runs on this host, "+\
+                 "to limit their total number of jobs on the server; uses "+\
+                 "HOST_SLOT_DIR in config by default")
+    parser.add_argument('--host-jobs', type=int, metavar="N",
+            help="(--host-slots modifier) most jobs on the server from all runs "+\
+                 "on this host; uses HOST_JOBS in config by default, or 4")
+    parser.add_argument('-V', '--num-validators', type=int,
+            default=min(4, os.cpu_count() or 1), metavar="N",
+            help="Number of processes that validate finished projects "+\
+                 "(default: number of CPUs, up to 4)")
     parser.add_argument('-i', '--interactive', action='store_true',
             help="Accept commands interactively when complete or on error")
     parser.add_argument('-e', '--errors-only', action='store_true',
@@ -38,10 +54,28 @@ if __name__ == '__main__':
     parser.add_argument('-b', '--base-url', metavar="URL",
             default='http://charmm-gui.org/',
             help="Web address to CHARMM-GUI (default: http://charmm-gui.org/)")
+    parser.add_argument('--headless', action='store_true',
+            help="Run browsers without opening any windows; uses value "+\
+                 "stored in config by default")
     parser.add_argument('--copy', action='store_true',
-            help="For tests on localhost, run solvent tests by cloning the "+\
-                 "project at the solvent test's branch point; saves time, "+\
+            help="For tests on localhost, run the steps that test cases "+\
+                 "have in common once, and clone the project where they part "+\
+                 "(e.g., at a solvent test's branch point); saves time, "+\
                  "but can cause errors if the request cache is corrupted")
+    parser.add_argument('--snapshots', metavar="PATH",
+            help="For tests on localhost, keep snapshots of projects in PATH "+\
+                 "and start test cases from the latest step a previous run "+\
+                 "reached with the same inputs and server code; uses "+\
+                 "SNAPSHOT_DIR in config by default")
+    parser.add_argument('--snapshot-budget', type=float, metavar="GB",
+            help="(--snapshots modifier) most disk space to use for "+\
+                 "snapshots; uses SNAPSHOT_BUDGET in config by default, or 20")
+    parser.add_argument('--record', metavar="PATH",
+            help="Save the pages, static files, and archives that browsers "+\
+                 "see to PATH, for replay.py to serve")
+    parser.add_argument('--replay', action='store_true',
+            help="The server is replay.py; tell it which test case each "+\
+                 "browser is running")
     parser.add_argument('-l', '--logfile', default='results.log')
     parser.add_argument('--config', type=argparse.FileType('r'),
             default="config.yml", metavar="PATH",
@@ -51,6 +85,9 @@ if __name__ == '__main__':
                  "cases after preprocessing")
     parser.add_argument('--validate-only', action='store_true',
             help="Reads logfile and attempts to infer and validate PSFs of all logged test cases")
+    parser.add_argument('--extract', action='store_true',
+            help="(--validate-only modifier) extract whole project archives "+\
+                 "instead of reading only the PSF to validate from them")
     parser.add_argument('-s', '--skip-success', action='store_true',
             help="Don't repeat tests that have already succeeded")
     parser.add_argument('-d', '--skip-done', action='store_true',
@@ -70,14 +107,14 @@ if __name__ == '__main__':
         if not os.path.exists(LOGFILE):
             warn("Can't validate: logfile ({}) does not exist".format(LOGFILE))
 
-        from logger import Logger, parse_logfile
-        sys_info = parse_logfile(LOGFILE)
+        from logger import Logger, read_results
+        sys_info = read_results(LOGFILE)
     else:
         if os.path.exists(LOGFILE):
             warn("Appending to existing logfile:", LOGFILE)
 
-            from logger import parse_logfile
-            sys_info = parse_logfile(LOGFILE)
+            from logger import read_results
+            sys_info = read_results(LOGFILE)
         else:
             warn("Creating new logfile:", LOGFILE)
             sys_info = {}
@@ -105,6 +142,7 @@ if __name__ == '__main__':
     if 'BROWSER_TYPE' in CONFIG:
         BROWSER_TYPE = CONFIG['BROWSER_TYPE']
     settings['browser_type'] = BROWSER_TYPE
+    settings['headless'] = args.headless or bool(CONFIG.get('BROWSER_HEADLESS'))
 
     # validate WWW_DIR as a directory
     WWW_DIR = args.www_dir
@@ -121,6 +159,21 @@ if __name__ == '__main__':
             raise ValueError(WWW_DIR+" is not a directory")
     settings['www_dir'] = WWW_DIR
 
+    # snapshots are only valid for the server code they were made with
+    SNAPSHOT_DIR = args.snapshots or CONFIG.get('SNAPSHOT_DIR')
+    SERVER_REVISION = None
+    if SNAPSHOT_DIR and not args.dry_run:
+        if WWW_DIR is None:
+            warn("Warning: snapshots need WWW_DIR; not using snapshots")
+        elif not 'SERVER_REVISION' in CONFIG:
+            warn("Warning: snapshots need SERVER_REVISION in "+args.config.name+\
+                 "; not using snapshots")
+        else:
+            from snapshot_cache import SnapshotCache, server_revision
+            SERVER_REVISION = server_revision(CONFIG['SERVER_REVISION'])
+            budget = args.snapshot_budget or CONFIG.get('SNAPSHOT_BUDGET', 20)
+            settings['snapshots'] = SnapshotCache(SNAPSHOT_DIR, int(budget * 1024**3))
+
     if not args.modules:
         if not 'MODULE' in CONFIG:
             raise KeyError('Missing C-GUI module name, either use -m opt '+\
@@ -148,30 +201,31 @@ if __name__ == '__main__':
 
             args.modules = cgui_modules
 
+    # test cases from every module share one pool of browser processes
+    process_types = {}
+    graph = scheduler.CaseGraph()
+
     test_cases = []
     for MODULE_NAME in args.modules:
         MODULE_NAME = MODULE_NAME.upper()
         if not MODULE_NAME in cgui_modules:
             raise ValueError('Unknown C-GUI module: '+MODULE_NAME)
-        MODULE_FILE = cgui_modules[MODULE_NAME]
+        MODULE_FILE, CLASS_NAME = cgui_modules[MODULE_NAME]
         cgui_module = MODULE_NAME.lower()
-        settings['module'] = cgui_module
 
         # import relevant names from the module file
         module = import_module(MODULE_FILE)
         init_module = getattr(module, 'init_module', None)
 
-        # to avoid ambiguity, class name should be provided in module file
-        BrowserProcess = getattr(module, '_BROWSER_PROCESS')
-        BrowserProcess = getattr(module, BrowserProcess)
+        # to avoid ambiguity, class name should be provided in modules.yml
+        # or in the module file
+        BrowserProcess = getattr(module, CLASS_NAME or module._BROWSER_PROCESS)
 
         # look for a test case in a standard order
         file_tests = 'standard', 'minimal', 'full'
         if args.test_name and not args.test_name in file_tests:
             TEST_CASE_PATH = pjoin('test_cases', cgui_module, args.test_name+'.yml')
-
-            # test cases from this module before (pre-) custom option setup
-            pre_test_cases = utils.read_yaml(TEST_CASE_PATH)
+            test_paths = [TEST_CASE_PATH]
         else:
             file_order = 'full', 'standard', 'minimal'
             test_name = args.test_name or 'standard'
@@ -201,15 +255,11 @@ if __name__ == '__main__':
                         continue
                 test_files = [BASIC_FILE]
 
-            # get all test cases from filenames
-            pre_test_cases = []
-            for test_file in test_files:
-                test_file = utils.find_test_file(test_file, module=cgui_module)
-                test_cases = utils.read_yaml(test_file)
-                pre_test_cases.extend(test_cases)
+            test_paths = [utils.find_test_file(test_file, module=cgui_module)
+                          for test_file in test_files]
 
-        base_cases = [utils.setup_custom_options(test_case, cgui_module)
-                      for test_case in pre_test_cases]
+        # test cases from all files, with custom options set up
+        base_cases = plan.get_compiler().compile(cgui_module, test_paths)
 
         # check for duplicate labels, which make debugging very difficult
         labels = []
@@ -224,10 +274,13 @@ if __name__ == '__main__':
             sys.exit(1)
         del labels, duplicates
 
+        # init_module may return a scheduler.CaseGraph, or (base, wait) cases
         if callable(init_module):
-            base_cases, wait_cases = init_module(base_cases, args)
+            module_graph = init_module(base_cases, args)
         else:
-            wait_cases = {}
+            module_graph = base_cases
+        module_graph = scheduler.CaseGraph.from_plan(module_graph, cgui_module)
+        base_cases = module_graph.cases()
 
         if args.skip_success or args.skip_done:
             module_info = sys_info.get(cgui_module, {})
@@ -235,7 +288,7 @@ if __name__ == '__main__':
             while case_no < len(base_cases):
                 case = base_cases[case_no]
                 if args.skip_done:
-                    base_cases.pop(case_no)
+                    module_graph.discard(scheduler.case_key(base_cases.pop(case_no)))
                 elif case_log := module_info.pop(case['label'], None):
                     if step := case_log['step']:
                         step = int(step)
@@ -249,20 +302,24 @@ if __name__ == '__main__':
                             print(f"restarting '{case['label']}'")
                     else:
                         print(f"skipping completed job: '{case['label']}")
-                        base_cases.pop(case_no)
+                        module_graph.discard(scheduler.case_key(base_cases.pop(case_no)))
                 else:
                     case_no += 1
 
-        if not base_cases and not wait_cases:
+        if not base_cases:
             print("nothing to do for", cgui_module)
             continue
 
-        if args.validate_only:
-            if wait_cases:
-                # processing the wait cases is too complicated and rare for now
-                warn("Warning: wait_cases can only be checked at their "+\
-                     "original runtime; skipping ...")
+        if SERVER_REVISION is not None:
+            plan.set_snapshot_keys(base_cases, SERVER_REVISION)
+
+        # on localhost, steps that test cases have in common are run once
+        if args.copy and 'localhost' in BASE_URL.lower() and not args.validate_only:
+            saved = plan.share_step_prefixes(module_graph)
+            if saved:
+                print("sharing steps of", cgui_module, "saves", saved, "steps")
 
+        if args.validate_only:
             module_info = sys_info[cgui_module]
 
             # log messages directly to stdout
@@ -279,29 +336,48 @@ if __name__ == '__main__':
                 test_case['jobid'] = case_info['jobid']
 
                 result = utils.validate_test_case(test_case, case_info['dirname'],
-                        sys_archive=case_info['archive'],
-                        module=cgui_module)
+                        sys_archive=case_info.get('archive'),
+                        module=cgui_module,
+                        extract=args.extract)
 
                 logger.log_result(result)
         else:
-            print("starting", cgui_module)
-            settings['dry_run'] = args.dry_run
-            settings['interactive'] = args.interactive
-            settings['errors_only'] = args.errors_only
-
-            # set max threads to higher of number of jobs and CLI argument
-            num_threads = len(base_cases) + len(wait_cases)
-            if num_threads > args.num_threads:
-                num_threads = args.num_threads
-
-            # sets up multiprocessing info
-            manager = BrowserManager(BrowserProcess, LOGFILE, num_threads, **settings)
-
-            # initializes the other threads
-            manager.start()
-
-            # runs test-case event loop
-            manager.run(base_cases, wait_cases)
-
-            # blocks until all BrowserProcesses terminate
-            manager.stop()
+            print("queueing", cgui_module)
+            process_types[cgui_module] = BrowserProcess
+
+            graph.merge(module_graph)
+
+    if process_types:
+        settings['dry_run'] = args.dry_run
+        settings['interactive'] = args.interactive
+        settings['errors_only'] = args.errors_only
+        settings['record_dir'] = args.record
+        settings['replay'] = args.replay
+
+        # set max threads to lower of number of jobs and CLI argument
+        num_threads = len(graph)
+        if num_threads > args.num_threads:
+            num_threads = args.num_threads
+
+        # start the longest test cases first, going by past runs
+        from logger import events_filename
+        if os.path.exists(LOGFILE) or os.path.exists(events_filename(LOGFILE)):
+            from get_time import History, estimate_durations
+            graph.set_durations(*estimate_durations(History(LOGFILE)))
+
+        # sets up multiprocessing info
+        from browser_manager import BrowserManager
+        manager = BrowserManager(process_types, LOGFILE, num_threads,
+                num_validators=args.num_validators,
+                server_jobs=args.server_jobs,
+                host_slot_dir=args.host_slots or CONFIG.get('HOST_SLOT_DIR'),
+                host_jobs=args.host_jobs or CONFIG.get('HOST_JOBS', 4), **settings)
+
+        # initializes the other threads
+        manager.start()
+
+        # runs test-case event loop
+        manager.run(graph)
+
+        # blocks until all BrowserProcesses terminate
+        manager.stop()
@@ -26,6 +26,9 @@ parser.add_argument('--ref', nargs=1, metavar='filename',
         help="name of source reference file (default: step1_pdbreader.psf")
 parser.add_argument('-o', '--output', type=directory,
         help="output directory in which to place reference files")
+parser.add_argument('--extract', action='store_true',
+        help="extract whole project archives instead of reading only the "+\
+             "reference file from them")
 parser.add_argument('results_file', nargs='?',
         type=argparse.FileType('r'), default='results.log',
         help="log file containing testing results (default: 'results.log')")
@@ -33,7 +36,7 @@ parser.add_argument('results_file', nargs='?',
 args = parser.parse_args()
 results = None
 with args.results_file as fh:
-    results = logger.parse_logfile(args.results_file)
+    results = logger.read_results(args.results_file.name)
 
 if results:
     for module, cases in results.items():
@@ -42,13 +45,17 @@ if results:
 
             ref_dir = 'charmm-gui-'+jobid
             ref_archive = ref_dir+'.tgz'
+            from_archive = False
             if os.path.exists(ref_dir):
                 if not os.path.isdir(ref_dir):
                     ERRMSG = "Warning: '{}' exists but is not a directory; skipping"
                     print(ERRMSG.format(ref_dir), file=sys.stderr)
                     continue
             elif os.path.exists(ref_archive):
-                shutil.unpack_archive(ref_archive)
+                if args.extract:
+                    shutil.unpack_archive(ref_archive)
+                else:
+                    from_archive = True
             else:
                 ERRMSG = "Warning: couldn't find '{}'; skipping"
                 print(ERRMSG.format(ref_archive), file=sys.stderr)
@@ -63,6 +70,17 @@ if results:
             else:
                 dest = os.path.join('files', 'references', module, ref_filename)
 
+            if from_archive:
+                data = utils.read_archive_member(ref_archive, src)
+                if data is None:
+                    print("Skipping nonexistent file:", ref_archive+':'+src)
+                    continue
+
+                print('copying', ref_archive+':'+src, '->', dest)
+                with open(dest, 'wb') as dest_file:
+                    dest_file.write(data)
+                continue
+
             if not os.path.exists(src):
                 print("Skipping nonexistent file:", src)
                 continue
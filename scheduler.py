@@ -0,0 +1,379 @@
+"""Schedules test cases that depend on each other
+
+A CaseGraph holds test cases and the prerequisites each must wait for. A
+test case can start once each of its prerequisites has either
+    - finished without error ('done' requirements), or
+    - sent CONTINUE, usually after copying its project ('continue'
+      requirements; see CGUIBrowserProcess.copy_dir()).
+
+Test cases may declare prerequisites in their YAML with `requires`, a list
+of labels of test cases in the same module. A label that ends with '*'
+stands for every test case whose label starts with the rest of it:
+    - label: membrane with ions
+      requires:
+        - membrane only
+        - "protein in *"
+
+Ready test cases are started in order of decreasing `priority` (default
+0), then of decreasing length of the longest chain of test cases that
+depend on them (the critical path), so that long chains start first. With
+durations estimated from past runs (see set_durations()), independent test
+cases start longest first, so that a long test case does not start last
+and hold up the end of a run.
+"""
+import heapq
+
+DONE = 'done'
+CONTINUE = 'continue'
+
+def case_key(test_case):
+    """Returns the key of a test case in a CaseGraph"""
+    return test_case.get('module'), test_case['label']
+
+class CaseGraph:
+    """A dependency graph of test cases
+
+    Usage:
+        graph = CaseGraph()
+        graph.add(base_case)
+        graph.add(other_case, requires={case_key(base_case): CONTINUE},
+                  prepare=resume_from_copy)
+        graph.finalize()
+
+        while graph:
+            for test_case in graph.pop_ready(): ...
+            graph.release(key, done_case)     # on CONTINUE
+            graph.finish(key, done_case, ok)  # on a final result
+
+    `prepare`, if given, is called as prepare(test_case, prerequisite_case)
+    when a CONTINUE requirement is released, e.g. to point the test case at
+    its prerequisite's copied project.
+
+    A test case that sends CONTINUE more than once, at several branching
+    points, tells them apart with a `branch` (see copy_dir()); a test case
+    added with a branch waits for a CONTINUE with the same branch, or for
+    one without a branch.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.ready = []
+        self.order = 0
+        self.durations = {}
+        self.default_durations = {}
+        self.fallback_duration = 1.
+
+    def __len__(self):
+        """Number of test cases without a final result"""
+        return len(self.nodes)
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    @classmethod
+    def from_plan(cls, plan, module):
+        """Returns a graph of the test cases in `plan`
+
+        Parameters
+        ==========
+            plan    one of:
+                        - a list of test cases with no dependencies
+                        - a 2-tuple (base_cases, wait_cases), where
+                          wait_cases maps the label of a base case to test
+                          cases to start when it sends CONTINUE
+                        - a CaseGraph
+            module  name of the module the test cases belong to
+        """
+        if isinstance(plan, CaseGraph):
+            # the graph may have been built before test cases had a module
+            graph = plan
+            new_keys = {}
+            for key, node in graph.nodes.items():
+                node['case']['module'] = module
+                new_keys[key] = case_key(node['case'])
+            graph.nodes = {new_keys[key]: node for key, node in graph.nodes.items()}
+            for node in graph.nodes.values():
+                node['requires'] = {new_keys.get(key, key): kind
+                                    for key, kind in node['requires'].items()}
+            return graph
+
+        graph = cls()
+        if isinstance(plan, tuple):
+            base_cases, wait_cases = plan
+        else:
+            base_cases, wait_cases = plan, {}
+
+        for test_case in base_cases:
+            test_case['module'] = module
+            graph.add(test_case)
+        for label, test_cases in wait_cases.items():
+            for test_case in test_cases:
+                test_case['module'] = module
+                graph.add(test_case, requires={(module, label): CONTINUE})
+        return graph
+
+    def add(self, test_case, requires=None, prepare=None, priority=None, branch=None):
+        """Adds a test case
+
+        Parameters
+        ==========
+            test_case  dict  the test case
+            requires   dict  {key of prerequisite: DONE or CONTINUE}
+            prepare    func  see class docstring
+            priority   int   overrides test_case's 'priority'
+            branch           branch of the CONTINUE requirements to wait for
+        """
+        key = case_key(test_case)
+        if key in self.nodes:
+            raise ValueError("duplicate test case: {}".format(key))
+        if priority is None:
+            priority = test_case.get('priority', 0)
+        self.nodes[key] = {
+            'case': test_case,
+            'requires': dict(requires or {}),
+            'prepare': prepare,
+            'priority': priority,
+            'branch': branch,
+            'resolved': False,
+            'order': self.order,
+            'started': False,
+        }
+        self.order += 1
+
+    def merge(self, other):
+        """Adds all test cases of another graph"""
+        for key, node in other.nodes.items():
+            if key in self.nodes:
+                raise ValueError("duplicate test case: {}".format(key))
+            node['order'] = self.order
+            self.order += 1
+            self.nodes[key] = node
+
+    def cases(self):
+        """Returns a list of all test cases, in the order they were added"""
+        nodes = sorted(self.nodes.values(), key=lambda node: node['order'])
+        return [node['case'] for node in nodes]
+
+    def discard(self, key):
+        """Removes a test case that does not need to run
+
+        Test cases that require it no longer wait for it. A test case that
+        needed it to CONTINUE also forgets how to resume from it, and
+        starts from the beginning instead.
+        """
+        del self.nodes[key]
+        for node in self.nodes.values():
+            if node['requires'].pop(key, None) == CONTINUE:
+                node['prepare'] = None
+
+    def require(self, key, required, kind, prepare=None, branch=None):
+        """Makes the test case `key` wait for `required`
+
+        `prepare` and `branch` replace those given to add(); see the class
+        docstring. Must be called before finalize().
+        """
+        node = self.nodes[key]
+        node['requires'][required] = kind
+        node['prepare'] = prepare
+        node['branch'] = branch
+
+    def independent_cases(self):
+        """Returns test cases that neither require nor are required by another"""
+        self._resolve_requirements()
+        required = {key for node in self.nodes.values() for key in node['requires']}
+        return [node['case'] for key, node in sorted(self.nodes.items(),
+                                                     key=lambda item: item[1]['order'])
+                if not node['requires'] and not key in required]
+
+    def _resolve_requirements(self):
+        """Adds DONE requirements declared by test cases' `requires`"""
+        labels = {}
+        for module, label in self.nodes:
+            labels.setdefault(module, []).append(label)
+
+        for (module, label), node in self.nodes.items():
+            if node['resolved']:
+                continue
+            node['resolved'] = True
+            for required in node['case'].get('requires', []):
+                if required.endswith('*'):
+                    prefix = required[:-1]
+                    matches = [other for other in labels.get(module, [])
+                               if other.startswith(prefix) and other != label]
+                else:
+                    matches = [required] if required in labels.get(module, []) else []
+
+                if not matches:
+                    print("Warning: '{}' requires '{}', which is not scheduled; ignoring".format(
+                        label, required))
+                for other in matches:
+                    node['requires'].setdefault((module, other), DONE)
+
+    def _dependents(self):
+        dependents = {key: [] for key in self.nodes}
+        for key, node in self.nodes.items():
+            for required in node['requires']:
+                if required in dependents:
+                    dependents[required].append(key)
+                else:
+                    print("Warning: {} requires {}, which is not scheduled; ignoring".format(
+                        key, required))
+        return dependents
+
+    def estimate(self, key):
+        """Returns the estimated duration of a test case in seconds
+
+        A test case without a known duration takes the default of its
+        module, or else the median of all known durations. Unless
+        set_durations() was called, every test case lasts 1, so the critical
+        path is the longest chain of test cases.
+        """
+        duration = self.durations.get(key)
+        if duration is None:
+            duration = self.default_durations.get(key[0], self.fallback_duration)
+        return duration
+
+    def set_durations(self, durations, defaults=None):
+        """Sets estimated durations
+
+        Parameters
+        ==========
+            durations  dict  {key: seconds}
+            defaults   dict  {module: seconds} for test cases not in durations
+        """
+        self.durations = durations
+        self.default_durations = defaults or {}
+        known = sorted(durations.values()) or sorted(self.default_durations.values())
+        self.fallback_duration = known[len(known) // 2] if known else 1.
+
+    def predict_wall_time(self, num_workers):
+        """Returns the estimated wall time of running the graph
+
+        Simulates num_workers processes that each start the best ready test
+        case as soon as they are free. Test cases waiting for a CONTINUE are
+        assumed to wait for their prerequisite to finish, so the estimate
+        is high for graphs that clone projects. Must be called after
+        finalize() and before any test case has started.
+        """
+        waiting = {key: len(node['requires']) for key, node in self.nodes.items()}
+        ready = list(self.ready)
+        heapq.heapify(ready)
+        running = []
+        now = 0.
+        while ready or running:
+            while ready and len(running) < num_workers:
+                key = heapq.heappop(ready)[-1]
+                node = self.nodes[key]
+                heapq.heappush(running, (now + self.estimate(key), node['order'], key))
+            now, _order, key = heapq.heappop(running)
+            for dependent in self.dependents[key]:
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    node = self.nodes[dependent]
+                    heapq.heappush(ready, (-node['priority'], -node['rank'], node['order'],
+                                           dependent))
+        return now
+
+    def finalize(self):
+        """Resolves declared requirements and ranks test cases
+
+        Must be called once all test cases are added, and before the first
+        call to pop_ready(). Raises ValueError if requirements form a cycle.
+        """
+        self._resolve_requirements()
+        self.dependents = dependents = self._dependents()
+        for node in self.nodes.values():
+            node['requires'] = {key: kind for key, kind in node['requires'].items()
+                                if key in self.nodes}
+
+        # the rank of a test case is the duration of the longest path from
+        # its start to the end of the last test case that depends on it
+        rank = {}
+        visiting = set()
+        def get_rank(key):
+            if key in rank:
+                return rank[key]
+            if key in visiting:
+                raise ValueError("test case requirements form a cycle at {}".format(key))
+            visiting.add(key)
+            longest = max(map(get_rank, dependents[key]), default=0.)
+            visiting.discard(key)
+            rank[key] = self.estimate(key) + longest
+            return rank[key]
+
+        for key, node in self.nodes.items():
+            node['rank'] = get_rank(key)
+            if not node['requires']:
+                self._push(key)
+
+    def _push(self, key):
+        node = self.nodes[key]
+        heapq.heappush(self.ready, (-node['priority'], -node['rank'], node['order'], key))
+
+    def pop_ready(self, limit=None):
+        """Marks up to `limit` ready test cases as started and returns them"""
+        started = []
+        while self.ready and (limit is None or len(started) < limit):
+            key = heapq.heappop(self.ready)[-1]
+            node = self.nodes[key]
+            node['started'] = True
+            started.append(node['case'])
+        return started
+
+    def has_ready(self):
+        """Whether any test case can be started now"""
+        return bool(self.ready)
+
+    def _satisfy(self, key, kind, done_case, branch=None):
+        """Removes requirements of `kind` on key, and queues ready cases"""
+        for dependent in self.dependents.get(key, []):
+            node = self.nodes[dependent]
+            if node['requires'].get(key) != kind:
+                continue
+            if branch is not None and node['branch'] not in (None, branch):
+                continue
+            del node['requires'][key]
+            if kind == CONTINUE and node['prepare']:
+                node['prepare'](node['case'], done_case)
+            if not node['requires']:
+                self._push(dependent)
+
+    def release(self, key, done_case, branch=None):
+        """Starts test cases waiting for key to CONTINUE at `branch`"""
+        if key in self.nodes:
+            self._satisfy(key, CONTINUE, done_case, branch)
+
+    def finish(self, key, done_case, success):
+        """Records a test case's final result
+
+        Returns
+        =======
+            list of (test case, reason) for test cases that can no longer
+            run because this test case (or one of their other
+            prerequisites) failed, or finished without sending CONTINUE.
+            They are removed from the graph.
+        """
+        if not key in self.nodes:
+            return []
+
+        self.nodes.pop(key)
+        if success:
+            self._satisfy(key, DONE, done_case)
+
+        # anything still waiting for key now waits forever
+        cancelled = []
+        stack = [key]
+        while stack:
+            failed_key = stack.pop()
+            for dependent in self.dependents.get(failed_key, []):
+                if not dependent in self.nodes:
+                    continue
+                kind = self.nodes[dependent]['requires'].get(failed_key)
+                if kind is None:
+                    continue
+                if kind == CONTINUE and success and failed_key == key:
+                    reason = "{} finished without reaching its branching point".format(key)
+                else:
+                    reason = "prerequisite {} did not finish".format(key)
+                cancelled.append((self.nodes.pop(dependent)['case'], reason))
+                stack.append(dependent)
+        return cancelled
@@ -0,0 +1,159 @@
+"""Keeps snapshots of localhost projects across runs
+
+A snapshot is a copy of a project's directory in WWW_DIR as it was when
+the page of one of its steps had loaded. It is stored under a key that
+hashes the server's code revision and everything the test case did before
+that page (see plan.set_snapshot_keys()), so a later run that would do the
+same can start from a copy of the snapshot instead. Snapshots are evicted
+least recently used first once they take more than the cache's budget.
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+import uuid
+from os.path import join as pjoin
+
+import clone
+import utils
+
+def server_revision(setting):
+    """Returns a token that changes whenever the server's code does
+
+    `setting` is either the token itself or the path of a git checkout of
+    the server, whose commit and uncommitted changes make up the token.
+    """
+    setting = str(setting)
+    if not os.path.isdir(setting):
+        return setting
+    git = ['git', '-C', setting]
+    commit = subprocess.check_output(git + ['rev-parse', 'HEAD']).decode().strip()
+    changes = subprocess.check_output(git + ['diff', 'HEAD'])
+    if changes:
+        commit += '+' + hashlib.sha1(changes).hexdigest()[:12]
+    return commit
+
+class SnapshotCache:
+    """Snapshots of projects in a directory
+
+    Layout of the directory:
+        {key}/project/      the project's files
+        {key}/meta.json     the project's job ID, step, and size; its mtime
+                            is the last time the snapshot was used
+
+    A snapshot appears atomically once complete, so several runs may share
+    a directory. Usage:
+        cache = SnapshotCache('/var/tmp/cgui-snapshots', 20 * 1024**3)
+        cache.save(key, project_dir, jobid, step)
+        restored = cache.restore(keys, www_dir)
+    """
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+
+    def meta_filename(self, key):
+        """Returns the name of the metadata file of a snapshot"""
+        return pjoin(self.directory, key, 'meta.json')
+
+    def has(self, key):
+        """Whether a complete snapshot is stored under key"""
+        return os.path.exists(self.meta_filename(key))
+
+    def save(self, key, project_dir, jobid, step):
+        """Stores a snapshot of project_dir, unless key already has one
+
+        Returns
+        =======
+            clone.clone_tree() stats, or None if nothing was stored
+        """
+        if self.has(key):
+            return None
+        tmp_dir = pjoin(self.directory, '.tmp-{}'.format(uuid.uuid4().hex))
+        try:
+            os.mkdir(tmp_dir)
+            # no hard links, so a snapshot never shares an inode with a project
+            stats = clone.clone_tree(project_dir, pjoin(tmp_dir, 'project'), immutable=())
+            size = stats['reflinked'] + stats['linked'] + stats['copied']
+            utils.write_json_atomic(pjoin(tmp_dir, 'meta.json'),
+                    {'jobid': str(jobid), 'step': step, 'size': size, 'time': time.time()})
+            os.rename(tmp_dir, pjoin(self.directory, key))
+        except OSError:
+            # e.g., another run stored the same snapshot first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+        self.evict()
+        return stats
+
+    def restore(self, keys, www_dir, max_step=None):
+        """Copies the deepest snapshot among keys to a new project in www_dir
+
+        Parameters
+        ==========
+            keys      list  keys[i] is the key of the page of step i+1
+            www_dir   str   directory of projects
+            max_step  int   don't restore past this step
+
+        Returns
+        =======
+            (job ID of the new project, step), or None if there is no
+            snapshot to restore
+        """
+        for index in reversed(range(len(keys))):
+            step = index + 1
+            if max_step is not None and step > max_step:
+                continue
+            key = keys[index]
+            if not self.has(key):
+                continue
+            dst = None
+            try:
+                with open(self.meta_filename(key)) as meta_file:
+                    meta = json.load(meta_file)
+                jobid = '{}_s{}_{}'.format(meta['jobid'], step, uuid.uuid4().hex[:8])
+                dst = pjoin(www_dir, jobid)
+                clone.clone_tree(pjoin(self.directory, key, 'project'), dst, immutable=())
+                os.utime(self.meta_filename(key))
+            except (OSError, ValueError, KeyError):
+                # evicted while it was being copied
+                if dst:
+                    shutil.rmtree(dst, ignore_errors=True)
+                continue
+            return jobid, step
+        return None
+
+    def evict(self):
+        """Removes least recently used snapshots until they fit the budget"""
+        snapshots = []
+        for key in os.listdir(self.directory):
+            if key.startswith('.'):
+                # left behind by a run that was killed while saving
+                path = pjoin(self.directory, key)
+                try:
+                    if os.stat(path).st_mtime < time.time() - 86400:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(self.meta_filename(key)) as meta_file:
+                    size = json.load(meta_file)['size']
+                used = os.stat(self.meta_filename(key)).st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            snapshots.append((used, size, key))
+
+        total = sum(size for _used, size, _key in snapshots)
+        for _used, size, key in sorted(snapshots):
+            if total <= self.budget:
+                break
+            # vanish at once, so that nobody restores a partial snapshot
+            doomed = pjoin(self.directory, '.del-{}'.format(uuid.uuid4().hex))
+            try:
+                os.rename(pjoin(self.directory, key), doomed)
+            except OSError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+            total -= size
@@ -2,10 +2,10 @@
 import time
 from pdb_reader import PDBBrowserProcess
 from input_generator import InputBrowserProcess
-from utils import read_yaml, set_elem_value, set_form_value
+from utils import load_config, set_elem_value, set_form_value
 
 _BROWSER_PROCESS = 'SolutionBrowserProcess'
-_ions_menu = read_yaml('custom_ions_menu.yml')['charmm']
+_ions_menu = load_config('custom_ions_menu.yml')['charmm']
 
 class SolutionBrowserProcess(PDBBrowserProcess, InputBrowserProcess):
     """Implements selection of solution settings"""
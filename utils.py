@@ -1,13 +1,42 @@
 """Common helper functions"""
+import hashlib
+import json
 import os
-import re
+import pickle
 import shutil
 import sys
+import tarfile
 from os.path import join as pjoin
 
 import yaml
-from splinter.element_list import ElementList
-from selenium.common.exceptions import UnexpectedAlertPresentException
+
+# use LibYAML's loader if PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
+# directory for data that can be regenerated at any time
+CACHE_DIR = '.cache'
+
+# pickled copies of configuration files, by content hash
+CONFIG_CACHE_DIR = pjoin(CACHE_DIR, 'config')
+_configs = {}
+
+# reference PSFs, and the index of their header counts and content hashes
+REFERENCE_DIR = pjoin('files', 'references')
+REFERENCE_INDEX = pjoin(CACHE_DIR, 'references.json')
+_reference_index = None
+
+def get_reference_index():
+    """Returns this process's psf.ReferenceIndex of REFERENCE_DIR"""
+    global _reference_index
+    import psf
+
+    if _reference_index is None:
+        _reference_index = psf.ReferenceIndex(REFERENCE_DIR, REFERENCE_INDEX)
+        _reference_index.update()
+    return _reference_index
 
 def find_test_file(filename, module=None, root_dir='test_cases', ext='.yml'):
     """Looks for a test case or related file in the following order:
@@ -62,144 +91,77 @@ def find_test_file(filename, module=None, root_dir='test_cases', ext='.yml'):
     return path
 
 def setup_custom_options(test_case, module):
-    test_case = setup_test_inheritance(test_case, module)
-
-    map_filename = test_case.get('dict')
-    if map_filename:
-        map_filename = find_test_file(map_filename, module=module)
-        opt_map = read_yaml(map_filename)
-        for opt, settings in opt_map.items():
-            if opt in test_case:
-                value = str(test_case[opt])
-                pattern = r'\b' + opt + r'\b'
-
-                step = settings.get('step')
-                assert step, "Error: 'step' must be defined for custom options"
-                step = int(step) - 1
-
-                test_step = test_case['steps'][step]
-
-                presteps = settings.get('presteps')
-                if presteps:
-                    for ind, step in enumerate(presteps):
-                        presteps[ind] = re.sub(pattern, value, step)
-
-                    test_presteps = test_step.setdefault('presteps', [])
-                    test_presteps += presteps
-
-                elems = settings.get('elems')
-                if elems:
-                    for ind, elem in enumerate(elems):
-                        for elem_name, elem_value in elem.items():
-                            elem_value = str(elem_value)
-                            elems[ind][elem_name] = re.sub(pattern, value, elem_value)
-
-                    test_elems = test_step.setdefault('elems', [])
-                    test_elems += elems
-
-                poststeps = settings.get('poststeps')
-                if poststeps:
-                    for ind, step in enumerate(poststeps):
-                        poststeps[ind] = re.sub(pattern, value, step)
-
-                    test_poststeps = test_step.setdefault('poststeps', [])
-                    test_poststeps += poststeps
-
-    # look for "module" in each step
-    # can't use for loop b/c iteration is nonlinear
-    ind = 0
-    while ind < len(test_case['steps']):
-        step = test_case['steps'][ind]
-        if 'module' in step:
-            module_info = step['module']
-            module_name = module_info['name']
-            module_template = find_test_file(module_name, module=module_name)
-
-            test_template = read_yaml(module_template)
-
-            # inherit options from test_template
-            test_copy = test_case.copy()
-
-            # default to test_copy's options except for steps/dict/parent
-            for key in ('steps', 'dict', 'parent'):
-                if key in test_copy:
-                    del test_copy[key]
-
-            test_template.update(test_copy)
-
-            test_template = test_copy
-
-            # generate sub-case as though template were the main case
-            test_template = setup_custom_options(test_template, module=module_name)
-
-            # obtain user's desired slice of module's steps
-            index = module_info.get('index', None)
-            if index is None:
-                start = module_info.get('start', None)
-                stop = module_info.get('stop', None)
-                step_slice = slice(start, stop)
-                module_steps = test_template['steps'][step_slice]
-            else:
-                module_steps = [test_template['steps'][index]]
+    """Applies inheritance, custom options, and module steps to test_case
 
-            # replace module entry with steps
-            before = test_case['steps'][:ind]
-            after = test_case['steps'][ind+1:]
-            test_template['steps'] = before + module_steps + after
-            test_case = test_template
-
-            ind += len(module_steps)
-        else:
-            ind += 1
-
-    return test_case
+    See plan.PlanCompiler, which reads each file involved only once.
+    """
+    import plan
+    return plan.get_compiler().setup_custom_options(test_case, module)
 
 def setup_test_inheritance(child_case, module):
-    """Option inheritance logic is handled here.
+    """Returns child_case with the options it inherits from its parents
 
-    Test cases can inherit options from another test case. Option resolution
-    works similarly to variable-name resolution in Python's object inheritance
-    scheme, except that multiple inheritance is not allowed; i.e., test cases
-    may have only one parent.
-
-    If an option is defined in both the child and the parent, then the child's
-    value for that option used.
+    See plan.PlanCompiler.setup_test_inheritance().
     """
-    if not 'parent' in child_case:
-        child_case['parent'] = module
+    import plan
+    return plan.get_compiler().setup_test_inheritance(child_case, module)
 
-    lineage = [child_case]
-    filenames = [None]
-    parent = child_case.get('parent', module)
-    while parent != False:
-        # defaults to module name
-        if parent is None:
-            parent = module
+def read_yaml(filename):
+    """Shortcut for reading a YAML file referred by a filename"""
+    with open(filename) as file_obj:
+        return yaml.load(file_obj.read(), Loader=YAMLLoader)
 
-        # break if module has itself as parent
-        parent = find_test_file(parent, module=module)
-        if parent in filenames:
-            break
+def read_module_registry(filename='modules.yml'):
+    """Returns the registry of CHARMM-GUI modules
 
-        with open(parent) as parent_file:
-            parent_case = yaml.load(parent_file.read(), Loader=yaml.FullLoader)
-        lineage.append(parent_case)
-        filenames.append(parent)
+    Each entry of the registry file maps a case-insensitive module alias to
+    the base filename of its Python module, optionally followed by a dot
+    and the name of its BrowserProcess class. If the class name is omitted,
+    it is taken from the module's _BROWSER_PROCESS when it is imported.
 
-        child_case = parent_case
-        parent = child_case.get('parent', module)
+    Returns
+    =======
+        {ALIAS: (module filename, class name or None)}
+    """
+    registry = {}
+    for alias, entry in read_yaml(filename).items():
+        module_file, _dot, class_name = entry.partition('.')
+        registry[alias.upper()] = module_file, class_name or None
+    return registry
 
-    parent_case = lineage.pop()
-    while lineage:
-        child_case = lineage.pop()
-        parent_case.update(child_case)
+def load_config(filename):
+    """Returns the contents of a YAML configuration file, e.g. a menu
 
-    return parent_case
+    Each file is loaded once per process, and the same object is returned
+    to every caller, so it must not be modified. Load configs when a module
+    is imported, so that browser processes inherit them when forked.
 
-def read_yaml(filename):
-    """Shortcut for reading a YAML file referred by a filename"""
-    with open(filename) as file_obj:
-        return yaml.full_load(file_obj.read())
+    A pickled copy of each file is kept in CONFIG_CACHE_DIR under the
+    file's SHA-1, so a file is only parsed again after it changes.
+    """
+    if filename in _configs:
+        return _configs[filename]
+
+    with open(filename, 'rb') as file_obj:
+        content = file_obj.read()
+    digest = hashlib.sha1(content).hexdigest()
+    cache_file = pjoin(CONFIG_CACHE_DIR, digest + '.pickle')
+    try:
+        with open(cache_file, 'rb') as cache:
+            config = pickle.load(cache)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        config = yaml.load(content, Loader=YAMLLoader)
+        try:
+            os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            with open(tmp_file, 'wb') as cache:
+                pickle.dump(config, cache, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except OSError as exc:
+            warn("Warning: can't cache {}: {}".format(filename, exc))
+
+    _configs[filename] = config
+    return config
 
 def set_elem_value(elem, value):
     """Same as set_form_value, but if you have a ref to the actual element
@@ -208,6 +170,9 @@ def set_elem_value(elem, value):
 
     Warning: This will fail if splinter/slelenium changes their API!
     """
+    from splinter.element_list import ElementList
+    from selenium.common.exceptions import UnexpectedAlertPresentException
+
     input_type = elem._element.get_property('type')
     if input_type == "radio":
         elem = ElementList(filter(lambda e: e.value == str(value), elem),
@@ -277,76 +242,85 @@ def psf_seek_title(file_obj):
 
     return False, line_no
 
-def diff_psf(target, reference):
-    """Compares target and reference line-by-line.
+def read_archive_member(archive, member):
+    """Returns the contents of one file in a (compressed) tar archive
 
-    Comparison begins after the title.
+    The archive is read as a stream and nothing is written to disk. If no
+    member is named exactly `member`, the first member whose path ends with
+    '/' + basename(member) is used instead.
+
+    Returns None if no such member exists.
+    """
+    suffix = '/' + os.path.basename(member)
+    with tarfile.open(archive, 'r|*') as tar_obj:
+        for tar_info in tar_obj:
+            if not tar_info.isfile():
+                continue
+            if tar_info.name == member or tar_info.name.endswith(suffix):
+                return tar_obj.extractfile(tar_info).read()
+    return None
+
+def diff_psf(target, reference, charge_tol=1e-5, mass_tol=1e-4):
+    """Compares target and reference section-by-section.
+
+    Comparison begins after the title. See psf.diff() for how sections are
+    compared and what the tolerances mean.
 
     Parameters
     ==========
-      target        structure to check
-      reference     structure considered "correct"
+      target        structure to check (filename or psf.PSF)
+      reference     structure considered "correct" (same types as target)
+      charge_tol    absolute tolerance for charges
+      mass_tol      absolute tolerance for masses
 
     Return
     ======
         None if there are no differences;
         An error string if file can't be parsed;
-        Otherwise, a tuple showing the first difference is returned:
-            target_line_no, reference_line_no, target_line, reference_line
+        Otherwise, a psf.PSFDiff summarizing the differences per section.
     """
+    import psf
+
     invalid_file = 'Error: {} is not a regular file: {}'
     file_does_not_exist = 'Error: {} does not exist: {}'
-    invalid_title = 'Error: invalid title format for PSF: {}'
-
-    if isinstance(target, str):
-        if not os.path.exists(target):
-            return file_does_not_exist.format('target', target)
-        if not os.path.isfile(target):
-            return invalid_file.format('target', target)
-        target = open(target)
-
-    if isinstance(reference, str):
-        if not os.path.exists(reference):
-            return file_does_not_exist.format('reference', reference)
-        if not os.path.isfile(reference):
-            return invalid_file.format('reference', reference)
-        reference = open(reference)
-
-    with target:
-        with reference:
-            success, target_line_no = psf_seek_title(target)
-            if not success:
-                return invalid_title.format(target.name)
-
-            success, ref_line_no = psf_seek_title(reference)
-            if not success:
-                return invalid_title.format(reference.name)
-
-            for target_line, reference_line in zip(target, reference):
-                target_line_no += 1
-                ref_line_no += 1
-                target_line = target_line.strip().upper()
-                reference_line = reference_line.strip().upper()
-                if target_line != reference_line:
-                    return target_line_no, ref_line_no, target_line, reference_line
-
-            # compress any whitespace at end of file
-            target_data = target.read(512).rstrip()
-            reference_data = reference.read(512).rstrip()
-
-    if target_data != reference_data:
-        return target_line_no, ref_line_no, target_data, reference_data
+    invalid_format = 'Error: invalid PSF format for {}: {}'
 
-    return None
+    structures = []
+    for kind, source in ('target', target), ('reference', reference):
+        if isinstance(source, psf.PSF):
+            structures.append(source)
+            continue
+        if isinstance(source, str):
+            if not os.path.exists(source):
+                return file_does_not_exist.format(kind, source)
+            if not os.path.isfile(source):
+                return invalid_file.format(kind, source)
+        try:
+            structures.append(psf.PSF(source))
+        except ValueError as exc:
+            return invalid_format.format(kind, exc)
+
+    result = psf.diff(*structures, charge_tol=charge_tol, mass_tol=mass_tol)
+    return result or None
 
 def ref_from_label(label):
     """Returns an os-friendly filename from a test case label"""
     return label.strip().lower().replace(' ', '_')+'.psf'
 
 def validate_test_case(test_case, sys_dir, sys_archive=None, module=None,
-        elapsed_time=-1., printer_name=None):
+        elapsed_time=-1., printer_name=None, extract=False):
     """Attempts to infer a test's reference PSF, then validates it
 
+    If sys_dir does not exist, the target PSF is read directly from
+    sys_archive, unless extract is True, in which case the whole archive
+    is first extracted to the current directory.
+
+    Validation is tiered: a target whose section header counts differ from
+    the reference's is invalid, and a target whose content hash matches
+    the reference's (see psf.PSF.content_hash) is valid, without comparing
+    any section. Only otherwise is the detailed diff_psf() run. Reference
+    counts and hashes are cached in REFERENCE_INDEX.
+
     Parameters
     ==========
         sys_dir       str    name of project directory produced by this test case
@@ -354,19 +328,26 @@ def validate_test_case(test_case, sys_dir, sys_archive=None, module=None,
         test_case     dict   item from a test case configuration file
         module        str    module name
         elapsed_time  float  time since start of test case
+        extract       bool   whether to extract sys_archive if sys_dir is missing
 
     Returns
     =======
         A tuple representing the test cases's validation, for use with
         BrowserManager / CGUIBrowserProcess
     """
+    import psf
+
     # check test case for reference/target files
     ref = test_case.get('psf_validation')
 
     # modules must override this with psf_validation as necessary
     target = 'step1_pdbreader.psf'
+    tolerances = {}
     if isinstance(ref, dict):
         target = ref.get('target') or target
+        for key in 'charge_tol', 'mass_tol':
+            if key in ref:
+                tolerances[key] = float(ref[key])
         ref = ref.get('reference') or ref.get('ref')
 
     # looking in a standard location for the reference file
@@ -374,7 +355,7 @@ def validate_test_case(test_case, sys_dir, sys_archive=None, module=None,
     try:
         ref = find_test_file(ref_psf,
                 module=module,
-                root_dir='files/references',
+                root_dir=REFERENCE_DIR,
                 ext='.psf')
     except FileNotFoundError:
         msg = "couldn't find a reference PSF for "+\
@@ -388,46 +369,84 @@ def validate_test_case(test_case, sys_dir, sys_archive=None, module=None,
         # no reference for this system, just go to the next case
         return 'SUCCESS', test_case, elapsed_time
 
-    # extract system files if necessary
-    if not os.path.exists(sys_dir):
-        if os.path.exists(sys_archive):
-            shutil.unpack_archive(sys_archive)
-        else:
-            errmsg = "Error: Couldn't find archive: '{}'".format(sys_archive)
+    # read the target directly from the archive unless asked to extract it
+    target_path = pjoin(sys_dir, target)
+    if os.path.exists(sys_dir) or extract:
+        if not os.path.exists(sys_dir):
+            if sys_archive and os.path.exists(sys_archive):
+                shutil.unpack_archive(sys_archive)
+            else:
+                errmsg = "Error: Couldn't find archive: '{}'".format(sys_archive)
+                return 'INVALID', test_case, elapsed_time, errmsg
+
+        # ensure system directory exists
+        if not os.path.isdir(sys_dir):
+            if os.path.exists(sys_dir):
+                msg = "'{}' already exists and is not a directory"
+                raise FileExistsError(msg.format(sys_dir))
+            msg = "could not find project at '{}/'"
+            raise FileNotFoundError(msg.format(sys_dir))
+
+        if not os.path.isfile(target_path):
+            errmsg = 'Error: target does not exist: {}'.format(target_path) + os.linesep
+            return 'INVALID', test_case, elapsed_time, errmsg
+        target, name = target_path, target_path
+    elif sys_archive and os.path.exists(sys_archive):
+        member = pjoin(os.path.basename(os.path.normpath(sys_dir)), target)
+        target = read_archive_member(sys_archive, member)
+        if target is None:
+            errmsg = "Error: Couldn't find '{}' in archive: '{}'".format(member, sys_archive)
             return 'INVALID', test_case, elapsed_time, errmsg
+        name = sys_archive+':'+member
+    else:
+        errmsg = "Error: Couldn't find archive: '{}'".format(sys_archive)
+        return 'INVALID', test_case, elapsed_time, errmsg
 
-    # ensure system directory exists
-    if not os.path.isdir(sys_dir):
-        if os.path.exists(sys_dir):
-            msg = "'{}' already exists and is not a directory"
-            raise FileExistsError(msg.format(sys_dir))
-        msg = "could not find project at '{}/'"
-        raise FileNotFoundError(msg.format(sys_dir))
+    try:
+        target = psf.PSF(target, name=name)
+    except ValueError as exc:
+        errmsg = 'Error: invalid PSF format for target: {}'.format(exc) + os.linesep
+        return 'INVALID', test_case, elapsed_time, errmsg
+
+    # cheapest check first: do the section sizes match?
+    ref_entry = get_reference_index().lookup(ref)
+    result = psf.diff_counts(target, ref_entry['counts'], ref)
+    if result:
+        return 'INVALID', test_case, elapsed_time, str(result)
+
+    # identical content (ignoring case and surrounding whitespace) is valid
+    if target.content_hash() == ref_entry['hash']:
+        return 'VALID', test_case, elapsed_time
 
-    # finally, do the actual PSF comparison
-    target = pjoin(sys_dir, target)
-    result = diff_psf(target, ref)
+    # finally, do the detailed PSF comparison
+    result = diff_psf(target, ref, **tolerances)
 
-    # result is a string if PSF can't be parsed
-    if isinstance(result, str):
-        errmsg = result + os.linesep
-    # result is a tuple if files differ
-    if isinstance(result, tuple):
-        target_line_no, ref_line_no, target_line, ref_line = result
-        errmsg = [
-            'Target ({}) differs from reference ({}):',
-            '{} line {}',
-            target_line,
-            '{} line {}',
-            ref_line,
-        ]
-        errmsg = os.linesep.join(errmsg)
-        errmsg = errmsg.format(target, ref, target, target_line_no, ref, ref_line_no)
     # result is None on success
     if result is None:
         return 'VALID', test_case, elapsed_time
+
+    # result is a string if PSF can't be parsed, else a summary of differences
+    errmsg = str(result)
+    if isinstance(result, str):
+        errmsg += os.linesep
     return 'INVALID', test_case, elapsed_time, errmsg
 
+def write_text_atomic(path, text):
+    """Replaces the contents of path with text in a single step
+
+    The text is written to a temporary file next to path, which is then
+    renamed, so readers never see a partially written file.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_file, 'w') as file_obj:
+        file_obj.write(text)
+    os.replace(tmp_file, path)
+
+def write_json_atomic(path, obj):
+    """Replaces the contents of path with obj in JSON format"""
+    write_text_atomic(path, json.dumps(obj))
+
 def get_sys_dirname(jobid):
     """Returns the directory name associated with a job ID"""
     return 'charmm-gui-{}'.format(jobid)
@@ -436,6 +455,12 @@ def get_archive_name(jobid):
     """Returns the archive (.tgz) file associated with a job ID"""
     return 'charmm-gui-{}.tgz'.format(jobid)
 
+def project_copy_name(jobid, copy_no, branch=None):
+    """Returns the job ID of a copy of a project made at a branching point"""
+    if branch is None:
+        return '{}_{}'.format(jobid, copy_no)
+    return '{}_{}_{}'.format(jobid, branch, copy_no)
+
 def warn(*strs):
     """Shortcut for print(..., file=sys.stderr)"""
     print(*strs, file=sys.stderr)